@@ -0,0 +1,68 @@
+"""
+Throughput of job.py create (Connector.create_group in multiprocessing.Pool) with and without
+keep-alive connection pooling.
+"exists" workload runs check_group_exists of every node instead, it has no commits,
+so the share of connection setup in the request cost is better visible.
+
+    python3 benchmarks/bench_connector_sessions.py --ids 10000 --processes 16 --workload create
+"""
+
+import json
+import os
+import sys
+import time
+from functools import partial
+from multiprocessing import Pool
+
+import click
+from harness import load_app, serve
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+)
+from connector import Connector, check_group_exists  # noqa: E402
+
+
+def exists_everywhere(connector: Connector, group_id: str) -> bool:
+    return all(
+        check_group_exists(group_id, host, node, connector.session(host))
+        for node, host in connector.hosts.items()
+    )
+
+
+@click.command()
+@click.option("--ids", "n_ids", default=10000, show_default=True)
+@click.option("--processes", default=16, show_default=True)
+@click.option("--random-behavior", default=0.0, show_default=True)
+@click.option("--workload", type=click.Choice(["create", "exists"]), default="create")
+def run(n_ids, processes, random_behavior, workload):
+    main = load_app(random_behavior)
+    url = serve(main)
+    hosts = {node: url for node in ("node01", "node02", "node03")}
+    for pool_size in (0, 10):
+        connector = Connector(hosts, pool_size=pool_size)
+        group_ids = [f"{pool_size}-{i}" for i in range(n_ids)]
+        operation = (
+            connector.create_group
+            if workload == "create"
+            else partial(exists_everywhere, connector)
+        )
+        start = time.perf_counter()
+        with Pool(processes) as p:
+            p.map(operation, group_ids, chunksize=64)
+        elapsed = time.perf_counter() - start
+        click.echo(
+            json.dumps(
+                {
+                    "workload": workload,
+                    "pool_size": pool_size,
+                    "ids": n_ids,
+                    "seconds": round(elapsed, 2),
+                    "operations_per_second": round(n_ids / elapsed, 1),
+                }
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
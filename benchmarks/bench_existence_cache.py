@@ -0,0 +1,89 @@
+"""
+Existence checks of /group and /groups/exists endpoints with and without the existence cache
+(existence.py): GET of missing groupIds, GET and duplicate POST of existing ones (the same
+100 groupIds, which stay in the LRU of positives), DELETE of missing groupIds, and
+/groups/exists of 1000 groupIds, half of them missing. POST and DELETE are always written
+to the database, they show the cost of the cache on writes. Time of building the cache
+of the seeded table is reported as warm_seconds.
+
+    python3 benchmarks/bench_existence_cache.py --sizes 10000,1000000
+"""
+
+import json
+import time
+
+import click
+from harness import clear, load_app, measure, seed
+
+
+def run_requests(client, size: int, n_requests: int, batch: int) -> dict:
+    headers = {"node": "node01"}
+    return {
+        "GET miss": measure(
+            lambda i: client.get(f"/group/missing-{i}", headers=headers), n_requests
+        ),
+        "GET hit": measure(
+            lambda i: client.get(
+                f"/group/seed-{i % 100 * 997 % size}", headers=headers
+            ),
+            n_requests,
+        ),
+        "POST duplicate": measure(
+            lambda i: client.post(
+                "/group",
+                data=json.dumps({"groupId": f"seed-{i % 100 * 997 % size}"}),
+                headers=headers,
+            ),
+            n_requests,
+        ),
+        "DELETE miss": measure(
+            lambda i: client.delete(
+                "/group", data=json.dumps({"groupId": f"missing-{i}"}), headers=headers
+            ),
+            n_requests,
+        ),
+        "POST /groups/exists": measure(
+            lambda i: client.post(
+                "/groups/exists",
+                data=json.dumps(
+                    {
+                        "groupIds": [
+                            f"seed-{j * 997 % size}" if j % 2 else f"missing-{i}-{j}"
+                            for j in range(batch)
+                        ]
+                    }
+                ),
+                headers=headers,
+            ),
+            max(1, n_requests // 10),
+        ),
+    }
+
+
+@click.command()
+@click.option("--sizes", default="10000,1000000", show_default=True)
+@click.option("--requests", "n_requests", default=1000, show_default=True)
+def run(sizes, n_requests):
+    main = load_app(nodes=1)
+    client = main.app.test_client()
+    client.get("/ping")  # creates tables
+    # EXISTENCE_CACHE is off by default, the caches are built by the benchmark
+    caches = {"node01": main.ExistenceCache()}
+    main.existence_caches.update(caches)
+    batch = main.app.config["GROUP_BATCH_LIMIT"]
+    for size in [int(s) for s in sizes.split(",")]:
+        clear(main, "node01")
+        seed(main, "node01", size)
+        start = time.perf_counter()
+        main.rebuild_existence_cache("node01")
+        result = {"rows": size, "warm_seconds": round(time.perf_counter() - start, 2)}
+        # requests of the benchmark don't change the table, the cache stays valid while off
+        main.existence_caches.clear()
+        result["without cache"] = run_requests(client, size, n_requests, batch)
+        main.existence_caches.update(caches)
+        result["with cache"] = run_requests(client, size, n_requests, batch)
+        click.echo(json.dumps(result))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,100 @@
+"""
+Throughput and latency of Connector.create_group as the number of nodes grows,
+with requests of one operation sent to the nodes one after another and concurrently (--fan-out).
+Every number of nodes runs in its own process, because nodes are registered at import
+of the cluster application (NODE_COUNT).
+
+    python3 benchmarks/bench_fan_out.py --nodes 3 --nodes 8 --nodes 16 --nodes 32 --ids 2000
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+from multiprocessing import Pool
+from typing import Optional
+
+import click
+from harness import load_app, percentile, serve
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+)
+from connector import Connector  # noqa: E402
+
+connector = None
+
+
+def init_worker(hosts, fan_out):
+    global connector
+    connector = Connector(hosts, fan_out=fan_out)
+
+
+def create_group(group_id: str) -> Optional[float]:
+    """Returns latency in milliseconds, None if the operation failed"""
+    start = time.perf_counter()
+    try:
+        connector.create_group(group_id)
+    except Exception:
+        return None
+    return (time.perf_counter() - start) * 1000
+
+
+def run_nodes(n_nodes, n_ids, processes):
+    main = load_app(nodes=n_nodes)
+    url = serve(main)
+    hosts = {node: url for node in main.hosts}
+    for fan_out in (False, True):
+        group_ids = [f"{fan_out}-{i}" for i in range(n_ids)]
+        start = time.perf_counter()
+        with Pool(processes, initializer=init_worker, initargs=(hosts, fan_out)) as p:
+            results = p.map(create_group, group_ids, chunksize=16)
+        elapsed = time.perf_counter() - start
+        latencies = [latency for latency in results if latency is not None]
+        click.echo(
+            json.dumps(
+                {
+                    "nodes": n_nodes,
+                    "fan_out": fan_out,
+                    "ids": n_ids,
+                    "operations_per_second": round(len(latencies) / elapsed, 1),
+                    "writes_per_second": round(len(latencies) * n_nodes / elapsed, 1),
+                    "failed": n_ids - len(latencies),
+                    "p50_ms": round(percentile(latencies, 0.5), 2),
+                    "p99_ms": round(percentile(latencies, 0.99), 2),
+                }
+            )
+        )
+
+
+@click.command()
+@click.option(
+    "--nodes", multiple=True, type=int, default=(3, 8, 16, 32), show_default=True
+)
+@click.option("--ids", "n_ids", default=2000, show_default=True)
+@click.option("--processes", default=4, show_default=True)
+@click.option("--single", is_flag=True, hidden=True)
+def run(nodes, n_ids, processes, single):
+    if single:
+        run_nodes(nodes[0], n_ids, processes)
+        return
+    for n_nodes in nodes:
+        subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--single",
+                "--nodes",
+                str(n_nodes),
+                "--ids",
+                str(n_ids),
+                "--processes",
+                str(processes),
+            ],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    run()
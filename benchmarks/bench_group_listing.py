@@ -0,0 +1,63 @@
+"""
+Streaming listing of a node (GET /groups, NDJSON with keyset pagination) read through
+Connector.node_groups, as the table grows. Every size is seeded into its own node.
+Server and client run in this process, peak of Python memory allocated during the listing
+(tracemalloc) is reported: it stays flat while the table grows, because neither side holds
+more than one chunk of records. tracemalloc slows the listing down, rows_per_second is measured
+by a separate listing without it.
+
+    python3 benchmarks/bench_group_listing.py --rows 10000 --rows 100000 --rows 1000000
+"""
+
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import click
+from harness import load_app, seed, serve
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+)
+from connector import Connector  # noqa: E402
+
+
+@click.command()
+@click.option(
+    "--rows",
+    multiple=True,
+    type=int,
+    default=(10000, 100000, 1000000),
+    show_default=True,
+)
+@click.option("--order", type=click.Choice(["id", "groupId"]), default="id")
+def run(rows, order):
+    rows = sorted(rows)
+    main = load_app(nodes=max(3, len(rows)))
+    url = serve(main)
+    connector = Connector({node: url for node in main.hosts})
+    for node, n_rows in zip(main.hosts, rows):
+        seed(main, node, n_rows)
+        start = time.perf_counter()
+        count = sum(1 for _ in connector.node_groups(node, order))
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        sum(1 for _ in connector.node_groups(node, order))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        click.echo(
+            json.dumps(
+                {
+                    "rows": count,
+                    "order": order,
+                    "rows_per_second": round(count / elapsed),
+                    "peak_memory_mb": round(peak / 2**20, 2),
+                }
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
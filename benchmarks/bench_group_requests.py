@@ -0,0 +1,51 @@
+"""
+Per-request latency of /group endpoint depending on the table size.
+
+Every operation is served by one indexed statement, so latency should stay flat
+from thousands to millions of rows.
+
+    python3 benchmarks/bench_group_requests.py --sizes 1000,10000,100000,1000000
+"""
+
+import json
+
+import click
+from harness import load_app, measure, seed
+
+
+@click.command()
+@click.option("--sizes", default="1000,10000,100000,1000000", show_default=True)
+@click.option("--requests", "n_requests", default=500, show_default=True)
+def run(sizes, n_requests):
+    results = []
+    for size in [int(s) for s in sizes.split(",")]:
+        main = load_app()
+        seed(main, "node01", size)
+        client = main.app.test_client()
+        headers = {"node": "node01"}
+        result = {"rows": size}
+        result["GET hit"] = measure(
+            lambda i: client.get(f"/group/seed-{i * 997 % size}", headers=headers),
+            n_requests,
+        )
+        result["GET miss"] = measure(
+            lambda i: client.get(f"/group/missing-{i}", headers=headers), n_requests
+        )
+        result["POST"] = measure(
+            lambda i: client.post(
+                "/group", data=json.dumps({"groupId": f"new-{i}"}), headers=headers
+            ),
+            n_requests,
+        )
+        result["DELETE"] = measure(
+            lambda i: client.delete(
+                "/group", data=json.dumps({"groupId": f"new-{i}"}), headers=headers
+            ),
+            n_requests,
+        )
+        results.append(result)
+        click.echo(json.dumps(result))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,102 @@
+"""
+Connector.create_group and Connector.delete_group with unstable nodes (RANDOM_BEHAVIOR),
+with writes sent once and rolled back on failure, and with writes carrying Idempotency-Key,
+retried by the retry policy, and deletes sent without existence check.
+requests is the number of requests sent to the nodes per operation, including existence
+checks, retries and rollbacks, applied is the number of groups created or deleted in every node.
+
+    python3 benchmarks/bench_idempotency_keys.py --ids 2000 --random-behavior 0.2
+"""
+
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+from typing import List, Optional, Tuple
+
+import click
+import requests
+from harness import load_app, percentile, serve
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+)
+from connector import Connector  # noqa: E402
+
+connector = None
+
+
+def init_worker(hosts, options):
+    global connector
+    connector = Connector(hosts, **options)
+
+
+def sent_requests() -> int:
+    return sum(node["requests"] for node in connector.policy.counters().values())
+
+
+def run_operation(args) -> Tuple[Optional[float], int]:
+    """Returns latency in milliseconds (None if the operation raised) and number of requests"""
+    command, group_id = args
+    before = sent_requests()
+    start = time.perf_counter()
+    try:
+        if command == "create":
+            connector.create_group(group_id)
+        else:
+            connector.delete_group(group_id)
+        latency = (time.perf_counter() - start) * 1000
+    except Exception:
+        latency = None
+    return latency, sent_requests() - before
+
+
+def node_counts(url: str) -> List[int]:
+    consistent, counts = requests.get(f"{url}/stats").json()
+    return list(counts.values())
+
+
+@click.command()
+@click.option("--ids", "n_ids", default=2000, show_default=True)
+@click.option("--processes", default=8, show_default=True)
+@click.option("--random-behavior", default=0.2, show_default=True)
+@click.option("--fan-out/--no-fan-out", default=True, show_default=True)
+def run(n_ids, processes, random_behavior, fan_out):
+    main = load_app(random_behavior)
+    url = serve(main)
+    hosts = {node: url for node in main.hosts}
+    for idempotency_keys in (False, True):
+        options = {"fan_out": fan_out, "idempotency_keys": idempotency_keys}
+        group_ids = [f"{idempotency_keys}-{i}" for i in range(n_ids)]
+        with Pool(processes, initializer=init_worker, initargs=(hosts, options)) as p:
+            for command in ("create", "delete"):
+                before = node_counts(url)
+                start = time.perf_counter()
+                results = p.map(
+                    run_operation,
+                    [(command, group_id) for group_id in group_ids],
+                    chunksize=16,
+                )
+                elapsed = time.perf_counter() - start
+                after = node_counts(url)
+                latencies = [latency for latency, _ in results if latency is not None]
+                click.echo(
+                    json.dumps(
+                        {
+                            "idempotency_keys": idempotency_keys,
+                            "command": command,
+                            "operations": n_ids,
+                            "operations_per_second": round(n_ids / elapsed, 1),
+                            "raised": n_ids - len(latencies),
+                            "applied": min(abs(a - b) for a, b in zip(after, before)),
+                            "requests": round(sum(n for _, n in results) / n_ids, 2),
+                            "p50_ms": round(percentile(latencies, 0.5), 2),
+                            "p99_ms": round(percentile(latencies, 0.99), 2),
+                        }
+                    )
+                )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,304 @@
+"""
+Load generator: a mix of create, delete, get and stats operations sent by concurrent worker
+processes, through raw HTTP (one request to a random node per operation, module functions
+of connector.py) and through Connector (create_group/delete_group on all nodes with rollback,
+existence check of a random node). Every combination of --client, --rows, --random-behavior
+(or --faults) and --concurrency is one run, reported as one JSON line:
+
+    {"client", "rows", "random_behavior", "faults", "concurrency", "mix", "operations", "seconds",
+     "operations_per_second", "errors", "rollbacks", "p50_ms", "p95_ms", "p99_ms",
+     "ops": {op: {"operations", "errors", "p50_ms", "p95_ms", "p99_ms"}}}
+
+Before runs of every table size all nodes are seeded with groupIds seed-0..seed-<rows-1>.
+Creates add new groupIds, deletes remove seeded groupIds not deleted by the previous runs
+(missing ones once the seeds run out), gets ask for seed-0..seed-<2*rows-1>, half of which exist.
+Errors are operations which raised, gets of Connector which didn't learn the existence,
+or with raw HTTP got a status other than the contract of the endpoint (e.g. 500 injected
+by RANDOM_BEHAVIOR). Rollbacks are counted by Connector runs,
+Connector writes carry Idempotency-Key and are retried unless --no-idempotency-keys is given.
+Operations are generated from --seed, so runs with the same options send the same workload.
+--faults are JSON files with fault profiles of the API (format in cluster/faults.py), which
+replace --random-behavior runs, so strategies can be compared under the same seeded faults.
+
+    python3 benchmarks/bench_load.py --mix create=30,delete=10,get=50,stats=10 \\
+        --client http --client connector --concurrency 1 --concurrency 8 \\
+        --rows 0 --rows 100000 --random-behavior 0 --random-behavior 0.2 --output results.jsonl
+"""
+
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+from itertools import count
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Tuple
+
+import click
+from harness import clear, latency_summary, load_app, seed, serve
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+)
+from connector import (  # noqa: E402
+    Connector,
+    create_node_group,
+    delete_node_group,
+    get_node_group,
+)
+
+OPERATIONS = ("create", "delete", "get", "stats")
+# status codes of the endpoints which are not errors
+EXPECTED_STATUSES = {
+    "create": (201, 400),
+    "delete": (200, 404),
+    "get": (200, 404),
+    "stats": (200,),
+}
+
+connector = None
+client = None
+
+
+def init_worker(hosts, client_, idempotency_keys):
+    global connector, client
+    client = client_
+    connector = Connector(
+        hosts, fan_out=True, journal_dir=None, idempotency_keys=idempotency_keys
+    )
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    """Parses "create=30,get=70" into operation -> weight"""
+    weights = {}
+    for part in mix.split(","):
+        op, _, weight = part.partition("=")
+        op = op.strip()
+        if op not in OPERATIONS:
+            raise click.BadParameter(f"Unknown operation {op!r}, one of {OPERATIONS}")
+        weights[op] = int(weight or 1)
+    if not any(weights.values()):
+        raise click.BadParameter("Mix has no operation with positive weight")
+    return weights
+
+
+def run_operation(args) -> Tuple[str, float, bool, int]:
+    """
+    Returns operation, latency in milliseconds, True if it succeeded,
+    and number of rollbacks done by the operation
+    """
+    op, group_id, node = args
+    host = connector.hosts[node]
+    rollbacks = connector.metrics()["rollbacks"]
+    start = time.perf_counter()
+    try:
+        if op == "stats":
+            resp = connector.session(host).get(f"{host}/stats")
+            ok = resp.status_code in EXPECTED_STATUSES[op]
+        elif client == "connector":
+            ok = True
+            if op == "create":
+                connector.create_group(group_id)
+            elif op == "delete":
+                connector.delete_group(group_id)
+            else:
+                ok = connector.exists(group_id, host, node) is not None
+        else:
+            session = connector.session(host)
+            timestamp = datetime.utcnow().timestamp()
+            if op == "create":
+                resp = create_node_group(group_id, host, node, timestamp, session)
+            elif op == "delete":
+                resp = delete_node_group(group_id, host, node, timestamp, session)
+            else:
+                resp = get_node_group(group_id, host, node, session)
+            ok = resp.status_code in EXPECTED_STATUSES[op]
+    except Exception:
+        ok = False
+    latency = (time.perf_counter() - start) * 1000
+    return op, latency, ok, connector.metrics()["rollbacks"] - rollbacks
+
+
+def workload(
+    weights: Dict[str, int],
+    n_operations: int,
+    nodes: List[str],
+    rows: int,
+    deletable: List[int],
+    rng: random.Random,
+    run_id: int,
+) -> List[Tuple[str, Optional[str], str]]:
+    """
+    Generates (operation, groupId, node) list. Deleted seeds are popped from deletable,
+    so the following runs of the table size don't delete them again
+    """
+    ops = rng.choices(list(weights), weights=list(weights.values()), k=n_operations)
+    created = count()
+    operations = []
+    for i, op in enumerate(ops):
+        if op == "create":
+            group_id = f"load-{run_id}-{next(created)}"
+        elif op == "delete":
+            group_id = f"seed-{deletable.pop()}" if deletable else f"missing-{i}"
+        elif op == "get":
+            group_id = f"seed-{rng.randrange(max(1, 2 * rows))}"
+        else:
+            group_id = None
+        operations.append((op, group_id, rng.choice(nodes)))
+    return operations
+
+
+def summary(results: List[Tuple[str, float, bool, int]]) -> Dict:
+    """Number of operations, errors and latency percentiles of run_operation results"""
+    return {
+        "operations": len(results),
+        "errors": sum(not ok for _, _, ok, _ in results),
+        **latency_summary([latency for _, latency, _, _ in results]),
+    }
+
+
+@click.command()
+@click.option(
+    "--mix",
+    default="create=30,delete=10,get=50,stats=10",
+    show_default=True,
+    help="Weights of the operations",
+)
+@click.option(
+    "--client",
+    "clients",
+    multiple=True,
+    type=click.Choice(["http", "connector"]),
+    default=("http", "connector"),
+    show_default=True,
+)
+@click.option(
+    "--concurrency",
+    multiple=True,
+    type=int,
+    default=(1, 4, 16),
+    show_default=True,
+    help="Number of worker processes",
+)
+@click.option(
+    "--rows",
+    multiple=True,
+    type=int,
+    default=(0, 100000),
+    show_default=True,
+    help="Records seeded into every node",
+)
+@click.option(
+    "--random-behavior",
+    multiple=True,
+    type=float,
+    default=(0, 0.2),
+    show_default=True,
+)
+@click.option(
+    "--faults",
+    "fault_files",
+    multiple=True,
+    type=click.File("r"),
+    help="Fault profile JSON file, replaces --random-behavior runs",
+)
+@click.option(
+    "--operations", "n_operations", default=2000, show_default=True, help="Per run"
+)
+@click.option("--nodes", "n_nodes", default=3, show_default=True)
+@click.option(
+    "--idempotency-keys/--no-idempotency-keys",
+    default=True,
+    show_default=True,
+    help="Connector retries writes with Idempotency-Key, without it failed writes are rolled back",
+)
+@click.option("--seed", "rng_seed", default=0, show_default=True)
+@click.option(
+    "--output",
+    type=click.File("a"),
+    default=None,
+    help="Also append results to this JSONL file",
+)
+def run(
+    mix,
+    clients,
+    concurrency,
+    rows,
+    random_behavior,
+    fault_files,
+    n_operations,
+    n_nodes,
+    idempotency_keys,
+    rng_seed,
+    output,
+):
+    weights = parse_mix(mix)
+    main = load_app(nodes=n_nodes)
+    if fault_files:
+        profiles = [
+            (None, os.path.basename(file.name), json.load(file)) for file in fault_files
+        ]
+    else:
+        profiles = [
+            (behavior, None, main.random_behavior_profile(behavior))
+            for behavior in random_behavior
+        ]
+    url = serve(main)
+    hosts = {node: url for node in main.hosts}
+    nodes = list(hosts)
+    rng = random.Random(rng_seed)
+    run_id = count()
+    for n_rows in rows:
+        for node in nodes:
+            clear(main, node)
+            seed(main, node, n_rows)
+        deletable = list(range(n_rows))
+        rng.shuffle(deletable)
+        for behavior, faults, profile in profiles:
+            for client_ in clients:
+                for processes in concurrency:
+                    # RNG and outage windows of the profile start anew for every run
+                    main.faults.configure(profile)
+                    operations = workload(
+                        weights,
+                        n_operations,
+                        nodes,
+                        n_rows,
+                        deletable,
+                        rng,
+                        next(run_id),
+                    )
+                    with Pool(
+                        processes,
+                        initializer=init_worker,
+                        initargs=(hosts, client_, idempotency_keys),
+                    ) as p:
+                        start = time.perf_counter()
+                        results = p.map(run_operation, operations, chunksize=8)
+                        elapsed = time.perf_counter() - start
+                    report = {
+                        "client": client_,
+                        "rows": n_rows,
+                        "random_behavior": behavior,
+                        "faults": faults,
+                        "concurrency": processes,
+                        "mix": weights,
+                        "seconds": round(elapsed, 3),
+                        "operations_per_second": round(len(results) / elapsed, 1),
+                        **summary(results),
+                        "rollbacks": sum(rollbacks for *_, rollbacks in results),
+                        "ops": {
+                            op: summary([r for r in results if r[0] == op])
+                            for op in weights
+                        },
+                    }
+                    line = json.dumps(report)
+                    click.echo(line)
+                    if output is not None:
+                        output.write(line + "\n")
+                        output.flush()
+
+
+if __name__ == "__main__":
+    run()
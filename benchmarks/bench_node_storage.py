@@ -0,0 +1,109 @@
+"""
+Write throughput of POST /group spread over all nodes, with every node kept in its own
+database file and with all nodes kept in one shared file, as before per node databases.
+Every layout runs in its own process, because engines are created once.
+Clients are processes with keep-alive sessions, client i writes unique groupIds to node i % 3.
+
+    python3 benchmarks/bench_node_storage.py --clients 48 --writes 6000
+"""
+
+import json
+import subprocess
+import sys
+import time
+from multiprocessing import Pool
+
+import click
+import requests
+from harness import load_app, percentile, serve
+
+LAYOUTS = ("shared", "per-node")
+
+
+def create_groups(args):
+    url, node, group_ids = args
+    session = requests.Session()
+    latencies = []
+    failed = 0
+    for group_id in group_ids:
+        start = time.perf_counter()
+        resp = session.post(
+            f"{url}/group",
+            data=json.dumps({"groupId": group_id}),
+            headers={"node": node},
+        )
+        latencies.append((time.perf_counter() - start) * 1000)
+        failed += resp.status_code != 201
+    return latencies, failed
+
+
+def run_layout(layout, clients, writes, coalescing):
+    main = load_app(shared_storage=layout == "shared", WRITE_COALESCING=coalescing)
+    url = serve(main)
+    nodes = list(main.hosts)
+    per_client = writes // clients
+    start = time.perf_counter()
+    with Pool(clients) as p:
+        results = p.map(
+            create_groups,
+            [
+                (
+                    url,
+                    nodes[i % len(nodes)],
+                    [f"{i}-{j}" for j in range(per_client)],
+                )
+                for i in range(clients)
+            ],
+        )
+    elapsed = time.perf_counter() - start
+    latencies = [latency for client, _ in results for latency in client]
+    failed = sum(failed for _, failed in results)
+    click.echo(
+        json.dumps(
+            {
+                "layout": layout,
+                "coalescing": coalescing,
+                "clients": clients,
+                "writes": len(latencies),
+                "writes_per_second": round((len(latencies) - failed) / elapsed, 1),
+                "failed": failed,
+                "p50_ms": round(percentile(latencies, 0.5), 2),
+                "p99_ms": round(percentile(latencies, 0.99), 2),
+            }
+        )
+    )
+
+
+@click.command()
+@click.option("--layout", type=click.Choice(LAYOUTS), default=None)
+@click.option("--clients", default=48, show_default=True)
+@click.option("--writes", default=6000, show_default=True)
+@click.option(
+    "--coalescing/--no-coalescing",
+    default=True,
+    show_default=True,
+    help="WRITE_COALESCING, group commit of concurrent writes of a node",
+)
+def run(layout, clients, writes, coalescing):
+    if layout:
+        run_layout(layout, clients, writes, coalescing)
+        return
+    for layout in LAYOUTS:
+        subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--layout",
+                layout,
+                "--clients",
+                str(clients),
+                "--writes",
+                str(writes),
+                "--coalescing" if coalescing else "--no-coalescing",
+            ],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    run()
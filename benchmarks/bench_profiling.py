@@ -0,0 +1,85 @@
+"""
+Overhead of request profiling (profiling.py) on /group and /stats requests: profiling off,
+every request timed for the log of slow requests (the default), Server-Timing header on every
+response, and cProfile capture of every request. Breakdown of the Server-Timing header
+averaged over the requests is reported as phases_ms.
+
+    python3 benchmarks/bench_profiling.py --rows 100000
+"""
+
+import json
+import re
+import tempfile
+
+import click
+from harness import load_app, measure, seed
+
+MODES = {
+    "off": {"sample_rate": 0, "slow_request_seconds": None},
+    "slow log": {"sample_rate": 0, "slow_request_seconds": 1.0},
+    "Server-Timing": {"sample_rate": 1, "slow_request_seconds": 1.0},
+    "cProfile": {"sample_rate": 0, "slow_request_seconds": 1.0},
+}
+
+
+def run_requests(client, size: int, n_requests: int) -> dict:
+    headers = {"node": "node01"}
+    return {
+        "GET miss": measure(
+            lambda i: client.get(f"/group/missing-{i}", headers=headers), n_requests
+        ),
+        "POST": measure(
+            lambda i: client.post(
+                "/group", data=json.dumps({"groupId": f"new-{i}"}), headers=headers
+            ),
+            n_requests,
+        ),
+        "DELETE": measure(
+            lambda i: client.delete(
+                "/group", data=json.dumps({"groupId": f"new-{i}"}), headers=headers
+            ),
+            n_requests,
+        ),
+        "GET /stats": measure(lambda i: client.get("/stats"), n_requests),
+    }
+
+
+def phases(client, n_requests: int) -> dict:
+    """Server-Timing breakdown of POST /group averaged over the requests, in ms"""
+    totals = {}
+    for i in range(n_requests):
+        response = client.post(
+            "/group",
+            data=json.dumps({"groupId": f"phases-{i}"}),
+            headers={"node": "node01"},
+        )
+        for phase, ms in re.findall(
+            r"(\w+);dur=([\d.]+)", response.headers["Server-Timing"]
+        ):
+            totals[phase] = totals.get(phase, 0.0) + float(ms)
+    return {phase: round(ms / n_requests, 3) for phase, ms in totals.items()}
+
+
+@click.command()
+@click.option("--rows", default=100000, show_default=True)
+@click.option("--requests", "n_requests", default=1000, show_default=True)
+def run(rows, n_requests):
+    main = load_app(nodes=1, PROFILE_DIR=tempfile.mkdtemp(prefix="cluster-profiles-"))
+    main.profiler.directory = main.app.config["PROFILE_DIR"]
+    seed(main, "node01", rows)
+    client = main.app.test_client()
+    result = {"rows": rows}
+    for mode, settings in MODES.items():
+        client.put("/admin/profile", data=json.dumps(settings))
+        if mode == "cProfile":
+            # /group and /stats requests of run_requests
+            client.put("/admin/profile", data=json.dumps({"requests": 4 * n_requests}))
+        result[mode] = run_requests(client, rows, n_requests)
+        if mode == "Server-Timing":
+            result["phases_ms"] = phases(client, n_requests)
+    client.delete("/admin/profile")
+    click.echo(json.dumps(result))
+
+
+if __name__ == "__main__":
+    run()
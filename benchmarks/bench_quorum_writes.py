@@ -0,0 +1,116 @@
+"""
+Latency and success rate of Connector.create_group and Connector.delete_group with unstable
+nodes (RANDOM_BEHAVIOR), when every node must acknowledge the write and with W-of-N quorum
+(write_quorum) and hinted handoff. Deletes check existence first, with --hedge-percentile
+these checks are hedged.
+applied is the number of groups created or deleted in every node, operations which were
+rolled back are not, stats are read after worker processes delivered their hints.
+
+    python3 benchmarks/bench_quorum_writes.py --ids 2000 --random-behavior 0.2 --quorum 2
+"""
+
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
+from typing import List, Optional
+
+import click
+import requests
+from harness import load_app, percentile, serve
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+)
+from connector import Connector  # noqa: E402
+
+connector = None
+
+
+def init_worker(hosts, options):
+    global connector
+    connector = Connector(hosts, **options)
+    Finalize(connector, connector.close, exitpriority=10)
+
+
+def run_operation(args) -> Optional[float]:
+    """Returns latency in milliseconds, None if the operation raised"""
+    command, group_id = args
+    start = time.perf_counter()
+    try:
+        if command == "create":
+            connector.create_group(group_id)
+        else:
+            connector.delete_group(group_id)
+    except Exception:
+        return None
+    return (time.perf_counter() - start) * 1000
+
+
+def node_counts(url: str) -> List[int]:
+    consistent, counts = requests.get(f"{url}/stats").json()
+    return list(counts.values())
+
+
+@click.command()
+@click.option("--ids", "n_ids", default=2000, show_default=True)
+@click.option("--processes", default=8, show_default=True)
+@click.option("--random-behavior", default=0.2, show_default=True)
+@click.option("--quorum", default=2, show_default=True, help="write_quorum")
+@click.option("--hedge-percentile", default=0.9, show_default=True)
+def run(n_ids, processes, random_behavior, quorum, hedge_percentile):
+    main = load_app(random_behavior)
+    url = serve(main)
+    hosts = {node: url for node in main.hosts}
+    modes = [
+        ("all", {"fan_out": True}),
+        ("quorum", {"fan_out": True, "write_quorum": quorum}),
+        (
+            "quorum+hedge",
+            {
+                "fan_out": True,
+                "write_quorum": quorum,
+                "hedge_percentile": hedge_percentile,
+            },
+        ),
+    ]
+    for name, options in modes:
+        group_ids = [f"{name}-{i}" for i in range(n_ids)]
+        for command in ("create", "delete"):
+            before = node_counts(url)
+            start = time.perf_counter()
+            with Pool(
+                processes, initializer=init_worker, initargs=(hosts, options)
+            ) as p:
+                results = p.map(
+                    run_operation,
+                    [(command, group_id) for group_id in group_ids],
+                    chunksize=16,
+                )
+                elapsed = time.perf_counter() - start
+                p.close()
+                p.join()
+            after = node_counts(url)
+            latencies = [latency for latency in results if latency is not None]
+            click.echo(
+                json.dumps(
+                    {
+                        "mode": name,
+                        "command": command,
+                        "operations": n_ids,
+                        "operations_per_second": round(n_ids / elapsed, 1),
+                        "raised": n_ids - len(latencies),
+                        # groups applied to every node
+                        "applied": min(abs(a - b) for a, b in zip(after, before)),
+                        "diverged": len(set(after)) > 1,
+                        "p50_ms": round(percentile(latencies, 0.5), 2),
+                        "p99_ms": round(percentile(latencies, 0.99), 2),
+                    }
+                )
+            )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,314 @@
+"""
+Serving modes of the API at high connection counts: the Flask application under gunicorn
+with the gevent worker (SERVING_MODE "sync", config/gunicorn_conf.py) and the async one
+under uvicorn (SERVING_MODE "async", asgi.py), started the way confs/start.sh starts them.
+
+Every mode gets a copy of the same seeded databases (groupIds seed-0..seed-<rows-1> on every
+node) and a config module overriding config.cluster with them, RANDOM_BEHAVIOR 0 and no slow
+request log. Clients are --connections keep-alive HTTP/1.1 connections of one asyncio process,
+each sending a request of the --mix after the response of the previous one: gets of
+seed-0..seed-<2*rows-1> (half of them exist), creates of new groupIds, deletes of seeded ones
+and stats, to a random node. After --warmup seconds of load, --duration seconds are measured,
+every combination of --mode and --connections is one run reported as one JSON line:
+
+    {"mode", "connections", "rows", "seconds", "requests", "requests_per_second", "errors",
+     "p50_ms", "p95_ms", "p99_ms", "max_ms", "ops": {op: {"requests", "errors", "p50_ms", ...}}}
+
+Errors are responses with a status other than the contract of the endpoint, and requests
+on connections which failed or were closed by the server. The client shares the CPU with
+the server, so numbers of one machine compare the modes, not the capacity of a deployment.
+
+    python3 benchmarks/bench_serving_modes.py --connections 64 --connections 1000
+"""
+
+import asyncio
+import glob
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from typing import Dict, List, Tuple
+
+import click
+from harness import CLUSTER_DIR, latency_summary, load_app, seed
+
+# status codes of the endpoints which are not errors
+EXPECTED_STATUSES = {
+    "create": (201, 400),
+    "delete": (200, 404),
+    "get": (200, 404),
+    "stats": (200,),
+}
+CONFIG = """
+from config.cluster import *
+
+SQLALCHEMY_DATABASE_URI = "sqlite:///{storage}/cluster.db"
+SQLALCHEMY_BINDS = {{node: f"sqlite:///{storage}/{{node}}.db" for node in NODES}}
+RANDOM_BEHAVIOR = 0
+PROFILE_SLOW_REQUEST = None
+"""
+
+
+def server_command(mode: str, port: int) -> List[str]:
+    """Command of confs/start.sh for the mode, bound to the port"""
+    if mode == "sync":
+        return [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "--conf",
+            os.path.join(CLUSTER_DIR, "config", "gunicorn_conf.py"),
+            "--bind",
+            f"127.0.0.1:{port}",
+            "main:app",
+        ]
+    return [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "--app-dir",
+        CLUSTER_DIR,
+        "--host",
+        "127.0.0.1",
+        "--port",
+        str(port),
+        "--timeout-keep-alive",
+        "5",
+        "asgi:app",
+    ]
+
+
+def start_server(mode: str, databases: str, port: int) -> Tuple[subprocess.Popen, str]:
+    """
+    Starts the server of the mode on a copy of the databases, waits until it answers /ping.
+    Returns:
+        process and its directory, with server.log
+    """
+    directory = tempfile.mkdtemp(prefix=f"cluster-{mode}-")
+    for path in glob.glob(os.path.join(databases, "*.db")):
+        shutil.copy(path, directory)
+    with open(os.path.join(directory, "bench_config.py"), "w") as config:
+        config.write(CONFIG.format(storage=directory))
+    env = dict(
+        os.environ,
+        CONFIG_PATH="bench_config",
+        PYTHONPATH=os.pathsep.join([directory, CLUSTER_DIR]),
+    )
+    with open(os.path.join(directory, "server.log"), "w") as log:
+        process = subprocess.Popen(
+            server_command(mode, port),
+            cwd=directory,
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+    for _ in range(300):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/ping", timeout=1)
+            return process, directory
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    process.kill()
+    raise click.ClickException(
+        f"{mode} server didn't start, see {os.path.join(directory, 'server.log')}"
+    )
+
+
+def next_request(
+    rng: random.Random, mix: Dict[str, int], rows: int, nodes: List[str], name: str
+) -> Tuple[str, bytes]:
+    """Operation and HTTP/1.1 request of it"""
+    op = rng.choices(list(mix), weights=list(mix.values()))[0]
+    node = rng.choice(nodes)
+    body = b""
+    if op == "get":
+        head = f"GET /group/seed-{rng.randrange(max(2 * rows, 1))} HTTP/1.1\r\n"
+    elif op == "stats":
+        head = "GET /stats HTTP/1.1\r\n"
+    else:
+        group_id = (
+            f"{name}-{rng.getrandbits(48)}"
+            if op == "create"
+            else f"seed-{rng.randrange(max(rows, 1))}"
+        )
+        body = json.dumps({"groupId": group_id}).encode()
+        method = "POST" if op == "create" else "DELETE"
+        head = f"{method} /group HTTP/1.1\r\n"
+    head += f"Host: bench\r\nnode: {node}\r\nContent-Length: {len(body)}\r\n\r\n"
+    return op, head.encode() + body
+
+
+async def read_response(reader: asyncio.StreamReader) -> Tuple[int, bool]:
+    """Status code of the response and whether the server closes the connection"""
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    close = False
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        name = name.strip().lower()
+        if name == "content-length":
+            length = int(value)
+        elif name == "connection" and "close" in value.lower():
+            close = True
+    await reader.readexactly(length)
+    return status, close
+
+
+async def client(
+    port: int,
+    name: str,
+    mix: Dict[str, int],
+    rows: int,
+    nodes: List[str],
+    measure_from: float,
+    until: float,
+    results: List[Tuple[str, float, bool]],
+):
+    """One connection sending requests until the time is over, reconnects if it is closed"""
+    rng = random.Random(name)
+    writer = None
+    while time.perf_counter() < until:
+        op, data = next_request(rng, mix, rows, nodes, name)
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(data)
+            status, close = await read_response(reader)
+            ok = status in EXPECTED_STATUSES[op]
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+            ok, close = False, True
+        if started >= measure_from:
+            results.append((op, (time.perf_counter() - started) * 1000, ok))
+        if close and writer is not None:
+            writer.close()
+            writer = None
+            if not ok:
+                await asyncio.sleep(0.1)  # don't spin on a refused connection
+    if writer is not None:
+        writer.close()
+
+
+async def load(
+    port: int,
+    connections: int,
+    mix: Dict[str, int],
+    rows: int,
+    nodes: List[str],
+    warmup: float,
+    duration: float,
+) -> List[Tuple[str, float, bool]]:
+    results = []
+    measure_from = time.perf_counter() + warmup
+    until = measure_from + duration
+    await asyncio.gather(
+        *(
+            client(port, f"c{i}", mix, rows, nodes, measure_from, until, results)
+            for i in range(connections)
+        )
+    )
+    return results
+
+
+def summary(results: List[Tuple[str, float, bool]]) -> Dict:
+    return {
+        "requests": len(results),
+        "errors": sum(not ok for _, _, ok in results),
+        **latency_summary([latency for _, latency, _ in results]),
+        # the longest wait shows connections starved by the server
+        "max_ms": round(max((latency for _, latency, _ in results), default=0), 3),
+    }
+
+
+@click.command()
+@click.option(
+    "--mode",
+    "modes",
+    multiple=True,
+    type=click.Choice(["sync", "async"]),
+    default=("sync", "async"),
+    show_default=True,
+)
+@click.option(
+    "--connections",
+    multiple=True,
+    type=int,
+    default=(16, 256, 1000),
+    show_default=True,
+    help="Concurrent keep-alive connections, at most 1000 for the gevent worker",
+)
+@click.option(
+    "--mix",
+    default="get=70,create=15,delete=10,stats=5",
+    show_default=True,
+    help="Weights of the operations",
+)
+@click.option("--rows", default=100000, show_default=True, help="Records per node")
+@click.option("--warmup", default=3.0, show_default=True, help="Seconds")
+@click.option("--duration", default=15.0, show_default=True, help="Seconds")
+@click.option("--port", default=5090, show_default=True)
+@click.option(
+    "--output",
+    type=click.File("a"),
+    default=None,
+    help="Also append results to this JSONL file",
+)
+def run(modes, connections, mix, rows, warmup, duration, port, output):
+    mix = {
+        op: int(weight)
+        for op, weight in (item.split("=") for item in mix.split(","))
+        if int(weight)
+    }
+    if set(mix) - set(EXPECTED_STATUSES):
+        raise click.BadParameter(f"operations are {list(EXPECTED_STATUSES)}")
+    main = load_app()
+    nodes = list(main.hosts)
+    for node in nodes:
+        seed(main, node, rows)
+    with main.app.app_context():
+        for node in [None, *nodes]:
+            main.db.get_engine(main.app, bind=node).dispose()  # checkpoints the WAL
+    databases = os.path.dirname(
+        main.app.config["SQLALCHEMY_DATABASE_URI"][len("sqlite:///") :]
+    )
+    for n_connections in connections:
+        for mode in modes:
+            process, directory = start_server(mode, databases, port)
+            try:
+                started = time.perf_counter()
+                results = asyncio.run(
+                    load(port, n_connections, mix, rows, nodes, warmup, duration)
+                )
+                seconds = time.perf_counter() - started - warmup
+            finally:
+                process.terminate()
+                process.wait()
+            shutil.rmtree(directory, ignore_errors=True)
+            result = {
+                "mode": mode,
+                "connections": n_connections,
+                "rows": rows,
+                "seconds": round(seconds, 2),
+                **summary(results),
+                "ops": {op: summary([r for r in results if r[0] == op]) for op in mix},
+            }
+            result["requests_per_second"] = round(result["requests"] / seconds, 1)
+            line = json.dumps(result)
+            click.echo(line)
+            if output:
+                output.write(line + "\n")
+                output.flush()
+
+
+if __name__ == "__main__":
+    run()
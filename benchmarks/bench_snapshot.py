@@ -0,0 +1,92 @@
+"""
+Bootstrapping an empty node from a seeded one: binary snapshot (GET /snapshot) written
+to a file and restored from it (PUT /snapshot), snapshot piped from node to node
+(Connector.copy_node), and, as the baseline, the listing of the node (GET /groups)
+replayed into the empty node by batch creates (POST /groups) of GROUP_BATCH_LIMIT groupIds.
+Server and client run in this process, so times include both sides.
+
+    python3 benchmarks/bench_snapshot.py --rows 100000 --rows 1000000
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+import click
+from harness import clear, load_app, seed, serve
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+)
+from connector import Connector, create_node_groups  # noqa: E402
+
+
+def replay(connector: Connector, source: str, target: str, batch: int) -> int:
+    """Creates groups of source node in target node by batches, returns their number"""
+    host = connector.hosts[target]
+    session = connector.session(host)
+    group_ids = []
+    count = 0
+    for record in connector.node_groups(source):
+        group_ids.append(record["groupId"])
+        if len(group_ids) == batch:
+            create_node_groups(
+                group_ids, host, target, time.time(), session
+            ).raise_for_status()
+            count += len(group_ids)
+            group_ids = []
+    if group_ids:
+        create_node_groups(
+            group_ids, host, target, time.time(), session
+        ).raise_for_status()
+        count += len(group_ids)
+    return count
+
+
+@click.command()
+@click.option(
+    "--rows", multiple=True, type=int, default=(100000, 1000000), show_default=True
+)
+@click.option("--skip-replay", is_flag=True, help="Don't run the baseline")
+def run(rows, skip_replay):
+    main = load_app(nodes=4)
+    url = serve(main)
+    connector = Connector({node: url for node in main.hosts}, timeout=(3.05, 600))
+    source, restored, copied, replayed = main.hosts
+    batch = main.app.config["GROUP_BATCH_LIMIT"]
+    for n_rows in rows:
+        clear(main, source)
+        seed(main, source, n_rows)
+        with tempfile.TemporaryFile() as file:
+            start = time.perf_counter()
+            size = connector.save_snapshot(source, file)
+            snapshot_seconds = time.perf_counter() - start
+            file.seek(0)
+            start = time.perf_counter()
+            result = connector.restore_snapshot(restored, file)
+            restore_seconds = time.perf_counter() - start
+        assert result["inserted"] == n_rows, result
+        start = time.perf_counter()
+        result = connector.copy_node(source, copied)
+        copy_seconds = time.perf_counter() - start
+        assert result["inserted"] == n_rows, result
+        report = {
+            "rows": n_rows,
+            "snapshot_mb": round(size / 2**20, 1),
+            "snapshot_seconds": round(snapshot_seconds, 2),
+            "restore_seconds": round(restore_seconds, 2),
+            "copy_seconds": round(copy_seconds, 2),
+        }
+        if not skip_replay:
+            clear(main, replayed)
+            start = time.perf_counter()
+            count = replay(connector, source, replayed, batch)
+            report["replay_seconds"] = round(time.perf_counter() - start, 2)
+            assert count == n_rows, count
+        click.echo(json.dumps(report))
+
+
+if __name__ == "__main__":
+    run()
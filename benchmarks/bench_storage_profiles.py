@@ -0,0 +1,120 @@
+"""
+Throughput of mixed GET/POST/DELETE /group workload with different SQLite storage profiles.
+Every profile runs in its own process, because the engine and its pool are created once.
+Clients are processes with keep-alive sessions, each operation picks random groupId
+of the key space, half of which is seeded before the run.
+
+    python3 benchmarks/bench_storage_profiles.py --clients 16 --operations 6000
+"""
+
+import json
+import random
+import subprocess
+import sys
+import time
+from multiprocessing import Pool
+
+import click
+import requests
+from harness import load_app, percentile, seed, serve
+
+PROFILES = {
+    # SQLite defaults: rollback journal, synchronous FULL, no busy timeout, new connection per request
+    "legacy": {"SQLITE_PRAGMAS": {}, "SQLALCHEMY_ENGINE_OPTIONS": {}},
+    # WAL with synchronous FULL, pooled connections
+    "wal-full": {"SQLITE_PRAGMAS": {"journal_mode": "WAL", "busy_timeout": 5000}},
+    # config.cluster profile: WAL, synchronous NORMAL, mmap, cache, pooled connections
+    "tuned": {},
+}
+
+
+def run_client(args):
+    url, key_space, n_operations, seed_value = args
+    rnd = random.Random(seed_value)
+    session = requests.Session()
+    headers = {"node": "node01"}
+    latencies = []
+    errors = 0
+    for _ in range(n_operations):
+        group_id = f"seed-{rnd.randrange(key_space)}"
+        roll = rnd.random()
+        start = time.perf_counter()
+        if roll < 0.6:
+            resp = session.get(f"{url}/group/{group_id}", headers=headers)
+        elif roll < 0.8:
+            resp = session.post(
+                f"{url}/group", data=json.dumps({"groupId": group_id}), headers=headers
+            )
+        else:
+            resp = session.delete(
+                f"{url}/group", data=json.dumps({"groupId": group_id}), headers=headers
+            )
+        latencies.append((time.perf_counter() - start) * 1000)
+        errors += resp.status_code >= 500
+    return latencies, errors
+
+
+def run_profile(profile, clients, operations, key_space, coalescing):
+    main = load_app(WRITE_COALESCING=coalescing, **PROFILES[profile])
+    seed(main, "node01", key_space // 2)
+    url = serve(main)
+    start = time.perf_counter()
+    with Pool(clients) as p:
+        results = p.map(
+            run_client,
+            [(url, key_space, operations // clients, i) for i in range(clients)],
+        )
+    elapsed = time.perf_counter() - start
+    latencies = [latency for client, _ in results for latency in client]
+    click.echo(
+        json.dumps(
+            {
+                "profile": profile,
+                "coalescing": coalescing,
+                "clients": clients,
+                "operations": len(latencies),
+                "operations_per_second": round(len(latencies) / elapsed, 1),
+                "errors": sum(errors for _, errors in results),
+                "p50_ms": round(percentile(latencies, 0.5), 2),
+                "p99_ms": round(percentile(latencies, 0.99), 2),
+            }
+        )
+    )
+
+
+@click.command()
+@click.option("--profile", type=click.Choice(list(PROFILES)), default=None)
+@click.option("--clients", default=16, show_default=True)
+@click.option("--operations", default=6000, show_default=True)
+@click.option("--key-space", default=20000, show_default=True)
+@click.option(
+    "--coalescing/--no-coalescing",
+    default=True,
+    show_default=True,
+    help="WRITE_COALESCING, without it every write waits for the database lock on its own",
+)
+def run(profile, clients, operations, key_space, coalescing):
+    if profile:
+        run_profile(profile, clients, operations, key_space, coalescing)
+        return
+    for profile in PROFILES:
+        subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--profile",
+                profile,
+                "--clients",
+                str(clients),
+                "--operations",
+                str(operations),
+                "--key-space",
+                str(key_space),
+                "--coalescing" if coalescing else "--no-coalescing",
+            ],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    run()
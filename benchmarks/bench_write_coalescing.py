@@ -0,0 +1,80 @@
+"""
+Write throughput of POST /group with and without group commit (WRITE_COALESCING),
+at several numbers of concurrent clients. Every client is a process with its own
+keep-alive session, sending creates of unique groupIds one after another.
+
+    python3 benchmarks/bench_write_coalescing.py --writes 4000 --clients 16 --clients 64
+"""
+
+import json
+import time
+from multiprocessing import Pool
+from typing import List
+
+import click
+import requests
+from harness import load_app, serve
+
+
+def create_groups(args) -> int:
+    """Returns number of failed creates, e.g. 500 for "database is locked" errors"""
+    url, group_ids = args
+    session = requests.Session()
+    failed = 0
+    for group_id in group_ids:
+        resp = session.post(
+            f"{url}/group",
+            data=json.dumps({"groupId": group_id}),
+            headers={"node": "node01"},
+        )
+        failed += resp.status_code != 201
+    return failed
+
+
+def split(items: List[str], parts: int) -> List[List[str]]:
+    return [items[i::parts] for i in range(parts)]
+
+
+@click.command()
+@click.option("--writes", default=4000, show_default=True)
+@click.option("--clients", multiple=True, type=int, default=(16, 64), show_default=True)
+def run(writes, clients):
+    main = load_app()
+    url = serve(main)
+    for n_clients in clients:
+        for coalescing in (False, True):
+            main.app.config["WRITE_COALESCING"] = coalescing
+            coalescer = main.coalescers["node01"]
+            batches, applied = coalescer.batches, coalescer.writes
+            group_ids = [f"{n_clients}-{coalescing}-{i}" for i in range(writes)]
+            start = time.perf_counter()
+            with Pool(n_clients) as p:
+                failed = sum(
+                    p.map(
+                        create_groups,
+                        [(url, ids) for ids in split(group_ids, n_clients)],
+                    )
+                )
+            elapsed = time.perf_counter() - start
+            batches = coalescer.batches - batches
+            click.echo(
+                json.dumps(
+                    {
+                        "clients": n_clients,
+                        "coalescing": coalescing,
+                        "writes": writes,
+                        "seconds": round(elapsed, 2),
+                        "writes_per_second": round((writes - failed) / elapsed, 1),
+                        "failed": failed,
+                        "mean_batch": (
+                            round((coalescer.writes - applied) / batches, 1)
+                            if batches
+                            else None
+                        ),
+                    }
+                )
+            )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,137 @@
+"""
+Helpers shared by benchmark scripts.
+
+Benchmarks import the cluster Flask application in process, bound to SQLite files
+in a temporary directory, so they never touch databases of the storage directory.
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+CLUSTER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cluster")
+
+
+def load_app(
+    random_behavior: float = 0,
+    shared_storage: bool = False,
+    nodes: Optional[int] = None,
+    faults: Optional[dict] = None,
+    **config,
+):
+    """
+    Imports cluster application with temporary databases, one per node.
+    Args:
+        random_behavior: value of RANDOM_BEHAVIOR config parameter
+        shared_storage: all nodes are kept in one database file, as before per node databases
+        nodes: number of nodes (NODE_COUNT), works only before the application is imported
+        faults: fault profile (faults.py), RANDOM_BEHAVIOR errors if not given
+        config: any other config parameters to override
+    Returns:
+        main module of the cluster application
+    """
+    os.environ.setdefault("CONFIG_PATH", "config.cluster")
+    if nodes:
+        os.environ["NODE_COUNT"] = str(nodes)
+    if CLUSTER_DIR not in sys.path:
+        sys.path.insert(0, CLUSTER_DIR)
+    import main
+
+    logging.disable(logging.CRITICAL)  # error handler logs every 404/400 with traceback
+    storage = tempfile.mkdtemp(prefix="cluster-bench-")
+    main.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(
+        storage, "cluster.db"
+    )
+    main.app.config["SQLALCHEMY_BINDS"] = {
+        node: (
+            main.app.config["SQLALCHEMY_DATABASE_URI"]
+            if shared_storage
+            else "sqlite:///" + os.path.join(storage, f"{node}.db")
+        )
+        for node in main.hosts
+    }
+    main.app.config["RANDOM_BEHAVIOR"] = random_behavior
+    main.faults.configure(faults or main.random_behavior_profile(random_behavior))
+    main.app.config.update(config)
+    with main.app.app_context():
+        main.create_all()
+    return main
+
+
+def serve(main, port: int = 0) -> str:
+    """
+    Serves cluster application over HTTP/1.1 (keep-alive) from a background thread.
+    Returns:
+        base url of the server
+    """
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    server = make_server("127.0.0.1", port, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def seed(main, node: str, n_rows: int, chunk: int = 50000):
+    """
+    Bulk inserts n_rows group records with groupIds "seed-0".."seed-<n_rows-1>" into node table,
+    with their buckets, as snapshot restore does, and recounts node statistics and the existence cache
+    """
+    Group = main.hosts[node]
+    with main.app.app_context():
+        for start in range(0, n_rows, chunk):
+            main.db.session.execute(
+                Group.__table__.insert(),
+                [
+                    {
+                        "groupId": f"seed-{i}",
+                        "timestamp": float(i),
+                        "bucket": main.group_bucket(f"seed-{i}"),
+                    }
+                    for i in range(start, min(start + chunk, n_rows))
+                ],
+            )
+        main.recount_node_stats(node)
+        main.db.session.commit()
+        main.rebuild_existence_cache(node)
+
+
+def clear(main, node: str):
+    """Deletes all group records of the node and recounts its statistics and the existence cache"""
+    with main.app.app_context():
+        main.db.session.query(main.hosts[node]).delete()
+        main.recount_node_stats(node)
+        main.db.session.commit()
+        main.rebuild_existence_cache(node)
+
+
+def percentile(samples: List[float], p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def measure(func: Callable[[int], None], n: int) -> Dict[str, float]:
+    """
+    Calls func(i) n times and returns latency summary in milliseconds
+    """
+    samples = []
+    for i in range(n):
+        start = time.perf_counter()
+        func(i)
+        samples.append((time.perf_counter() - start) * 1000)
+    return latency_summary(samples)
+
+
+def latency_summary(samples: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p95/p99 of latencies in milliseconds, None without samples"""
+    if not samples:
+        return dict.fromkeys(("p50_ms", "p95_ms", "p99_ms"))
+    return {
+        "p50_ms": round(percentile(samples, 0.5), 3),
+        "p95_ms": round(percentile(samples, 0.95), 3),
+        "p99_ms": round(percentile(samples, 0.99), 3),
+    }
@@ -0,0 +1,748 @@
+"""
+Async entry point of the cluster API, served by uvicorn instead of gunicorn with the gevent
+worker when SERVING_MODE config parameter is "async" (confs/start.sh):
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+
+It serves /ping, /stats, /group, /groups (POST and DELETE) and /groups/exists with the contract
+of the Flask application (main.py): node and timestamp headers, Idempotency-Key, status codes,
+bodies and JSON errors are the same, validation and idempotency keys are implemented once
+for both (writes.py), and the fault profile of the config (FAULTS, RANDOM_BEHAVIOR) is applied
+to /group and /groups.
+Nothing is monkey-patched: the event loop awaits the databases through SQLAlchemy asyncio
+extension over aiosqlite, one AsyncEngine per node database, and the schema is created once
+at startup, before the first request is accepted.
+
+Concurrent writes of a node are committed in shared transactions by AsyncWriteCoalescer
+(coalescer.py), which applies one batch of the node at a time, so writes wait in the event loop
+instead of in SQLite busy handler of driver threads. Batch writes of /groups are applied
+in their own transaction, like in the Flask application. Existence cache, metrics, profiling,
+listing, hash tree and snapshot endpoints are served by the Flask application only, as well as migration of
+the shared database of older deployments, start it once to migrate.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from importlib import import_module
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from coalescer import AsyncWriteCoalescer
+from faults import DRAIN_CHUNK, Fault, FaultInjector, random_behavior_profile
+from models.models import (
+    IdempotencyKey,
+    NodeBucket,
+    NodeStats,
+    group_bucket,
+    node_models,
+    recount_statements,
+    stats_statements,
+    write_digest,
+)
+from sqlalchemy import Table, bindparam, delete, event, inspect, select, text
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.engine import Connection, make_url
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.exceptions import (
+    BadRequest,
+    HTTPException,
+    InternalServerError,
+    NotFound,
+    UnprocessableEntity,
+    default_exceptions,
+)
+from writes import (
+    BATCH_STATUSES,
+    batch_group_ids,
+    checked_idempotency_key,
+    chunks,
+    claim_key,
+    expired_keys,
+    group_body,
+    node_model,
+    replayed_result,
+    store_result,
+    stored_key,
+)
+
+logging.basicConfig(
+    format="%(asctime)s : %(levelname)s : %(message)s", level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel("INFO")
+
+# Config module of the Flask application, upper case attributes are the parameters
+config = {
+    name: value
+    for name, value in vars(import_module(os.environ["CONFIG_PATH"])).items()
+    if name.isupper()
+}
+
+hosts = node_models(config["NODES"])
+# Faults injected into /group requests, the same profile as of the Flask application
+faults = FaultInjector(
+    config.get("FAULTS") or random_behavior_profile(config.get("RANDOM_BEHAVIOR", 0.5))
+)
+
+
+def create_engine(node: str) -> AsyncEngine:
+    """
+    AsyncEngine of the node database of SQLALCHEMY_BINDS, pooled like the engines
+    of the Flask application (SQLALCHEMY_ENGINE_OPTIONS), with SQLITE_PRAGMAS applied
+    to every new connection
+    """
+    url = make_url(config["SQLALCHEMY_BINDS"][node]).set(drivername="sqlite+aiosqlite")
+    options = dict(config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+    options["poolclass"] = AsyncAdaptedQueuePool
+    engine = create_async_engine(url, **options)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in config.get("SQLITE_PRAGMAS", {}).items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return engine
+
+
+engines = {node: create_engine(node) for node in hosts}
+
+
+def create_node_schema(connection: Connection, node: str):
+    """
+    Creates tables and indexes of models.py in the node database, the same as create_all
+    of the Flask application: bucket column and indexes are created separately, for
+    databases created before they were introduced, and missing statistics are recounted.
+    """
+    Group = hosts[node]
+    table = Group.__table__
+    for Model in (Group, NodeStats, NodeBucket, IdempotencyKey):
+        Model.__table__.create(connection, checkfirst=True)
+    columns = {c["name"] for c in inspect(connection).get_columns(table.name)}
+    if "bucket" not in columns:
+        connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN bucket INTEGER"))
+    for index in table.indexes:
+        index.create(connection, checkfirst=True)
+    fill_bucket_column(connection, table)
+    stats = connection.execute(
+        select(NodeStats.node).where(NodeStats.node == node)
+    ).first()
+    if stats is None:
+        recount_node_stats(connection, node)
+
+
+def fill_bucket_column(connection: Connection, table: Table, chunk: int = 10000):
+    """
+    Computes bucket of the records which miss it, chunk by chunk, the same as
+    fill_bucket_column of the Flask application
+    """
+    while True:
+        rows = connection.execute(
+            select(table.c.id, table.c.groupId)
+            .where(table.c.bucket.is_(None))
+            .limit(chunk)
+        ).all()
+        if not rows:
+            break
+        connection.execute(
+            table.update()
+            .where(table.c.id == bindparam("_id"))
+            .values(bucket=bindparam("_bucket")),
+            [{"_id": id, "_bucket": group_bucket(group_id)} for id, group_id in rows],
+        )
+
+
+def recount_node_stats(connection: Connection, node: str) -> NodeStats:
+    """Recounts statistics of the node from its table, groupIds are streamed by the cursor"""
+    stats, statements = recount_statements(
+        node,
+        (
+            group_id
+            for (group_id,) in connection.exec_driver_sql(
+                f'SELECT "groupId" FROM {hosts[node].__tablename__}'
+            )
+        ),
+    )
+    for statement, parameters in statements:
+        connection.execute(statement, parameters)
+    return stats
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    """Schema of every node is created once, before the server accepts requests"""
+    for node in hosts:
+        async with engines[node].begin() as connection:
+            await connection.run_sync(create_node_schema, node)
+    logger.info("System started...")
+    yield
+    for engine in engines.values():
+        await engine.dispose()
+
+
+def text_response(body: str, status: int) -> Response:
+    """Response of str returned by a Flask view, which is text/html"""
+    return Response(body, status, media_type="text/html")
+
+
+def json_response(body: Any, status: int) -> Response:
+    """Response of dict returned by a Flask view, compact JSON with sorted keys"""
+    return Response(
+        json.dumps(body, separators=(",", ":"), sort_keys=True) + "\n",
+        status,
+        media_type="application/json",
+    )
+
+
+def error_response(e: HTTPException) -> Response:
+    """JSON of the error, the same as handle_exception of the Flask application"""
+    logger.exception(e)
+    return Response(
+        json.dumps({"message": e.description, "status": e.code}),
+        e.code,
+        media_type="application/json",
+    )
+
+
+async def inject_faults(request: Request, endpoint: str):
+    """
+    Unstable connection imitation, see inject_faults of the Flask application,
+    endpoint is the name of the view in the Flask application, matched by fault rules.
+    Delay is awaited and errors are raised here, partial failure and slow drain
+    are applied to the response by apply_response_faults
+    """
+    node = request.headers.get("node") or ""
+    fault = faults.decide(node, request.method, endpoint)
+    if fault is None:
+        return
+    if fault.delay:
+        await asyncio.sleep(fault.delay)
+    if fault.status is not None:
+        error = default_exceptions.get(fault.status, InternalServerError)
+        raise error(f"{error.__name__} due to Random Behavior")
+    request.state.fault = fault
+
+
+def apply_response_faults(fault: Fault, response: Response) -> Response:
+    if fault.partial and response.status_code < 400:
+        response = error_response(
+            InternalServerError(
+                "InternalServerError due to Random Behavior, the request was applied"
+            )
+        )
+    if fault.drain:
+        body = response.body
+        bytes_per_second = fault.drain
+
+        async def drain():
+            for i in range(0, len(body), DRAIN_CHUNK):
+                piece = body[i : i + DRAIN_CHUNK]
+                await asyncio.sleep(len(piece) / bytes_per_second)
+                yield piece
+
+        response = StreamingResponse(
+            drain(), response.status_code, media_type=response.media_type
+        )
+    return response
+
+
+def endpoint(
+    view: Callable[[Request], Awaitable[Response]],
+) -> Callable[[Request], Awaitable[Response]]:
+    """Errors of the view are returned as JSON, faults of the request are applied"""
+
+    async def handle(request: Request) -> Response:
+        try:
+            response = await view(request)
+        except HTTPException as e:
+            response = error_response(e)
+        except Exception as e:
+            logger.exception(e)
+            response = error_response(InternalServerError(original_exception=e))
+        fault = getattr(request.state, "fault", None)
+        if fault is not None:
+            response = apply_response_faults(fault, response)
+        return response
+
+    return handle
+
+
+async def json_body(request: Request) -> Any:
+    """
+    Body of the request parsed as json, like get_json(force=True) of Flask
+    Exceptions:
+        BadRequest:
+            Raises exception if body is not json
+    """
+    try:
+        return json.loads(await request.body())
+    except ValueError:
+        raise BadRequest()
+
+
+async def parse_body(request: Request) -> Any:
+    """Parses body of POST and DELETE of /group endpoint, see group_body"""
+    return group_body(await json_body(request))
+
+
+async def parse_batch_body(request: Request) -> List[str]:
+    """groupIds of the body of /groups and /groups/exists endpoints, see batch_group_ids"""
+    return batch_group_ids(
+        await json_body(request), config.get("GROUP_BATCH_LIMIT", 1000)
+    )
+
+
+def get_node_model(node: Optional[str]):
+    """Group Model of the node, see node_model"""
+    return node_model(hosts, node)
+
+
+def idempotency_key(request: Request) -> Optional[str]:
+    """Idempotency-Key header of the write request, see checked_idempotency_key"""
+    return checked_idempotency_key(request.headers.get("Idempotency-Key"))
+
+
+async def idempotent_write(
+    connection: AsyncConnection,
+    node: str,
+    key: Optional[str],
+    digest: str,
+    write: Callable[[], Awaitable[Any]],
+) -> Tuple[Any, bool]:
+    """
+    Awaits write() in the transaction of the connection once per Idempotency-Key of the node,
+    see idempotent_write of the Flask application, keys are shared by both entry points.
+    Returns:
+        (result of write(), False) or (stored result, True) if the key was used before
+    Exceptions:
+        UnprocessableEntity:
+            Raises exception if the key was used by a different write
+    """
+    if key is None:
+        return await write(), False
+    claimed = await connection.execute(claim_key(node, key, digest))
+    if not claimed.rowcount:
+        stored = (await connection.execute(stored_key(node, key))).one()
+        return replayed_result(stored, key, digest), True
+    result = await write()
+    await connection.execute(store_result(node, key, result))
+    return result, False
+
+
+async def expire_idempotency_keys(node: str):
+    """
+    Removes idempotency keys of the node older than IDEMPOTENCY_KEY_TTL seconds,
+    at most once per IDEMPOTENCY_KEY_EXPIRE_INTERVAL seconds, in its own transaction
+    (see expired_keys)
+    """
+    statement = expired_keys(node, config)
+    if statement is None:
+        return
+    async with engines[node].begin() as connection:
+        await connection.execute(statement)
+
+
+async def insert_group(
+    connection: AsyncConnection, table: Table, group_id: str, timestamp: Optional[float]
+) -> bool:
+    """
+    Inserts group record by INSERT ... ON CONFLICT (groupId) DO NOTHING.
+    Returns False if the record exists
+    """
+    values = {"groupId": group_id}
+    if timestamp:
+        values["timestamp"] = timestamp
+    result = await connection.execute(
+        insert(table)
+        .values(**values)
+        .on_conflict_do_nothing(index_elements=["groupId"])
+    )
+    return bool(result.rowcount)
+
+
+async def remove_group(
+    connection: AsyncConnection, table: Table, group_id: str, timestamp: Optional[float]
+) -> bool:
+    """
+    Deletes group record by groupId, and by timestamp if it is given.
+    Returns False if no record was found
+    """
+    statement = delete(table).where(table.c.groupId == group_id)
+    if timestamp:
+        statement = statement.where(table.c.timestamp == timestamp)
+    deleted = (await connection.execute(statement)).rowcount
+    if deleted and timestamp:
+        logger.info("Deleted group %s %s", timestamp, group_id)
+    return bool(deleted)
+
+
+# INSERT and DELETE return rows since SQLite 3.35, runs of writes are applied by one statement each
+RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+Write = Tuple[str, str, str, Optional[float], Optional[str]]
+
+
+def write_runs(writes: List[Write]) -> List[List[Write]]:
+    """
+    Splits writes into runs applied by one INSERT and one DELETE: consecutive writes without
+    idempotency key and with distinct groupIds, which don't depend on each other, so the result
+    of every write is the same as of applying them one by one. A write with idempotency key
+    is a run of its own
+    """
+    runs: List[List[Write]] = []
+    group_ids = set()
+    for write in writes:
+        _, _, group_id, _, key = write
+        run = runs[-1] if runs else None
+        if (
+            RETURNING
+            and run is not None
+            and key is None
+            and run[0][4] is None
+            and group_id not in group_ids
+        ):
+            run.append(write)
+        else:
+            runs.append([write])
+            group_ids = set()
+        group_ids.add(group_id)
+    return runs
+
+
+async def insert_groups(
+    connection: AsyncConnection, table: Table, writes: List[Write]
+) -> Set[str]:
+    """
+    Inserts group records of the writes by one INSERT ... ON CONFLICT (groupId) DO NOTHING.
+    Returns groupIds of the inserted records
+    """
+    rows = []
+    parameters = {}
+    for i, (_, _, group_id, timestamp, _) in enumerate(writes):
+        rows.append(f"(:group_id{i}, :timestamp{i}, :bucket{i})")
+        parameters[f"group_id{i}"] = group_id
+        parameters[f"timestamp{i}"] = timestamp or time.time()
+        parameters[f"bucket{i}"] = group_bucket(group_id)
+    result = await connection.execute(
+        text(
+            f'INSERT INTO "{table.name}" ("groupId", timestamp, bucket) '
+            f"VALUES {', '.join(rows)} "
+            'ON CONFLICT ("groupId") DO NOTHING RETURNING "groupId"'
+        ),
+        parameters,
+    )
+    return {group_id for (group_id,) in result}
+
+
+async def remove_groups(
+    connection: AsyncConnection, table: Table, writes: List[Write]
+) -> Set[str]:
+    """
+    Deletes group records of the writes by one DELETE, by groupId, and by timestamp
+    if it is given. Returns groupIds of the deleted records
+    """
+    conditions = []
+    parameters = {}
+    for i, (_, _, group_id, timestamp, _) in enumerate(writes):
+        parameters[f"group_id{i}"] = group_id
+        if timestamp:
+            conditions.append(
+                f'("groupId" = :group_id{i} AND timestamp = :timestamp{i})'
+            )
+            parameters[f"timestamp{i}"] = timestamp
+        else:
+            conditions.append(f'"groupId" = :group_id{i}')
+    result = await connection.execute(
+        text(
+            f'DELETE FROM "{table.name}" WHERE {" OR ".join(conditions)} '
+            'RETURNING "groupId"'
+        ),
+        parameters,
+    )
+    deleted = {group_id for (group_id,) in result}
+    for _, _, group_id, timestamp, _ in writes:
+        if timestamp and group_id in deleted:
+            logger.info("Deleted group %s %s", timestamp, group_id)
+    return deleted
+
+
+async def apply_writes(writes: List[Write]) -> List[Any]:
+    """
+    Applies writes ("create"/"delete", node, groupId, timestamp, idempotency key) of one node
+    in order, in one transaction, runs of write_runs by one INSERT and one DELETE, statistics
+    of the node are updated once per batch.
+    Returns list of results of insert_group/remove_group, replayed for known idempotency keys,
+    UnprocessableEntity for keys used by a different write
+    """
+    node = writes[0][1]
+    table = hosts[node].__table__
+    changes = {"create": [], "delete": []}
+    results = []
+    async with engines[node].begin() as connection:
+        for run in write_runs(writes):
+            action, _, group_id, timestamp, key = run[0]
+            if len(run) > 1:
+                done = set()
+                for run_action, apply_run in (
+                    ("create", insert_groups),
+                    ("delete", remove_groups),
+                ):
+                    part = [write for write in run if write[0] == run_action]
+                    if part:
+                        done |= await apply_run(connection, table, part)
+                for run_action, _, group_id, _, _ in run:
+                    if group_id in done:
+                        changes[run_action].append(group_id)
+                    results.append(group_id in done)
+                continue
+            apply = insert_group if action == "create" else remove_group
+            try:
+                done, replayed = await idempotent_write(
+                    connection,
+                    node,
+                    key,
+                    write_digest(action, [group_id], timestamp),
+                    lambda: apply(connection, table, group_id, timestamp),
+                )
+            except UnprocessableEntity as e:
+                results.append(e)
+                continue
+            if done and not replayed:
+                changes[action].append(group_id)
+            results.append(done)
+        for action, sign in (("create", 1), ("delete", -1)):
+            if changes[action]:
+                for statement, parameters in stats_statements(
+                    node, changes[action], sign
+                ):
+                    await connection.execute(statement, parameters)
+    return results
+
+
+# Every node has its own database, so writes of different nodes are coalesced
+# and committed independently of each other
+coalescers = {
+    node: AsyncWriteCoalescer(
+        apply_writes,
+        window=config.get("WRITE_COALESCE_WINDOW", 0.0),
+        max_batch=config.get("WRITE_COALESCE_MAX_BATCH", 128),
+    )
+    for node in hosts
+}
+
+
+async def write_group(
+    action: str,
+    node: str,
+    group_id: str,
+    timestamp: Optional[float],
+    key: Optional[str],
+) -> bool:
+    """
+    Applies create/delete write of /group endpoint, see write_group of the Flask application.
+    With WRITE_COALESCING concurrent writes of the node are applied by AsyncWriteCoalescer
+    in shared transactions (group commit), otherwise every write is committed on its own.
+    """
+    write = (action, node, group_id, timestamp, key)
+    if config.get("WRITE_COALESCING", True):
+        result = await coalescers[node].submit(write)
+    else:
+        result = (await apply_writes([write]))[0]
+    await expire_idempotency_keys(node)
+    if isinstance(result, HTTPException):
+        raise result
+    return result
+
+
+async def ping(request: Request) -> Response:
+    return text_response("PONG\n", 200)
+
+
+@endpoint
+async def statistics(request: Request) -> Response:
+    """
+    Statistics of the nodes, see statistics of the Flask application.
+    Node databases are read concurrently, with full=1 query parameter counters
+    are recounted from node tables and repaired.
+    """
+    full = request.query_params.get("full") in ("1", "true")
+
+    async def node_stats(node: str) -> NodeStats:
+        if full:
+            async with engines[node].begin() as connection:
+                return await connection.run_sync(recount_node_stats, node)
+        async with engines[node].connect() as connection:
+            row = (
+                await connection.execute(
+                    select(NodeStats).where(NodeStats.node == node)
+                )
+            ).one()
+        return NodeStats(**row._mapping)
+
+    stats = await asyncio.gather(*(node_stats(node) for node in hosts))
+    return text_response(
+        json.dumps(
+            [
+                len({(s.count, s.digest) for s in stats}) == 1,
+                {s.node: s.count for s in sorted(stats, key=lambda s: s.node)},
+            ]
+        ),
+        200,
+    )
+
+
+@endpoint
+async def group(request: Request) -> Response:
+    """
+    /group endpoint of the Flask application: GET, POST and DELETE of one group record
+    by groupId, of the node given by node header, DELETE qualified by timestamp header
+    """
+    await inject_faults(request, "group")  # Unstable connection imitation
+    node = request.headers.get("node")
+    timestamp = request.headers.get("timestamp")
+    if timestamp:
+        timestamp = float(timestamp)
+    Group = get_node_model(node)
+
+    if request.method == "GET":
+        group_id = request.path_params["groupId"]
+        table = Group.__table__
+        async with engines[node].connect() as connection:
+            found = (
+                await connection.execute(
+                    select(table.c.id).where(table.c.groupId == group_id)
+                )
+            ).first()
+        if found is None:
+            raise NotFound(f"No group record found with id '{group_id}'")
+        return json_response({"groupId": group_id}, 200)
+
+    body = await parse_body(request)
+    group_id = body["groupId"]
+    key = idempotency_key(request)
+    if request.method == "DELETE":
+        if await write_group("delete", node, group_id, timestamp, key):
+            return text_response("OK\n", 200)
+        if timestamp:
+            raise NotFound(
+                f"No group record found with id '{group_id}' and timestamp '{timestamp}'"
+            )
+        raise NotFound(f"No group record found with id '{group_id}'")
+
+    if not await write_group("create", node, group_id, timestamp, key):
+        raise BadRequest("Perhaps the object exists.")
+    return text_response("CREATED\n", 201)
+
+
+async def write_groups(
+    connection: AsyncConnection,
+    action: str,
+    node: str,
+    group_ids: List[str],
+    timestamp: Optional[float],
+) -> Dict[str, int]:
+    """
+    POST ("create") or DELETE ("delete") method of /groups endpoint in the transaction
+    of the connection, see create_groups and delete_groups of the Flask application:
+    every groupId is written by insert_group/remove_group, only written ones are counted
+    """
+    table = hosts[node].__table__
+    apply = insert_group if action == "create" else remove_group
+    written_status, kept_status = BATCH_STATUSES[action]
+    statuses: Dict[str, int] = {}
+    written = []
+    for group_id in group_ids:
+        if await apply(connection, table, group_id, timestamp):
+            statuses[group_id] = written_status
+            written.append(group_id)
+        else:
+            statuses[group_id] = kept_status
+    if written:
+        for statement, parameters in stats_statements(
+            node, written, 1 if action == "create" else -1
+        ):
+            await connection.execute(statement, parameters)
+    return statuses
+
+
+@endpoint
+async def groups(request: Request) -> Response:
+    """
+    /groups endpoint of the Flask application: POST creates and DELETE deletes
+    the groupIds of the body ({"groupIds": [...]}) in one transaction, response is a map
+    of per groupId statuses. With Idempotency-Key the batch is applied once per key and node
+    """
+    await inject_faults(request, "groups")  # Unstable connection imitation
+    node = request.headers.get("node")
+    get_node_model(node)
+    timestamp = request.headers.get("timestamp")
+    if timestamp:
+        timestamp = float(timestamp)
+    group_ids = await parse_batch_body(request)
+    key = idempotency_key(request)
+    action = "create" if request.method == "POST" else "delete"
+    async with engines[node].begin() as connection:
+        statuses, _ = await idempotent_write(
+            connection,
+            node,
+            key,
+            # the same digest as of the Flask application, keys are shared
+            write_digest(f"{action}_groups", group_ids, timestamp),
+            lambda: write_groups(connection, action, node, group_ids, timestamp),
+        )
+    await expire_idempotency_keys(node)
+    return json_response(statuses, 200)
+
+
+@endpoint
+async def groups_exist(request: Request) -> Response:
+    """
+    /groups/exists endpoint of the Flask application: existence of the groupIds of the body
+    in the node, checked by indexed groupId IN (...) queries, 200 exists, 404 not found
+    """
+    await inject_faults(request, "groups_exist")  # Unstable connection imitation
+    node = request.headers.get("node")
+    table = get_node_model(node).__table__
+    group_ids = await parse_batch_body(request)
+    existing = set()
+    async with engines[node].connect() as connection:
+        for chunk in chunks(group_ids):
+            result = await connection.execute(
+                select(table.c.groupId).where(table.c.groupId.in_(chunk))
+            )
+            existing.update(group_id for (group_id,) in result)
+    return json_response(
+        {group_id: 200 if group_id in existing else 404 for group_id in group_ids},
+        200,
+    )
+
+
+async def routing_error(request: Request, e: StarletteHTTPException) -> Response:
+    """Routing errors (404, 405) as JSON errors of the Flask application"""
+    return error_response(default_exceptions.get(e.status_code, InternalServerError)())
+
+
+app = Starlette(
+    routes=[
+        Route("/ping", ping),
+        Route("/stats", statistics, methods=["GET"]),
+        Route("/group", group, methods=["POST", "DELETE"]),
+        Route("/group/{groupId}", group, methods=["GET"]),
+        Route("/groups", groups, methods=["POST", "DELETE"]),
+        Route("/groups/exists", groups_exist, methods=["POST"]),
+    ],
+    exception_handlers={StarletteHTTPException: routing_error},
+    lifespan=lifespan,
+)
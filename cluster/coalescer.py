@@ -0,0 +1,162 @@
+"""
+Group commit of concurrent writes.
+
+Requests submit their writes to WriteCoalescer and wait. One of the waiting requests is
+the leader: it takes all writes queued so far (up to max_batch), applies them by one call
+of the apply function, which commits them in one transaction, and hands each request its
+own result. Writes which arrive while the leader is committing form the next batch,
+its leader is the oldest of them. So under load one fsync and one acquisition of
+the database lock are shared by many requests, while a lone request is applied
+immediately, without waiting for company (unless window is set).
+
+AsyncWriteCoalescer does the same for coroutines of one event loop (asgi.py), batches are
+applied by a task of the coalescer instead of a leading request.
+"""
+
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+
+class PendingWrite:
+    """Write waiting in the queue of WriteCoalescer"""
+
+    def __init__(self, write: Any):
+        self.write = write
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.lead = False  # woken up to lead the next batch
+        self.ready = threading.Event()
+
+
+class WriteCoalescer:
+    """
+    Args:
+        apply: function applying list of writes in one transaction,
+               returns list of results in the same order
+        window: seconds the leader waits for more writes before applying the batch
+        max_batch: maximum number of writes applied in one transaction
+    """
+
+    def __init__(
+        self,
+        apply: Callable[[List[Any]], List[Any]],
+        window: float = 0.0,
+        max_batch: int = 128,
+    ):
+        self.apply = apply
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._queue: List[PendingWrite] = []
+        self._leading = False
+        self._full = threading.Event()
+        self.batches = 0  # number of applied batches
+        self.writes = 0  # number of applied writes
+
+    def submit(self, write: Any) -> Any:
+        """
+        Queues the write and returns its result, after the batch containing it is applied.
+        Exception raised by apply is raised for every write of the batch.
+        """
+        pending = PendingWrite(write)
+        with self._lock:
+            self._queue.append(pending)
+            if len(self._queue) >= self.max_batch:
+                self._full.set()
+            lead = not self._leading
+            self._leading = True
+        if not lead:
+            pending.ready.wait()
+            lead = pending.lead
+        if lead:
+            self._lead()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _lead(self):
+        if self.window:
+            self._full.wait(self.window)
+        with self._lock:
+            batch = self._queue[: self.max_batch]
+            del self._queue[: self.max_batch]
+            if len(self._queue) < self.max_batch:
+                self._full.clear()
+        try:
+            results = self.apply([pending.write for pending in batch])
+            for pending, result in zip(batch, results):
+                pending.result = result
+        except BaseException as e:
+            for pending in batch:
+                pending.error = e
+        with self._lock:
+            self.batches += 1
+            self.writes += len(batch)
+            if self._queue:
+                # oldest queued write leads the next batch
+                self._queue[0].lead = True
+                self._queue[0].ready.set()
+            else:
+                self._leading = False
+        for pending in batch:
+            pending.ready.set()
+
+
+class AsyncWriteCoalescer:
+    """
+    WriteCoalescer of the event loop, see the module docstring.
+    Args:
+        apply: coroutine function applying list of writes in one transaction,
+               returns list of results in the same order
+        window: seconds the batch waits for more writes before it is applied
+        max_batch: maximum number of writes applied in one transaction
+    """
+
+    def __init__(
+        self,
+        apply: Callable[[List[Any]], Awaitable[List[Any]]],
+        window: float = 0.0,
+        max_batch: int = 128,
+    ):
+        self.apply = apply
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: List[Tuple[Any, asyncio.Future]] = []
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0  # number of applied batches
+        self.writes = 0  # number of applied writes
+
+    async def submit(self, write: Any) -> Any:
+        """
+        Queues the write and returns its result, after the batch containing it is applied.
+        Exception raised by apply is raised for every write of the batch.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((write, future))
+        if self._task is None:
+            self._task = asyncio.create_task(self._apply_queue())
+        return await future
+
+    async def _apply_queue(self):
+        """Applies batches until the queue is empty, writes queued meanwhile form the next ones"""
+        try:
+            while self._queue:
+                if self.window and len(self._queue) < self.max_batch:
+                    await asyncio.sleep(self.window)
+                batch = self._queue[: self.max_batch]
+                del self._queue[: self.max_batch]
+                try:
+                    results = await self.apply([write for write, _ in batch])
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for (_, future), result in zip(batch, results):
+                        if not future.done():  # cancelled by a closed connection
+                            future.set_result(result)
+                self.batches += 1
+                self.writes += len(batch)
+        finally:
+            self._task = None
@@ -1,4 +1,58 @@
+import os
+
+from sqlalchemy.pool import QueuePool
+
+# Database which kept all nodes before every node got its own one,
+# node tables found in it are moved to the node databases on start
 SQLALCHEMY_DATABASE_URI = "sqlite:///storage/cluster.db"
+# Registry of the nodes, node01..nodeNN, NODE_COUNT environment variable changes their number
+NODES = [f"node{i:02d}" for i in range(1, int(os.environ.get("NODE_COUNT", 3)) + 1)]
+# Every node is kept in its own database file, with its own write lock and WAL
+SQLALCHEMY_BINDS = {node: f"sqlite:///storage/{node}.db" for node in NODES}
 SQLALCHEMY_TRACK_MODIFICATIONS = False  # track modifications of objects and emit signals, we don't need this
-RANDOM_BEHAVIOR = 0.2
+# "sync": Flask application under gunicorn with the gevent worker (gunicorn_conf.py),
+# "async": asgi.py under uvicorn, serves /ping, /stats, /group and /groups writes only (confs/start.sh)
+SERVING_MODE = os.environ.get("SERVING_MODE", "sync")
+RANDOM_BEHAVIOR = 0.2  # probability of 500/408 errors, unless FAULTS are given
+# Fault profile of /group, /groups and /groups/exists (format in faults.py),
+# replaced at runtime by PUT /admin/faults
+FAULTS = None
 DEBUG = False
+GROUP_BATCH_LIMIT = 1000  # maximum number of groupIds accepted by one /groups request
+GROUP_LIST_CHUNK = 1000  # rows read by one query of GET /groups listing and of snapshots
+SNAPSHOT_RESTORE_BATCH = 50000  # records inserted by one transaction of snapshot restore
+WRITE_COALESCING = True  # concurrent /group writes share one transaction (group commit)
+WRITE_COALESCE_WINDOW = 0.0  # seconds the batch leader waits for more writes
+WRITE_COALESCE_MAX_BATCH = 128  # maximum number of writes in one transaction
+IDEMPOTENCY_KEY_TTL = 24 * 3600  # seconds results of writes with Idempotency-Key are kept
+IDEMPOTENCY_KEY_EXPIRE_INTERVAL = 60  # seconds between removals of expired keys
+# In-process existence index of groupIds of every node (existence.py), valid only while
+# one process writes the databases: gunicorn workers = 1 (checked at startup), and no other
+# process (async mode, scripts, sqlite3) writes the node files while the API runs
+EXISTENCE_CACHE = False
+EXISTENCE_CACHE_ERROR_RATE = 0.01  # false positive rate of the Bloom filter
+EXISTENCE_CACHE_MAX_BYTES = 8 * 2**20  # upper bound of the Bloom filter of one node
+EXISTENCE_CACHE_POSITIVES = 100000  # groupIds known to exist kept per node (LRU)
+# Profiling of requests (profiling.py), changed at runtime by PUT /admin/profile
+PROFILE_SAMPLE_RATE = 0.0  # share of responses with Server-Timing breakdown header
+PROFILE_SLOW_REQUEST = 1.0  # seconds, slower requests are logged with breakdown, None disables
+PROFILE_DIR = "storage/profiles"  # directory of cProfile captures
+
+# SQLite storage profile, PRAGMAs are applied to every new connection
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # readers don't block the writer and the writer doesn't block readers
+    "synchronous": "NORMAL",  # with WAL fsync only at checkpoints, commits survive crash of the app
+    "busy_timeout": 5000,  # ms to wait for the lock before failing with "database is locked"
+    "mmap_size": 268435456,  # 256 MiB of the database file read through memory map
+    "cache_size": -65536,  # 64 MiB of page cache per connection (negative value is KiB)
+}
+# Connections are kept in a pool instead of being opened for every request (default NullPool).
+# Locks of QueuePool are patched by gevent worker, connections are used by different greenlets,
+# so check_same_thread is disabled
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "poolclass": QueuePool,
+    "pool_size": 10,
+    "max_overflow": 20,
+    "pool_timeout": 30,
+    "connect_args": {"check_same_thread": False},
+}
@@ -1,3 +1,5 @@
+import os
+
 # Gunicorn config variables
 loglevel = "info"
 errorlog = "-"
@@ -8,3 +10,9 @@ timeout = 1000
 keepalive = 5
 threads = 3
 worker_class = "gevent"
+workers = 1  # existence cache of main.py (EXISTENCE_CACHE) needs one process writing
+
+
+def on_starting(server):
+    # inherited by the workers, main.py refuses EXISTENCE_CACHE with more than one
+    os.environ["GUNICORN_WORKERS"] = str(server.cfg.workers)
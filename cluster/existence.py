@@ -0,0 +1,277 @@
+"""
+In-process existence index of groupIds, one ExistenceCache per node.
+
+Bloom filter holds every groupId of the node table, it is built by a scan of the table and
+groupIds are added to it before the transaction inserting them is committed, so a groupId
+which is not in the filter is not in the table (answered without the database).
+A groupId in the filter may be missing (false positive, or deleted, bits can't be removed),
+then the database is asked. Positives are kept in a bounded LRU of groupIds known to exist,
+added when their insert is committed or the database confirms them, removed when their
+delete is committed.
+
+Filter is rebuilt by a new scan, in the background (main.py), lookups go to the database
+until the first filter is installed and are answered by the previous filter meanwhile.
+groupIds whose transactions are not committed when the scan starts (in flight) and groupIds
+added while it runs are added to the new filter when it is installed, so it misses neither
+writes committed before the scan nor after it. Table changed bypassing the index (snapshot
+restore) is marked by invalidate and end_bypass, filters scanned meanwhile are discarded.
+
+The index is correct only if all writes of the table go through one process (gunicorn runs
+one worker, gunicorn_conf.py), so it is disabled by default (EXISTENCE_CACHE), and writes
+never rely on it: the database decides whether a groupId is inserted or deleted.
+"""
+
+import hashlib
+import math
+import threading
+from collections import Counter, OrderedDict
+from typing import Iterable, List, Optional, Set, Tuple
+
+MIN_CAPACITY = 10000  # groupIds of the smallest filter
+
+
+class BloomFilter:
+    """
+    Args:
+        capacity: number of groupIds the filter is sized for
+        error_rate: false positive rate at capacity
+        max_bits: upper bound of the size, capacity is lowered to the one the size allows
+    """
+
+    def __init__(self, capacity: int, error_rate: float, max_bits: int):
+        capacity = max(capacity, 1)
+        per_item = -math.log(error_rate) / math.log(2) ** 2
+        self.size = max(64, min(math.ceil(capacity * per_item), max_bits))
+        self.capacity = min(capacity, int(self.size / per_item))
+        self.hashes = max(1, round(self.size / max(self.capacity, 1) * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0  # added groupIds, deleted ones included
+
+    def positions(self, group_id: str) -> Iterable[int]:
+        # double hashing, k positions from two 64 bit halves of one digest
+        digest = hashlib.blake2b(group_id.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def add(self, group_id: str):
+        bits = self.bits
+        for position in self.positions(group_id):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def update(self, group_ids: Iterable[str]):
+        """Adds many groupIds, the loop of add and positions inlined for the table scan"""
+        bits = self.bits
+        size = self.size
+        hashes = range(self.hashes)
+        blake2b = hashlib.blake2b
+        count = 0
+        for group_id in group_ids:
+            digest = int.from_bytes(
+                blake2b(group_id.encode(), digest_size=16).digest(), "little"
+            )
+            h1 = digest & 0xFFFFFFFFFFFFFFFF
+            h2 = (digest >> 64) | 1
+            for i in hashes:
+                position = (h1 + i * h2) % size
+                bits[position >> 3] |= 1 << (position & 7)
+            count += 1
+        self.count += count
+
+    def __contains__(self, group_id: str) -> bool:
+        bits = self.bits
+        return all(
+            bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(group_id)
+        )
+
+
+class ExistenceCache:
+    """
+    Existence index of one node, see the module docstring.
+    Args:
+        error_rate: false positive rate of the Bloom filter
+        max_bytes: upper bound of the size of the Bloom filter
+        positives: number of groupIds kept in the LRU of existing groupIds
+    """
+
+    def __init__(
+        self,
+        error_rate: float = 0.01,
+        max_bytes: int = 8 * 2**20,
+        positives: int = 100000,
+    ):
+        self.error_rate = error_rate
+        self.max_bits = max_bytes * 8
+        self.positives = positives
+        self._lock = threading.Lock()
+        self._filter: Optional[BloomFilter] = None  # None until the first build
+        self._building: Optional[BloomFilter] = None
+        self._pending: List[str] = []  # groupIds to add to the filter being built
+        self._built = 0  # groupIds in the table when the filter was built
+        self._requested = False  # rebuild is requested and not started yet
+        self._bypassing = 0  # writes bypassing the index in progress, see invalidate
+        self._inflight = Counter()  # groupIds added by uncommitted transactions
+        self._known: "OrderedDict[str, None]" = OrderedDict()
+        self.generation = 0  # changed by deletes, see remember
+
+    @property
+    def ready(self) -> bool:
+        return self._filter is not None
+
+    def lookup(self, group_id: str) -> Optional[bool]:
+        """True if groupId exists, False if it doesn't, None if the database should be asked"""
+        with self._lock:
+            if self._filter is None:
+                return None
+            if group_id in self._known:
+                self._known.move_to_end(group_id)
+                return True
+            if group_id not in self._filter:
+                return False
+        return None
+
+    def lookup_many(self, group_ids: Iterable[str]) -> Tuple[Set[str], List[str], int]:
+        """
+        lookup of many groupIds, returns groupIds which exist, groupIds the database
+        should be asked for, and number of missing groupIds
+        """
+        existing = set()
+        unknown = []
+        missing = 0
+        with self._lock:
+            if self._filter is None:
+                return existing, list(group_ids), missing
+            known = self._known
+            bloom = self._filter
+            for group_id in group_ids:
+                if group_id in known:
+                    known.move_to_end(group_id)
+                    existing.add(group_id)
+                elif group_id in bloom:
+                    unknown.append(group_id)
+                else:
+                    missing += 1
+        return existing, unknown, missing
+
+    def remember(self, group_id: str, generation: int):
+        """
+        Keeps groupId which the database found existing. generation is the value of
+        the attribute before the query, if a delete was committed since then,
+        the answer may be outdated and it is not kept
+        """
+        with self._lock:
+            if self._filter is not None and generation == self.generation:
+                self._remember(group_id)
+
+    def _remember(self, group_id: str):
+        self._known[group_id] = None
+        self._known.move_to_end(group_id)
+        while len(self._known) > self.positives:
+            self._known.popitem(last=False)
+
+    def adding(self, group_ids: Iterable[str]):
+        """groupIds inserted by a transaction, before it is committed"""
+        with self._lock:
+            for group_id in group_ids:
+                self._inflight[group_id] += 1
+                if self._filter is not None:
+                    self._filter.add(group_id)
+                if self._building is not None:
+                    self._pending.append(group_id)
+
+    def settle(self, group_ids: Iterable[str], sign: int, committed: bool):
+        """
+        Ends the transaction which inserted (sign=1, given to adding before)
+        or deleted (sign=-1) groupIds
+        """
+        with self._lock:
+            if sign > 0:
+                for group_id in group_ids:
+                    self._inflight[group_id] -= 1
+                    if self._inflight[group_id] <= 0:
+                        del self._inflight[group_id]
+                    if committed and self._filter is not None:
+                        self._remember(group_id)
+            elif committed:
+                for group_id in group_ids:
+                    self._known.pop(group_id, None)
+                self.generation += 1
+
+    def invalidate(self):
+        """
+        Table is being changed bypassing the index, lookups go to the database until
+        end_bypass is called and the filter is rebuilt
+        """
+        with self._lock:
+            self._filter = None
+            self._building = None  # scan may have missed the change
+            self._pending = []
+            self._known.clear()
+            self._bypassing += 1
+            self.generation += 1
+
+    def end_bypass(self):
+        """Change of invalidate is committed, filters scanned before can't be installed"""
+        with self._lock:
+            self._bypassing -= 1
+            self._building = None
+            self._pending = []
+
+    def request_rebuild(self) -> bool:
+        """Marks rebuild as requested, False if one is requested and not started yet"""
+        with self._lock:
+            if self._requested:
+                return False
+            self._requested = True
+            return True
+
+    def start_rebuild(self, expected: int) -> BloomFilter:
+        """
+        Returns new filter for expected number of groupIds, which must be filled
+        by a scan of the table started after this call and passed to finish_rebuild
+        """
+        bloom = BloomFilter(
+            max(2 * expected, MIN_CAPACITY), self.error_rate, self.max_bits
+        )
+        with self._lock:
+            self._requested = False
+            self._building = bloom
+            self._pending = list(self._inflight)
+        return bloom
+
+    def finish_rebuild(self, bloom: BloomFilter):
+        """Installs the filter filled by the scan, unless the cache was invalidated meanwhile"""
+        with self._lock:
+            if self._building is not bloom or self._bypassing:
+                return
+            built = bloom.count
+            for group_id in self._pending:
+                bloom.add(group_id)
+            self._building = None
+            self._pending = []
+            self._filter = bloom
+            self._built = built
+
+    def abort_rebuild(self, bloom: BloomFilter):
+        """Scan of the filter failed, the next rebuild can be started"""
+        with self._lock:
+            if self._building is bloom:
+                self._building = None
+                self._pending = []
+
+    @property
+    def stale(self) -> bool:
+        """
+        True if the filter should be rebuilt: half of its capacity was inserted since the build.
+        Filter of a table larger than its capacity is not rebuilt, its false positive rate
+        is over error_rate anyway
+        """
+        bloom = self._filter
+        if bloom is None or self._building is not None or self._requested:
+            return False
+        return self._built < bloom.capacity and (
+            bloom.count - self._built > bloom.capacity // 2
+        )
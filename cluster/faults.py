@@ -0,0 +1,308 @@
+"""
+Fault injection, imitation of an unstable connection and of unstable nodes.
+
+Faults are described by a profile, a JSON object with RNG seed and list of rules:
+
+    {
+        "seed": 42,
+        "rules": [
+            {
+                "nodes": ["node02"],
+                "methods": ["POST", "DELETE"],
+                "endpoints": ["group", "groups"],
+                "latency": {"distribution": "lognormal", "median_ms": 20, "sigma": 1},
+                "error_rate": 0.1,
+                "errors": [500, 408],
+                "partial_failure_rate": 0.05,
+                "slow_drain": {"rate": 0.1, "bytes_per_second": 512},
+                "outages": [{"start": 30, "duration": 10, "every": 120, "status": 503}]
+            }
+        ]
+    }
+
+The first rule matching node, method and endpoint of the request applies, omitted
+nodes/methods/endpoints match any. Faults of the rule, in the order they are applied:
+    outages:              during the windows (seconds since the profile was set, repeated
+                          every "every" seconds if given) requests fail with status (503)
+    latency:              delay before the request is handled, "constant" (ms),
+                          "uniform" (min_ms, max_ms), "exponential" (mean_ms)
+                          or "lognormal" (median_ms, sigma) distribution, in latency_rate (1)
+                          of requests
+    error_rate:           requests fail with one of errors status codes (500, 408),
+                          before they are handled
+    partial_failure_rate: requests are handled, their writes committed, and fail with 500
+    slow_drain:           response body is sent at bytes_per_second in rate of responses
+
+Every request draws the same amount of random numbers from the RNG of the profile,
+so a sequence of requests gets the same faults for the same seed.
+"""
+
+import math
+import random
+import threading
+import time
+from statistics import NormalDist
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+DISTRIBUTIONS = {
+    "constant": ("ms",),
+    "uniform": ("min_ms", "max_ms"),
+    "exponential": ("mean_ms",),
+    "lognormal": ("median_ms", "sigma"),
+}
+RULE_KEYS = {
+    "nodes",
+    "methods",
+    "endpoints",
+    "latency",
+    "latency_rate",
+    "error_rate",
+    "errors",
+    "partial_failure_rate",
+    "slow_drain",
+    "outages",
+}
+DRAIN_CHUNK = 256  # bytes sent at once by slow drain
+
+
+class FaultProfileError(ValueError):
+    """Profile is malformed"""
+
+
+def random_behavior_profile(probability: float) -> Dict[str, Any]:
+    """Profile of RANDOM_BEHAVIOR config parameter: 500 or 408 with given probability"""
+    return {"rules": [{"error_rate": probability, "errors": [500, 408]}]}
+
+
+def check_rate(rule: Dict[str, Any], key: str, default: float = 0.0) -> float:
+    value = rule.get(key, default)
+    if not isinstance(value, (int, float)) or not 0 <= value <= 1:
+        raise FaultProfileError(f"{key} should be a number from 0 to 1, got {value!r}")
+    return float(value)
+
+
+def check_number(value: Any, name: str) -> float:
+    if not isinstance(value, (int, float)) or value < 0:
+        raise FaultProfileError(
+            f"{name} should be a non negative number, got {value!r}"
+        )
+    return float(value)
+
+
+class Fault:
+    """
+    Faults of one request.
+    Args:
+        status: status code of the error raised before the request is handled
+        outage: error is raised because of an outage window
+        delay: seconds to wait before the request is handled
+        partial: request is handled and its response replaced by 500
+        drain: bytes per second the response body is sent at
+    """
+
+    __slots__ = ("status", "outage", "delay", "partial", "drain")
+
+    def __init__(
+        self,
+        status: Optional[int] = None,
+        outage: bool = False,
+        delay: float = 0.0,
+        partial: bool = False,
+        drain: Optional[float] = None,
+    ):
+        self.status = status
+        self.outage = outage
+        self.delay = delay
+        self.partial = partial
+        self.drain = drain
+
+
+class Rule:
+    def __init__(self, rule: Dict[str, Any]):
+        if not isinstance(rule, dict):
+            raise FaultProfileError(f"Rule should be an object, got {rule!r}")
+        unknown = set(rule) - RULE_KEYS
+        if unknown:
+            raise FaultProfileError(f"Unknown keys of rule: {sorted(unknown)}")
+        for key in ("nodes", "methods", "endpoints"):
+            values = rule.get(key)
+            if values is not None and not (
+                isinstance(values, list) and all(isinstance(v, str) for v in values)
+            ):
+                raise FaultProfileError(f"{key} should be a list of strings")
+        self.nodes = set(rule["nodes"]) if rule.get("nodes") is not None else None
+        self.methods = (
+            {method.upper() for method in rule["methods"]}
+            if rule.get("methods") is not None
+            else None
+        )
+        self.endpoints = (
+            set(rule["endpoints"]) if rule.get("endpoints") is not None else None
+        )
+
+        self.latency = rule.get("latency")
+        if self.latency is not None:
+            if not isinstance(self.latency, dict):
+                raise FaultProfileError("latency should be an object")
+            distribution = self.latency.get("distribution")
+            if distribution not in DISTRIBUTIONS:
+                raise FaultProfileError(
+                    f"latency distribution should be one of {list(DISTRIBUTIONS)}"
+                )
+            for param in DISTRIBUTIONS[distribution]:
+                check_number(self.latency.get(param), f"latency {param}")
+        self.latency_rate = check_rate(rule, "latency_rate", 1.0)
+        self.error_rate = check_rate(rule, "error_rate")
+        self.errors: List[int] = rule.get("errors", [500, 408])
+        if (
+            not isinstance(self.errors, list)
+            or not all(
+                isinstance(status, int) and 400 <= status < 600
+                for status in self.errors
+            )
+            or not self.errors
+        ):
+            raise FaultProfileError(
+                "errors should be a non empty list of 4xx/5xx status codes"
+            )
+        self.partial_failure_rate = check_rate(rule, "partial_failure_rate")
+
+        drain = rule.get("slow_drain")
+        self.drain_rate = 0.0
+        self.drain_speed = None
+        if drain is not None:
+            if not isinstance(drain, dict):
+                raise FaultProfileError("slow_drain should be an object")
+            self.drain_rate = check_rate(drain, "rate", 1.0)
+            self.drain_speed = check_number(
+                drain.get("bytes_per_second"), "slow_drain bytes_per_second"
+            )
+            if not self.drain_speed:
+                raise FaultProfileError(
+                    "slow_drain bytes_per_second should be positive"
+                )
+
+        self.outages = []  # (start, duration, every, status)
+        for outage in rule.get("outages", []):
+            if not isinstance(outage, dict):
+                raise FaultProfileError(f"Outage should be an object, got {outage!r}")
+            every = outage.get("every")
+            status = outage.get("status", 503)
+            if not isinstance(status, int) or not 400 <= status < 600:
+                raise FaultProfileError("outage status should be a 4xx/5xx status code")
+            self.outages.append(
+                (
+                    check_number(outage.get("start", 0), "outage start"),
+                    check_number(outage.get("duration"), "outage duration"),
+                    check_number(every, "outage every") if every is not None else None,
+                    status,
+                )
+            )
+
+    def matches(self, node: str, method: str, endpoint: str) -> bool:
+        return (
+            (self.nodes is None or node in self.nodes)
+            and (self.methods is None or method in self.methods)
+            and (self.endpoints is None or endpoint in self.endpoints)
+        )
+
+    def outage(self, elapsed: float) -> Optional[int]:
+        """Status code of the outage window the elapsed seconds fall into"""
+        for start, duration, every, status in self.outages:
+            if elapsed < start:
+                continue
+            offset = elapsed - start
+            if every:
+                offset %= every
+            if offset < duration:
+                return status
+        return None
+
+    def sample_latency(self, rng: random.Random) -> float:
+        """Delay in seconds, one random number is drawn for any distribution"""
+        u = rng.random()
+        latency = self.latency
+        distribution = latency["distribution"]
+        if distribution == "constant":
+            ms = latency["ms"]
+        elif distribution == "uniform":
+            ms = latency["min_ms"] + u * (latency["max_ms"] - latency["min_ms"])
+        elif distribution == "exponential":
+            ms = -latency["mean_ms"] * math.log(1 - u)
+        else:
+            # inverse CDF of lognormal by the normal quantile of u
+            z = NormalDist().inv_cdf(min(max(u, 1e-12), 1 - 1e-12))
+            ms = latency["median_ms"] * math.exp(latency["sigma"] * z)
+        return ms / 1000
+
+
+class FaultInjector:
+    """
+    Decides faults of requests by the profile, see the module docstring.
+    Profile can be replaced at any time, which restarts its RNG and outage windows.
+    """
+
+    def __init__(self, profile: Optional[Dict[str, Any]] = None):
+        self._lock = threading.Lock()
+        self.configure(profile)
+
+    def configure(self, profile: Optional[Dict[str, Any]]):
+        """
+        Installs the profile, None disables fault injection
+        Exceptions:
+            FaultProfileError:
+                Raises exception if the profile is malformed, previous one stays
+        """
+        profile = profile if profile is not None else {"rules": []}
+        if not isinstance(profile, dict):
+            raise FaultProfileError("Profile should be an object")
+        unknown = set(profile) - {"seed", "rules"}
+        if unknown:
+            raise FaultProfileError(f"Unknown keys of profile: {sorted(unknown)}")
+        if not isinstance(profile.get("rules", []), list):
+            raise FaultProfileError("rules should be a list")
+        rules = [Rule(rule) for rule in profile.get("rules", [])]
+        with self._lock:
+            self.profile = profile
+            self.rules = rules
+            self.rng = random.Random(profile.get("seed"))
+            self.started = time.monotonic()
+
+    def decide(self, node: str, method: str, endpoint: str) -> Optional[Fault]:
+        """Faults of the request, None if no rule matches it"""
+        with self._lock:
+            rule = next(
+                (rule for rule in self.rules if rule.matches(node, method, endpoint)),
+                None,
+            )
+            if rule is None:
+                return None
+            rng = self.rng
+            status = rule.outage(time.monotonic() - self.started)
+            if status is not None:
+                return Fault(status=status, outage=True)
+            # every draw is made whether it applies or not, to keep the sequence aligned
+            delay = rule.sample_latency(rng) if rule.latency is not None else 0.0
+            if rng.random() >= rule.latency_rate:
+                delay = 0.0
+            error = rng.random() < rule.error_rate
+            error_status = rng.choice(rule.errors)
+            partial = rng.random() < rule.partial_failure_rate
+            drain = rng.random() < rule.drain_rate
+        return Fault(
+            status=error_status if error else None,
+            delay=delay,
+            partial=partial and not error,
+            drain=rule.drain_speed if drain and not error else None,
+        )
+
+
+def slow_drain(
+    chunks: Iterable[bytes], bytes_per_second: float, chunk: int = DRAIN_CHUNK
+) -> Iterator[bytes]:
+    """Yields the body by pieces of chunk bytes, at bytes_per_second"""
+    for data in chunks:
+        for i in range(0, len(data), chunk):
+            piece = data[i : i + chunk]
+            time.sleep(len(piece) / bytes_per_second)
+            yield piece
@@ -1,7 +1,10 @@
 import json
 import logging
 import os
-from typing import Any, Optional
+import sqlite3
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 logging.basicConfig(
     format="%(asctime)s : %(levelname)s : %(message)s", level=logging.INFO
@@ -9,17 +12,61 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 logger.setLevel("INFO")
-import random
+from flask import Flask, g, has_request_context, request, stream_with_context
+from flask_apscheduler import APScheduler
 
-from flask import Flask, request
-from models.models import Group1, Group2, Group3, db
+from coalescer import WriteCoalescer
+from existence import ExistenceCache
+from faults import FaultInjector, FaultProfileError, random_behavior_profile, slow_drain
+from metrics import DB_BUCKETS, Registry
+from profiling import (
+    ProfilingError,
+    RequestProfiler,
+    TimedJSONProvider,
+    current_timings,
+)
+from snapshot import SnapshotError, encode_snapshot, read_snapshot
+from writes import (
+    BATCH_STATUSES,
+    batch_group_ids,
+    checked_idempotency_key,
+    chunks,
+    claim_key,
+    expired_keys,
+    group_body,
+    node_model,
+    replayed_result,
+    store_result,
+    stored_key,
+)
+
+from models.models import (
+    BUCKET_DIGEST_MODULUS,
+    TREE_DEPTH,
+    TREE_FANOUT_BITS,
+    TREE_LEAF_BITS,
+    IdempotencyKey,
+    NodeBucket,
+    NodeSession,
+    NodeStats,
+    db,
+    group_bucket,
+    node_models,
+    recount_statements,
+    stats_statements,
+    write_digest,
+)
+from sqlalchemy import delete, event, func, inspect, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.sqlite import insert
 from werkzeug.exceptions import (
     BadRequest,
     HTTPException,
     InternalServerError,
     NotAcceptable,
     NotFound,
-    RequestTimeout,
+    UnprocessableEntity,
+    default_exceptions,
 )
 from werkzeug.wrappers import Response
 
@@ -27,26 +74,326 @@ from werkzeug.wrappers import Response
 app = Flask(__name__)
 config_path = os.environ["CONFIG_PATH"]
 app.config.from_object(config_path)
+app.json = TimedJSONProvider(app)
 
 # Initialize db
 db.init_app(app)
 
+# Background jobs of the process (builds of existence caches)
+scheduler = APScheduler()
+scheduler.init_app(app)
+scheduler.start()
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Applies SQLITE_PRAGMAS storage profile of the config to every new SQLite connection
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config.get("SQLITE_PRAGMAS", {}).items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
 
 @app.before_first_request
 def create_all():
     """
     Function that run only before first request and creates all db structure
-    defined in models.py
+    defined in models.py in the database of every node.
+    Indexes and bucket column are created separately, because create_all skips tables
+    which already exist, and databases created before they were introduced would miss them.
     """
-    db.create_all()
+    for node, Group in hosts.items():
+        engine = db.get_engine(app, bind=node)
+        db.create_all(bind=node)
+        for Table in (NodeStats, NodeBucket, IdempotencyKey):
+            Table.__table__.create(engine, checkfirst=True)
+        add_bucket_column(node, Group)
+        for index in Group.__table__.indexes:
+            index.create(engine, checkfirst=True)
+        migrated = migrate_shared_table(node, Group)
+        fill_bucket_column(Group)
+        stats = db.session.execute(
+            select(NodeStats.node).where(NodeStats.node == node),
+            bind_arguments=node_bind(node),
+        ).first()
+        if migrated or stats is None:
+            recount_node_stats(node)
+        db.session.commit()
+        schedule_existence_rebuild(node)
 
 
-# Making mapping between node name and Model
-hosts = {
-    "node01": Group1,
-    "node02": Group2,
-    "node03": Group3,
-}
+def node_bind(node: str) -> Dict[str, Engine]:
+    """
+    bind_arguments of statements on NodeStats, NodeBucket and IdempotencyKey tables,
+    which are kept in the database of every node
+    """
+    return {"bind": db.get_engine(app, bind=node)}
+
+
+def add_bucket_column(node: str, Group):
+    """
+    Adds bucket column to the table created before the hash tree was introduced
+    """
+    table = Group.__tablename__
+    engine = db.get_engine(app, bind=node)
+    if "bucket" not in {c["name"] for c in inspect(engine).get_columns(table)}:
+        with engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN bucket INTEGER"))
+
+
+def migrate_shared_table(node: str, Group, chunk: int = 10000) -> bool:
+    """
+    Copies records of the node table from the shared database (SQLALCHEMY_DATABASE_URI),
+    which kept all nodes before every node got its own database, chunk by chunk.
+    Copy is idempotent, so interrupted migration is completed on the next start.
+    Afterwards the shared table is renamed to <table>_migrated, so it is copied only once
+    and can be dropped when the migration is checked.
+    Returns True if records were migrated
+    """
+    table = Group.__tablename__
+    shared = db.get_engine(app)
+    if shared.url == db.get_engine(app, bind=node).url:
+        return False  # node is still kept in the shared database
+    if not inspect(shared).has_table(table):
+        return False
+    logger.info("Migrating %s from %s to %s", table, shared.url, node)
+    with shared.connect() as connection:
+        result = connection.execute(text(f"SELECT groupId, timestamp FROM {table}"))
+        for rows in result.partitions(chunk):
+            db.session.execute(
+                insert(Group).on_conflict_do_nothing(index_elements=["groupId"]),
+                [dict(row._mapping) for row in rows],
+            )
+            db.session.commit()
+    with shared.begin() as connection:
+        connection.execute(text(f"ALTER TABLE {table} RENAME TO {table}_migrated"))
+    return True
+
+
+def fill_bucket_column(Group, chunk: int = 10000):
+    """
+    Computes bucket of the records which miss it, chunk by chunk
+    """
+    while True:
+        rows = (
+            db.session.query(Group.id, Group.groupId)
+            .filter(Group.bucket.is_(None))
+            .limit(chunk)
+            .all()
+        )
+        if not rows:
+            break
+        db.session.execute(
+            Group.__table__.update()
+            .where(Group.id == db.bindparam("_id"))
+            .values(bucket=db.bindparam("_bucket")),
+            [{"_id": id, "_bucket": group_bucket(group_id)} for id, group_id in rows],
+        )
+        db.session.commit()
+
+
+# Making mapping between node name and Model, for every node of the registry in the config
+hosts = node_models(app.config["NODES"])
+# Faults injected into /group, /groups and /groups/exists requests (see inject_faults)
+faults = FaultInjector(
+    app.config.get("FAULTS")
+    or random_behavior_profile(app.config.get("RANDOM_BEHAVIOR", 0.5))
+)
+# Existence index of every node, answers existence checks of missing groupIds and of
+# recently seen ones without the database (see existence.py). It sees only writes of this
+# process, gunicorn_conf.py passes the number of workers in GUNICORN_WORKERS
+if app.config.get("EXISTENCE_CACHE") and int(os.environ.get("GUNICORN_WORKERS", 1)) > 1:
+    raise RuntimeError(
+        "EXISTENCE_CACHE requires one process writing the databases, "
+        f"gunicorn runs {os.environ['GUNICORN_WORKERS']} workers"
+    )
+existence_caches = (
+    {
+        node: ExistenceCache(
+            app.config.get("EXISTENCE_CACHE_ERROR_RATE", 0.01),
+            app.config.get("EXISTENCE_CACHE_MAX_BYTES", 8 * 2**20),
+            app.config.get("EXISTENCE_CACHE_POSITIVES", 100000),
+        )
+        for node in hosts
+    }
+    if app.config.get("EXISTENCE_CACHE", False)
+    else {}
+)
+
+# Timing breakdown of requests and cProfile captures, switched by /admin/profile (see profiling.py)
+profiler = RequestProfiler(
+    app.config.get("PROFILE_SAMPLE_RATE", 0.0),
+    app.config.get("PROFILE_SLOW_REQUEST", 1.0),
+    app.config.get("PROFILE_DIR", "storage/profiles"),
+)
+app.wsgi_app = profiler.wrap(app.wsgi_app)
+
+metrics = Registry()
+request_seconds = metrics.histogram(
+    "cluster_request_duration_seconds",
+    "Time from the start of the request until its response is returned, "
+    "streamed bodies are sent afterwards",
+    ("node", "method", "endpoint"),
+)
+responses_total = metrics.counter(
+    "cluster_responses_total",
+    "Responses by status code",
+    ("node", "method", "endpoint", "status"),
+)
+statement_seconds = metrics.histogram(
+    "cluster_db_statement_duration_seconds",
+    "Time of executing one SQL statement, rows fetched afterwards are not included",
+    ("database", "statement"),
+    DB_BUCKETS,
+)
+commit_seconds = metrics.histogram(
+    "cluster_db_commit_duration_seconds",
+    "Time of committing the session, flush of pending objects included",
+    ("node",),
+    DB_BUCKETS,
+)
+injected_faults_total = metrics.counter(
+    "cluster_injected_faults_total",
+    "Faults injected by the fault profile, fault is the exception raised "
+    "or latency, outage, partial_failure, slow_drain",
+    ("node", "method", "fault"),
+)
+existence_lookups_total = metrics.counter(
+    "cluster_existence_cache_lookups_total",
+    "Existence checks by the existence cache, result is exists or missing if the cache "
+    "answered, miss if the database was asked",
+    ("node", "result"),
+)
+existence_false_positives_total = metrics.counter(
+    "cluster_existence_cache_false_positives_total",
+    "Misses of the existence cache which the database found missing",
+    ("node",),
+)
+STATEMENT_LABELS = {"SELECT", "INSERT", "UPDATE", "DELETE"}  # others are labelled OTHER
+
+
+def metric_node() -> str:
+    """
+    node header of the request as label value, empty for unknown nodes,
+    so arbitrary headers don't create new series
+    """
+    if not has_request_context():
+        return ""
+    node = request.headers.get("node")
+    return node if node in hosts else ""
+
+
+def database_name(engine: Engine) -> str:
+    """Name of the SQLite file of the engine without extension, node name for node databases"""
+    return os.path.splitext(os.path.basename(engine.url.database or ""))[0]
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.before_request
+def mark_routing():
+    """Registered after other before_request functions, so routing includes them"""
+    timings = current_timings()
+    if timings is not None:
+        timings.mark("routing")
+
+
+@app.after_request
+def report_timings(response: Response) -> Response:
+    """
+    Server-Timing header of sampled responses, log of slow requests.
+    Registered before other after_request functions, so it runs after them
+    """
+    timings = current_timings()
+    if timings is not None:
+        header = profiler.report(
+            timings, request.method, request.path, response.status_code
+        )
+        if header is not None:
+            response.headers["Server-Timing"] = header
+    return response
+
+
+@app.after_request
+def observe_request(response: Response) -> Response:
+    labels = (metric_node(), request.method, request.endpoint or "")
+    started = g.get("request_started")
+    if started is not None:
+        request_seconds.observe(time.perf_counter() - started, *labels)
+    responses_total.inc(*labels, str(response.status_code))
+    return response
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info["statement_started"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def observe_statement(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop("statement_started", None)
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    timings = current_timings()
+    if timings is not None:
+        timings.add("db", seconds)
+    verb = (statement.split(None, 1) or [""])[0].upper()
+    statement_seconds.observe(
+        seconds,
+        database_name(conn.engine),
+        verb if verb in STATEMENT_LABELS else "OTHER",
+    )
+
+
+@event.listens_for(NodeSession, "before_commit")
+def start_commit_timer(session):
+    session.info["commit_started"] = time.perf_counter()
+    timings = current_timings()
+    if timings is not None:
+        session.info["commit_db_seconds"] = timings.phases.get("db", 0.0)
+
+
+@event.listens_for(NodeSession, "after_commit")
+def observe_commit(session):
+    started = session.info.pop("commit_started", None)
+    db_seconds = session.info.pop("commit_db_seconds", None)
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    commit_seconds.observe(seconds, metric_node())
+    timings = current_timings()
+    if timings is not None and db_seconds is not None:
+        # statements flushed by the commit are already counted in db
+        timings.add("commit", seconds - (timings.phases.get("db", 0.0) - db_seconds))
+
+
+@event.listens_for(NodeSession, "after_commit")
+def settle_existence_changes(session):
+    """Committed writes of the transaction are applied to the existence caches"""
+    for node, group_ids, sign in session.info.pop("existence_changes", ()):
+        existence_caches[node].settle(group_ids, sign, committed=True)
+
+
+@event.listens_for(NodeSession, "after_transaction_end")
+def discard_existence_changes(session, transaction):
+    """Writes of the transaction which was rolled back or closed without commit"""
+    if transaction.parent is None:
+        for node, group_ids, sign in session.info.pop("existence_changes", ()):
+            existence_caches[node].settle(group_ids, sign, committed=False)
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """Metrics of this process in Prometheus text exposition format"""
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
 
 
 @app.route("/ping")
@@ -67,12 +414,174 @@ def parse_body() -> Optional[Any]:
     body = request.get_json(
         force=True
     )  # force=True Ignores mimetype ("application/json") and tries to parse json
-    if body is None:
-        raise NotAcceptable("Invalid Request, Please provide body")
-    if "groupId" in body:
-        return body
+    return group_body(body)
+
+
+def parse_batch_body() -> List[str]:
+    """
+    Function parses body of the batch request as json and returns list of groupIds.
+    Used in POST and DELETE methods of /groups endpoint and in /groups/exists endpoint.
+    Duplicated groupIds are dropped, order of the first occurrence is kept.
+    Exceptions:
+        NotAcceptable:
+            Raises exception if body is missing, "groupIds" parameter is missing or is not a list,
+            or the number of groupIds exceeds GROUP_BATCH_LIMIT
+    Returns:
+        List[str]
+    """
+    return batch_group_ids(
+        request.get_json(force=True), app.config.get("GROUP_BATCH_LIMIT", 1000)
+    )
+
+
+def get_node_model(node: Optional[str]):
+    """
+    Function returns Group Model corresponding to the node
+    Exceptions:
+        NotAcceptable:
+            Raises exception if node is missing or not configured
+    """
+    return node_model(hosts, node)
+
+
+def update_node_stats(node: str, group_ids: List[str], sign: int):
+    """
+    Updates counter and digest of the node and of its buckets by inserted (sign=1)
+    or deleted (sign=-1) groupIds.
+    Must be called in the same transaction as the write itself, updates are done by
+    UPDATE and UPSERT statements, so concurrent writers can't lose each other's changes.
+    groupIds are passed to the existence cache of the node, which is updated on commit.
+    """
+    if not group_ids:
+        return
+    cache = existence_caches.get(node)
+    if cache is not None:
+        # inserted groupIds must be in the Bloom filter before they are committed
+        if sign > 0:
+            cache.adding(group_ids)
+        db.session.info.setdefault("existence_changes", []).append(
+            (node, group_ids, sign)
+        )
+    bind = node_bind(node)
+    for statement, parameters in stats_statements(node, group_ids, sign):
+        db.session.execute(statement, parameters, bind_arguments=bind)
+
+
+def recount_node_stats(node: str) -> NodeStats:
+    """
+    Recounts statistics of the node and of its buckets from its table and stores them
+    in the node's database.
+    groupIds are streamed from the table by the driver cursor, without building ORM rows,
+    so memory usage doesn't depend on the table size.
+    """
+    Group = hosts[node]
+    connection = db.session.connection(bind_arguments=node_bind(node))
+    stats, statements = recount_statements(
+        node,
+        (
+            group_id
+            for (group_id,) in connection.exec_driver_sql(
+                f'SELECT "groupId" FROM {Group.__tablename__}'
+            )
+        ),
+    )
+    bind = node_bind(node)
+    for statement, parameters in statements:
+        db.session.execute(statement, parameters, bind_arguments=bind)
+    return stats
+
+
+def rebuild_existence_cache(node: str, chunk: int = 1000):
+    """
+    Builds Bloom filter of the existence cache of the node by a scan of its table.
+    The scan uses its own connection, so it reads committed records, changes of the table
+    made bypassing the cache must be committed first. Rows are read by chunks, and other
+    greenlets and threads run between them, so requests aren't blocked by the scan.
+    """
+    cache = existence_caches.get(node)
+    if cache is None:
+        return
+    table = hosts[node].__tablename__
+    started = time.perf_counter()
+    with db.get_engine(app, bind=node).connect() as connection:
+        expected = connection.exec_driver_sql(f"SELECT count(*) FROM {table}").scalar()
+        bloom = cache.start_rebuild(expected)
+        try:
+            result = connection.exec_driver_sql(f'SELECT "groupId" FROM {table}')
+            for rows in iter(lambda: result.fetchmany(chunk), []):
+                bloom.update(group_id for (group_id,) in rows)
+                # the gevent hub polls connections only after a timer, not after sleep(0)
+                time.sleep(0.001)
+        except BaseException:
+            cache.abort_rebuild(bloom)
+            raise
+    cache.finish_rebuild(bloom)
+    logger.info(
+        "Built existence cache of %s: %s groupIds, %.2f s",
+        node,
+        bloom.count,
+        time.perf_counter() - started,
+    )
+
+
+def schedule_existence_rebuild(node: str):
+    """
+    Rebuilds existence cache of the node by a job of the scheduler, the request
+    doesn't wait for the scan. Until the filter is built, lookups go to the database,
+    or to the previous filter, which holds every groupId as well
+    """
+    cache = existence_caches.get(node)
+    if cache is None or not cache.request_rebuild():
+        return
+    scheduler.add_job(
+        f"existence-cache-{node}",
+        rebuild_existence_cache,
+        args=[node],
+        misfire_grace_time=None,
+    )
+
+
+def refresh_existence_cache(node: str):
+    """Schedules rebuild of existence cache of the node if inserts filled it since its build"""
+    cache = existence_caches.get(node)
+    if cache is not None and cache.stale:
+        schedule_existence_rebuild(node)
+
+
+def existing_groups(node: str, Group, group_ids: List[str]) -> Set[str]:
+    """
+    Returns groupIds of the list which exist in the node table.
+    groupIds unknown to the existence cache are checked by indexed groupId IN (...) queries,
+    without loading rows into the session, and the ones found are kept by the cache.
+    """
+    cache = existence_caches.get(node)
+    if cache is None:
+        existing, unknown, missing = set(), group_ids, 0
+        generation = 0
     else:
-        raise NotAcceptable("Invalid Request, missing groupId in body")
+        existing, unknown, missing = cache.lookup_many(group_ids)
+        generation = cache.generation
+        for result, count in (
+            ("exists", len(existing)),
+            ("missing", missing),
+            ("miss", len(unknown)),
+        ):
+            if count:
+                existence_lookups_total.inc(node, result, amount=count)
+    found = set()
+    for chunk in chunks(unknown):
+        found.update(
+            group_id
+            for (group_id,) in db.session.query(Group.groupId).filter(
+                Group.groupId.in_(chunk)
+            )
+        )
+    if cache is not None:
+        for group_id in found:
+            cache.remember(group_id, generation)
+        if cache.ready and len(found) < len(unknown):
+            existence_false_positives_total.inc(node, amount=len(unknown) - len(found))
+    return existing | found
 
 
 @app.route("/stats", methods=["GET"])
@@ -80,8 +589,10 @@ def statistics():
     """
     Function shows statistics of the group records in each group, and helps user to do quick checks.
     Functionality:
-        1. Compares groups' groupIds together in unordered form (set) -> True/False
-        2. Calculates the number of records in each node -> Dictionary
+        1. Compares groups' groupIds together in unordered form (equal counts and digests) -> True/False
+        2. Returns the number of records in each node -> Dictionary
+    Statistics are read from NodeStats counters, kept up to date by every write.
+    With full=1 query parameter, counters are recounted from node tables and repaired.
     Output looks like following
         [bool, {
             "node01": count_1,
@@ -90,28 +601,252 @@ def statistics():
                }
         ]
     """
-    group_1 = Group1.query.all()
-    group_2 = Group2.query.all()
-    group_3 = Group3.query.all()
-    group_1_ids = [record.groupId for record in group_1]
-    group_2_ids = [record.groupId for record in group_2]
-    group_3_ids = [record.groupId for record in group_3]
+    if request.args.get("full") in ("1", "true"):
+        stats = [recount_node_stats(node) for node in hosts]
+        db.session.commit()
+    else:
+        stats = [
+            db.session.execute(
+                select(NodeStats).where(NodeStats.node == node),
+                bind_arguments=node_bind(node),
+            ).scalar_one()
+            for node in hosts
+        ]
 
     return (
-        json.dumps(
+        app.json.dumps(
             [
-                set(group_1_ids) == set(group_2_ids) == set(group_3_ids),
-                {
-                    "node01": len(group_1),
-                    "node02": len(group_2),
-                    "node03": len(group_3),
-                },
+                len({(s.count, s.digest) for s in stats}) == 1,
+                {s.node: s.count for s in sorted(stats, key=lambda s: s.node)},
             ]
         ),
         200,
     )
 
 
+@app.route("/tree", methods=["GET"])
+def tree():
+    """
+    Hash tree of the node's groupIds, used for comparing nodes and finding divergent groups.
+    Leaves of the tree are 2**TREE_LEAF_BITS hash buckets (see models.NodeBucket),
+    each level splits a bucket into 2**TREE_FANOUT_BITS children,
+    so bucket b of level L is the parent of buckets b*16..b*16+15 of level L+1.
+    Query parameters:
+        level  -> tree level, 0 (root) .. TREE_DEPTH (leaves)
+        prefix -> optional, repeatable. Bucket of level-1, children of which should be returned.
+                  If missing, all buckets of the level are returned
+    Output looks like following, only non empty buckets are returned
+        {"depth": 4, "level": 1, "buckets": {"<bucket>": [count, digest], ...}}
+    """
+    node = request.headers.get("node")
+    get_node_model(node)
+    try:
+        level = int(request.args.get("level", 0))
+        prefixes = [int(prefix) for prefix in request.args.getlist("prefix")]
+    except ValueError:
+        raise NotAcceptable("Invalid Request, level and prefix should be integers")
+    if not 0 <= level <= TREE_DEPTH:
+        raise NotAcceptable(
+            f"Invalid Request, level should be in range 0..{TREE_DEPTH}"
+        )
+
+    bucket = NodeBucket.bucket.op(">>")(TREE_LEAF_BITS - level * TREE_FANOUT_BITS)
+    query = select(
+        bucket, func.sum(NodeBucket.count), func.sum(NodeBucket.digest)
+    ).where(NodeBucket.node == node, NodeBucket.count > 0)
+    if prefixes and level > 0:
+        parent = NodeBucket.bucket.op(">>")(
+            TREE_LEAF_BITS - (level - 1) * TREE_FANOUT_BITS
+        )
+        query = query.where(parent.in_(prefixes))
+    buckets = {
+        str(b): [count, digest % BUCKET_DIGEST_MODULUS]
+        for b, count, digest in db.session.execute(
+            query.group_by(bucket), bind_arguments=node_bind(node)
+        )
+    }
+    return {"depth": TREE_DEPTH, "level": level, "buckets": buckets}, 200
+
+
+@app.route("/tree/groups", methods=["GET"])
+def tree_groups():
+    """
+    Contents of the leaf buckets of the node's hash tree.
+    Query parameters:
+        bucket -> repeatable, leaf bucket (level TREE_DEPTH)
+    Output looks like following
+        {"<bucket>": [groupId, ...], ...}
+    """
+    Group = get_node_model(request.headers.get("node"))
+    try:
+        buckets = [int(bucket) for bucket in request.args.getlist("bucket")]
+    except ValueError:
+        raise NotAcceptable("Invalid Request, bucket should be integer")
+    groups = {str(bucket): [] for bucket in buckets}
+    for group_id, bucket in db.session.query(Group.groupId, Group.bucket).filter(
+        Group.bucket.in_(buckets)
+    ):
+        groups[str(bucket)].append(group_id)
+    return groups, 200
+
+
+def idempotency_key() -> Optional[str]:
+    """
+    Returns Idempotency-Key header of the write request, None if it is missing
+    Exceptions:
+        NotAcceptable:
+            Raises exception if the key is longer than 255 characters
+    """
+    return checked_idempotency_key(request.headers.get("Idempotency-Key"))
+
+
+def idempotent_write(
+    node: str, key: Optional[str], digest: str, write: Callable[[], Any]
+) -> Tuple[Any, bool]:
+    """
+    Calls write() in the transaction in progress once per Idempotency-Key of the node.
+    Key is inserted before the write, INSERT takes the write lock of the node database,
+    so of concurrent requests with the same key only the first applies the write, the others
+    wait for its commit and find its result. Result is stored in the same transaction as the write,
+    so it is recorded if and only if the write is committed.
+    Returns:
+        (result of write(), False) or (stored result, True) if the key was used before
+    Exceptions:
+        UnprocessableEntity:
+            Raises exception if the key was used by a different write
+    """
+    if key is None:
+        return write(), False
+    bind = node_bind(node)
+    claimed = db.session.execute(claim_key(node, key, digest), bind_arguments=bind)
+    if not claimed.rowcount:
+        stored = db.session.execute(stored_key(node, key), bind_arguments=bind).one()
+        return replayed_result(stored, key, digest), True
+    result = write()
+    db.session.execute(store_result(node, key, result), bind_arguments=bind)
+    return result, False
+
+
+def expire_idempotency_keys(node: str):
+    """
+    Removes idempotency keys of the node older than IDEMPOTENCY_KEY_TTL seconds,
+    at most once per IDEMPOTENCY_KEY_EXPIRE_INTERVAL seconds, in its own transaction
+    (see expired_keys)
+    """
+    statement = expired_keys(node, app.config)
+    if statement is None:
+        return
+    db.session.execute(statement, bind_arguments=node_bind(node))
+    db.session.commit()
+
+
+def insert_group(Group, group_id: str, timestamp: Optional[float]) -> bool:
+    """
+    Inserts group record by INSERT ... ON CONFLICT (groupId) DO NOTHING.
+    Returns False if the record exists
+    """
+    values = {"groupId": group_id}
+    if timestamp:
+        values["timestamp"] = timestamp
+    result = db.session.execute(
+        insert(Group)
+        .values(**values)
+        .on_conflict_do_nothing(index_elements=["groupId"])
+    )
+    return bool(result.rowcount)
+
+
+def remove_group(Group, group_id: str, timestamp: Optional[float]) -> bool:
+    """
+    Deletes group record by groupId, and by timestamp if it is given.
+    Returns False if no record was found
+    """
+    if timestamp:
+        query = Group.query.filter_by(groupId=group_id, timestamp=timestamp)
+    else:
+        query = Group.query.filter_by(groupId=group_id)
+    deleted = query.delete(synchronize_session=False)
+    if deleted and timestamp:
+        logger.info("Deleted group %s %s", timestamp, group_id)
+    return bool(deleted)
+
+
+def apply_writes(
+    writes: List[Tuple[str, str, str, Optional[float], Optional[str]]],
+) -> List[Any]:
+    """
+    Applies writes ("create"/"delete", node, groupId, timestamp, idempotency key) in order,
+    in one transaction, statistics of every node are updated once per batch.
+    Returns list of results of insert_group/remove_group, replayed for known idempotency keys,
+    UnprocessableEntity for keys used by a different write
+    """
+    changes = defaultdict(lambda: ([], []))  # node -> (inserted, deleted) groupIds
+    results = []
+    try:
+        for action, node, group_id, timestamp, key in writes:
+            Group = hosts[node]
+            apply = insert_group if action == "create" else remove_group
+            try:
+                done, replayed = idempotent_write(
+                    node,
+                    key,
+                    write_digest(action, [group_id], timestamp),
+                    lambda: apply(Group, group_id, timestamp),
+                )
+            except UnprocessableEntity as e:
+                results.append(e)
+                continue
+            if done and not replayed:
+                inserted, deleted = changes[node]
+                (inserted if action == "create" else deleted).append(group_id)
+            results.append(done)
+        for node, (inserted, deleted) in changes.items():
+            update_node_stats(node, inserted, 1)
+            update_node_stats(node, deleted, -1)
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+    return results
+
+
+# Every node has its own database, so writes of different nodes are coalesced
+# and committed independently of each other
+coalescers = {
+    node: WriteCoalescer(
+        apply_writes,
+        window=app.config.get("WRITE_COALESCE_WINDOW", 0.0),
+        max_batch=app.config.get("WRITE_COALESCE_MAX_BATCH", 128),
+    )
+    for node in hosts
+}
+
+
+def write_group(
+    action: str,
+    node: str,
+    group_id: str,
+    timestamp: Optional[float],
+    key: Optional[str] = None,
+) -> bool:
+    """
+    Applies create/delete write of /group endpoint.
+    With WRITE_COALESCING concurrent writes are applied by WriteCoalescer in shared
+    transactions (group commit), otherwise every write is committed on its own.
+    Write with idempotency key is applied once, its retries get the result of the first one.
+    """
+    write = (action, node, group_id, timestamp, key)
+    if app.config.get("WRITE_COALESCING", True):
+        result = coalescers[node].submit(write)
+    else:
+        result = apply_writes([write])[0]
+    expire_idempotency_keys(node)
+    refresh_existence_cache(node)
+    if isinstance(result, HTTPException):
+        raise result
+    return result
+
+
 @app.route("/group", methods=["POST", "DELETE"])
 @app.route("/group/<groupId>", methods=["GET"])
 def group(groupId: Optional[str] = None):
@@ -121,10 +856,12 @@ def group(groupId: Optional[str] = None):
         POST   -> For creating group in node
         DELETE -> Fore deleting group from node
         GET    -> For returning group data from node
+    POST and DELETE with Idempotency-Key header are applied once per key and node,
+    retry with the same key gets the response of the first request (see idempotent_write).
     Args:
         groupId: Mandatory only for GET request
     """
-    random_exception()  # Unstable connection imitation
+    inject_faults()  # Unstable connection imitation
     node = request.headers.get(
         "node"
     )  # node parameter in headers replaces running 3 separate servers (nodes)
@@ -134,27 +871,15 @@ def group(groupId: Optional[str] = None):
     if timestamp:
         timestamp = float(timestamp)
 
-    if node is None:
-        raise NotAcceptable("provide node parameter in request headers")
-
-    Group = hosts.get(node)  # take Group Model corresponding to the node
-    if Group is None:
-        raise NotAcceptable(
-            f"node {node} is not configured. Available nodes {list(hosts.keys())}"
-        )
-
-    groups = Group.query.all()
-    logger.debug(groups)
-    if groups:
-        logger.debug([(g.id, g.groupId) for g in Group.query.all()])
+    Group = get_node_model(node)
 
     if request.method == "GET":
         """
-        Checking of existence of the group record by given groupId
+        Checking of existence of the group record by given groupId (see existing_groups),
+        missing and recently seen groupIds are answered by the existence cache.
         Afterwards returns response containing groupId or raises NotFound Exception
         """
-        group = Group.query.filter_by(groupId=groupId).first()
-        if group:
+        if groupId in existing_groups(node, Group, [groupId]):
             return {"groupId": groupId}, 200
         else:
             raise NotFound(f"No group record found with id '{groupId}'")
@@ -162,22 +887,15 @@ def group(groupId: Optional[str] = None):
     if request.method == "DELETE":
         """
         This method uses for deleting a group record from the table.
-        If timestamp was provided it will first query by given groupId and given timestamp,
-        otherwise will query only by groupId.
-        If corresponding group record found it will delete group record from the table
-        otherwise will raise Not Found error
+        If timestamp was provided it will delete by given groupId and given timestamp
+        (served by (groupId, timestamp) index), otherwise only by groupId.
+        Deletion is done by one DELETE statement (see write_group), if no row was affected
+        it will raise Not Found error. The existence cache is not asked, the database decides
         """
         body = parse_body()
         group_id = body["groupId"]
-        if timestamp:
-            group = Group.query.filter_by(groupId=group_id, timestamp=timestamp).first()
-            if group:
-                logger.info("Will delete group %s %s", group.timestamp, group.groupId)
-        else:
-            group = Group.query.filter_by(groupId=group_id).first()
-        if group:
-            db.session.delete(group)
-            db.session.commit()
+        key = idempotency_key()
+        if write_group("delete", node, group_id, timestamp, key):
             return "OK\n", 200
         else:
             if timestamp:
@@ -190,48 +908,413 @@ def group(groupId: Optional[str] = None):
     if request.method == "POST":
         """
         This method uses for creating a group record from the table.
-        First it queries for a group by groupId and if group found it will raise
-        BadRequest (400) error, because object exists in the table.
-        Otherwise if timestamp was provided it will create group object by specifying
-        groupId and timestamp, if not provided only by groupId, and will add to the table.
+        Record is inserted by INSERT ... ON CONFLICT (groupId) DO NOTHING (see write_group),
+        so existence check and insertion are one statement. If no row was inserted,
+        object exists in the table and it will raise BadRequest (400) error.
+        If timestamp was provided it will create group object by specifying
+        groupId and timestamp, if not provided only by groupId.
         Here, also in case of DELETE I introduced timestamp parameter for differentiation object
         that created during one procedure from objects that are there before.
+        The existence cache is not asked, the same as in DELETE.
         """
         body = parse_body()
         group_id = body["groupId"]
-        group = Group.query.filter_by(groupId=group_id).first()
-        if group:
+        key = idempotency_key()
+        if not write_group("create", node, group_id, timestamp, key):
             raise BadRequest("Perhaps the object exists.")
+        return "CREATED\n", 201
+
+
+@app.route("/groups", methods=["POST", "DELETE"])
+def groups():
+    """
+    Batch version of /group endpoint.
+    Body contains list of groupIds ({"groupIds": [...]}) which are created or deleted
+    in one transaction, so the whole batch costs one round trip and one commit.
+    It accepts following request methods
+        POST   -> For creating groups in node
+        DELETE -> For deleting groups from node
+    Response is a map of per groupId statuses, same codes that /group returns for a single record
+        POST   -> 201 created, 400 exists
+        DELETE -> 200 deleted, 404 not found
+    With Idempotency-Key header the batch is applied once per key and node, the same as in /group.
+    """
+    inject_faults()  # Unstable connection imitation
+    node = request.headers.get("node")
+    Group = get_node_model(node)
+    timestamp = request.headers.get("timestamp")
+    if timestamp:
+        timestamp = float(timestamp)
+    group_ids = parse_batch_body()
+    key = idempotency_key()
+    write = create_groups if request.method == "POST" else delete_groups
+    statuses, _ = idempotent_write(
+        node,
+        key,
+        # differs from the digest of /group writes, keys of the endpoints can't be mixed up
+        write_digest(write.__name__, group_ids, timestamp),
+        lambda: write(node, Group, group_ids, timestamp),
+    )
+    db.session.commit()
+    expire_idempotency_keys(node)
+    refresh_existence_cache(node)
+    return statuses, 200
+
+
+def create_groups(
+    node: str, Group, group_ids: List[str], timestamp: Optional[float]
+) -> Dict[str, int]:
+    """
+    POST method of /groups endpoint, in the transaction of the request.
+    Every groupId is inserted by insert_group, so a group inserted by a concurrent writer
+    is reported with 400 and is not counted, the same as in POST of /group endpoint.
+    """
+    statuses: Dict[str, int] = {}
+    inserted = []
+    for group_id in group_ids:
+        if group_id in statuses:
+            continue
+        created, exists = BATCH_STATUSES["create"]
+        if insert_group(Group, group_id, timestamp):
+            statuses[group_id] = created
+            inserted.append(group_id)
         else:
-            if timestamp:
-                group = Group(groupId=group_id, timestamp=timestamp)
-            else:
-                group = Group(groupId=group_id)
-            db.session.add(group)
-            db.session.commit()
-            return "CREATED\n", 201
+            statuses[group_id] = exists
+    update_node_stats(node, inserted, 1)
+    return statuses
+
+
+def delete_groups(
+    node: str, Group, group_ids: List[str], timestamp: Optional[float]
+) -> Dict[str, int]:
+    """
+    DELETE method of /groups endpoint, in the transaction of the request.
+    Every groupId is deleted by remove_group, by timestamp if it was provided, the same as
+    in DELETE of /group endpoint, so only rows actually deleted are counted.
+    Missing groups are reported with 404.
+    """
+    statuses: Dict[str, int] = {}
+    deleted = []
+    for group_id in group_ids:
+        if group_id in statuses:
+            continue
+        removed, missing = BATCH_STATUSES["delete"]
+        if remove_group(Group, group_id, timestamp):
+            statuses[group_id] = removed
+            deleted.append(group_id)
+        else:
+            statuses[group_id] = missing
+    update_node_stats(node, deleted, -1)
+    return statuses
+
+
+@app.route("/groups", methods=["GET"])
+def list_groups():
+    """
+    Streams groupIds and timestamps of the node as NDJSON, one record per line
+        {"id": 1, "groupId": "1", "timestamp": 1650000000.0}
+    with keyset pagination: records are read by indexed "WHERE key > cursor ORDER BY key"
+    queries of GROUP_LIST_CHUNK rows, so memory use doesn't depend on the table size,
+    and a listing which broke off is continued from the last received record.
+    Query parameters:
+        order -> "id" (default) or "groupId", key of the order and of the cursor
+        after -> optional, cursor: id or groupId of the last received record
+        limit -> optional, maximum number of records, all records after the cursor if missing
+    """
+    Group = get_node_model(request.headers.get("node"))
+    order = request.args.get("order", "id")
+    if order not in ("id", "groupId"):
+        raise NotAcceptable("Invalid Request, order should be id or groupId")
+    after = request.args.get("after")
+    limit = request.args.get("limit")
+    try:
+        if after is not None and order == "id":
+            after = int(after)
+        if limit is not None:
+            limit = int(limit)
+    except ValueError:
+        raise NotAcceptable("Invalid Request, after and limit should be integers")
+    if limit is not None and limit < 1:
+        raise NotAcceptable("Invalid Request, limit should be positive")
+
+    def records() -> Iterator[str]:
+        for id, group_id, timestamp in iterate_groups(Group, order, after, limit):
+            yield json.dumps(
+                {"id": id, "groupId": group_id, "timestamp": timestamp}
+            ) + "\n"
+
+    return Response(
+        stream_with_context(records()), 200, mimetype="application/x-ndjson"
+    )
+
+
+def iterate_groups(
+    Group,
+    order: str,
+    after: Optional[Any] = None,
+    limit: Optional[int] = None,
+    consistent: bool = False,
+) -> Iterator[Any]:
+    """
+    Yields (id, groupId, timestamp) rows of the node table ordered by id or groupId,
+    read by keyset queries of GROUP_LIST_CHUNK rows.
+    Read transaction is ended after every chunk, so a long iteration doesn't hold back
+    checkpoints of the WAL. With consistent=True one read transaction is kept for the whole
+    iteration, so rows are a point in time snapshot of the table.
+    """
+    chunk = app.config.get("GROUP_LIST_CHUNK", 1000)
+    key = getattr(Group, order)
+    cursor = after
+    remaining = limit
+    try:
+        while remaining is None or remaining > 0:
+            query = db.session.query(Group.id, Group.groupId, Group.timestamp)
+            if cursor is not None:
+                query = query.filter(key > cursor)
+            size = chunk if remaining is None else min(chunk, remaining)
+            rows = query.order_by(key).limit(size).all()
+            if not consistent:
+                db.session.rollback()
+            yield from rows
+            if len(rows) < size:
+                break
+            cursor = rows[-1].id if order == "id" else rows[-1].groupId
+            if remaining is not None:
+                remaining -= len(rows)
+    finally:
+        db.session.rollback()
+
+
+@app.route("/snapshot", methods=["GET"])
+def snapshot():
+    """
+    Streams binary snapshot of the node table (see snapshot.py), records sorted by groupId.
+    Records are read in one read transaction, so the snapshot is consistent,
+    and encoded block by block while they are read, so memory use doesn't depend on the table size.
+    """
+    Group = get_node_model(request.headers.get("node"))
+    records = (
+        (group_id, timestamp)
+        for _, group_id, timestamp in iterate_groups(Group, "groupId", consistent=True)
+    )
+    return Response(
+        stream_with_context(encode_snapshot(records)),
+        200,
+        mimetype="application/octet-stream",
+    )
+
+
+@app.route("/snapshot", methods=["PUT"])
+def restore():
+    """
+    Loads binary snapshot from the request body into the node table.
+    Body is read as a stream, block by block, and records are bulk inserted by
+    INSERT ... ON CONFLICT (groupId) DO NOTHING in transactions of SNAPSHOT_RESTORE_BATCH records.
+    Statistics of the node are recounted at the end, in one pass over the table, which is cheaper
+    than updating them by every transaction, as nearly every batch touches all buckets.
+    In replace mode secondary indexes of the table (bucket, groupId with timestamp) are dropped
+    with the records and built once after the load, which is cheaper than updating them
+    by every insert, queries which use them (/tree) scan the table during the restore.
+    Query parameters:
+        mode -> "replace" (default): records of the node are deleted first, in the first transaction,
+                "merge": only records missing in the node are inserted
+    Output looks like following
+        {"records": records in the snapshot, "inserted": inserted records, "deleted": deleted records}
+    Exceptions:
+        BadRequest:
+            Raises exception if the snapshot is malformed, truncated or corrupted,
+            batches committed before stay, the node should be restored again
+    """
+    node = request.headers.get("node")
+    Group = get_node_model(node)
+    mode = request.args.get("mode", "replace")
+    if mode not in ("replace", "merge"):
+        raise NotAcceptable("Invalid Request, mode should be replace or merge")
+    batch_size = app.config.get("SNAPSHOT_RESTORE_BATCH", 50000)
+    # rows are passed to the driver as tuples, without compiling parameters of every row
+    statement = (
+        f'INSERT INTO {Group.__tablename__} ("groupId", timestamp, bucket) '
+        'VALUES (?, ?, ?) ON CONFLICT ("groupId") DO NOTHING'
+    )
+    indexes = list(Group.__table__.indexes) if mode == "replace" else []
+    result = {"records": 0, "inserted": 0, "deleted": 0}
+
+    def insert_rows(rows: List[Tuple[str, Optional[float], int]]):
+        connection = db.session.connection(bind_arguments=node_bind(node))
+        result["inserted"] += connection.exec_driver_sql(statement, rows).rowcount
+
+    rows = []
+    error = None
+    # records are inserted bypassing the existence cache, it is built again at the end
+    cache = existence_caches.get(node)
+    if cache is not None:
+        cache.invalidate()
+    try:
+        if mode == "replace":
+            result["deleted"] = db.session.execute(delete(Group)).rowcount
+            for index in indexes:
+                index.drop(db.session.connection(bind_arguments=node_bind(node)))
+        for block in read_snapshot(request.stream):
+            result["records"] += len(block)
+            rows.extend(
+                (group_id, timestamp, group_bucket(group_id))
+                for group_id, timestamp in block
+            )
+            if len(rows) >= batch_size:
+                insert_rows(rows)
+                db.session.commit()
+                rows = []
+        if rows:
+            insert_rows(rows)
+    except SnapshotError as e:
+        db.session.rollback()
+        error = BadRequest(f"Invalid snapshot: {e}")
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        # failed restore keeps the committed batches, with indexes and statistics of them
+        for index in indexes:
+            index.create(
+                db.session.connection(bind_arguments=node_bind(node)), checkfirst=True
+            )
+        recount_node_stats(node)
+        db.session.commit()
+        if cache is not None:
+            cache.end_bypass()
+        schedule_existence_rebuild(node)
+    if error is not None:
+        raise error
+    logger.info("Restored %s: %s", node, result)
+    return result, 200
+
+
+@app.route("/groups/exists", methods=["POST"])
+def groups_exist():
+    """
+    Batch version of GET method of /group endpoint.
+    Body contains list of groupIds ({"groupIds": [...]}), their existence in the node
+    is checked by the existence cache and indexed groupId IN (...) queries (see existing_groups).
+    Response is a map of per groupId statuses: 200 exists, 404 not found
+    """
+    inject_faults()  # Unstable connection imitation
+    node = request.headers.get("node")
+    Group = get_node_model(node)
+    group_ids = parse_batch_body()
+
+    existing = existing_groups(node, Group, group_ids)
+    return {
+        group_id: 200 if group_id in existing else 404 for group_id in group_ids
+    }, 200
 
 
-def random_exception():
+def inject_faults():
     """
     Unstable connection imitation.
-    Function is randomly raising exception by choosing from the list of exception
-        [InternalServerError, RequestTimeout]
-    Function has threshold parameter, which is probability of RANDOM behavior.
-    It means if threshold (which is RANDOM_BEHAVIOR env parameter) is 0,
-    function will not have effect, and API will be stable.
-    If no RANDOM_BEHAVIOR provided in environment, by default 0.5 will be taken
-    """
-    random_number = random.random()
-    thresh = app.config.get("RANDOM_BEHAVIOR", 0.5)
-    logger.info("RANDOM_BEHAVIOR %s", thresh)
-    if random_number < thresh:
-        raise random.choice(
-            [
-                InternalServerError("InternalServerError due to Random Behavior"),
-                RequestTimeout("Timeout due to Random Behavior"),
-            ]
+    Faults of the request are decided by the fault profile of the process (see faults.py),
+    set by FAULTS config parameter, by RANDOM_BEHAVIOR probability of 500/408 errors
+    if it is not given, and replaced at runtime by /admin/faults endpoint.
+    Delay is waited and errors are raised here, partial failure and slow drain are applied
+    to the response by apply_response_faults.
+    """
+    node = request.headers.get("node") or ""
+    fault = faults.decide(node, request.method, request.endpoint or "")
+    if fault is None:
+        return
+    labels = (metric_node(), request.method)
+    if fault.delay:
+        injected_faults_total.inc(*labels, "latency")
+        time.sleep(fault.delay)
+        timings = current_timings()
+        if timings is not None:
+            timings.add("fault", fault.delay)
+    if fault.status is not None:
+        error = default_exceptions.get(fault.status, InternalServerError)
+        injected_faults_total.inc(*labels, "outage" if fault.outage else error.__name__)
+        raise error(f"{error.__name__} due to Random Behavior")
+    g.fault = fault
+
+
+@app.after_request
+def apply_response_faults(response: Response) -> Response:
+    """
+    Partial failure: the request was handled, its writes are committed, and it fails with 500.
+    Slow drain: response body is sent at the rate of the fault.
+    Registered after observe_request, so it runs before it and the metrics see the fault
+    """
+    fault = g.pop("fault", None)
+    if fault is None:
+        return response
+    labels = (metric_node(), request.method)
+    if fault.partial and response.status_code < 400:
+        injected_faults_total.inc(*labels, "partial_failure")
+        response = handle_exception(
+            InternalServerError(
+                "InternalServerError due to Random Behavior, the request was applied"
+            )
         )
+    if fault.drain:
+        injected_faults_total.inc(*labels, "slow_drain")
+        response.response = slow_drain(response.response, fault.drain)
+    return response
+
+
+@app.route("/admin/faults", methods=["GET", "PUT", "DELETE"])
+def fault_profile():
+    """
+    Fault profile of the process (see faults.py), switchable at runtime.
+    It accepts following request methods
+        GET    -> Returns the current profile
+        PUT    -> Installs the profile given in the body, its RNG and outage windows start anew
+        DELETE -> Disables fault injection
+    Output looks like following
+        {"profile": profile, "seconds": seconds since the profile was installed}
+    Exceptions:
+        BadRequest:
+            Raises exception if the profile is malformed, the current one stays
+    """
+    if request.method == "PUT":
+        try:
+            faults.configure(request.get_json(force=True))
+        except FaultProfileError as e:
+            raise BadRequest(f"Invalid fault profile: {e}")
+        logger.info("Fault profile set: %s", json.dumps(faults.profile))
+    elif request.method == "DELETE":
+        faults.configure(None)
+        logger.info("Fault injection disabled")
+    return {
+        "profile": faults.profile,
+        "seconds": round(time.monotonic() - faults.started, 3),
+    }, 200
+
+
+@app.route("/admin/profile", methods=["GET", "PUT", "DELETE"])
+def request_profile():
+    """
+    Profiling of the process (see profiling.py), switchable at runtime.
+    It accepts following request methods
+        GET    -> Returns the current settings and capture
+        PUT    -> Changes the settings given in the body, all keys are optional
+                  {"sample_rate": share of responses with Server-Timing header,
+                   "slow_request_seconds": requests as slow are logged, null disables the log,
+                   "requests": cProfile of this number of next requests is captured}
+        DELETE -> Ends the capture, requests captured so far are dumped to a file
+    Output looks like following
+        {"sample_rate": 0.01, "slow_request_seconds": 1.0,
+         "capture": {"requests": 100, "captured": 12, "seconds": 3.2} or null,
+         "last_file": path of the last dumped capture}
+    Exceptions:
+        BadRequest:
+            Raises exception if a setting is malformed, nothing is changed then
+    """
+    if request.method == "PUT":
+        try:
+            profiler.configure(request.get_json(force=True))
+        except ProfilingError as e:
+            raise BadRequest(f"Invalid profiling settings: {e}")
+    elif request.method == "DELETE":
+        profiler.stop()
+    return profiler.status(), 200
 
 
 @app.errorhandler(HTTPException)
@@ -1,35 +1,320 @@
 """
-In this file each Model corresponds to the node.
-    Group1 -> node01
-    Group2 -> node02
-    Group3 -> node03
+In this file each Model corresponds to the node. Models are built from one definition
+(GroupMixin) for every node of NODES config parameter by node_models, e.g.
+    node01 -> table group1
+    node02 -> table group2
+    ...
+
+Every node is kept in its own database, bind key of the model is the node name
+(see SQLALCHEMY_BINDS of the config), so nodes don't share the write lock, and storage
+of one node can be copied or replaced without touching the others.
+
+Every table has unique index on groupId, used by GET and POST,
+and composite index on (groupId, timestamp), used by timestamp qualified DELETE.
+
+NodeStats keeps per node counters, which make /stats independent of the table sizes.
+
+NodeBucket keeps the same counters per hash bucket of groupId. Buckets are the leaves
+of the hash tree served by /tree, which lets nodes be compared level by level.
+
+NodeStats and NodeBucket tables are created in the database of every node, next to the node
+table they describe, so they are updated in the same transaction. Their statements are routed
+to the database of the node by bind_arguments={"bind": engine} (see NodeSession).
+
+IdempotencyKey keeps results of the writes sent with Idempotency-Key header, in the database
+of the node next to the write, so a retried write gets the stored result instead of being applied again.
+
+Statements maintaining NodeStats and NodeBucket (stats_statements, recount_statements) are built here
+and executed by both entry points, the Flask application (main.py) and the async one (asgi.py).
 """
 
-from datetime import datetime
+import hashlib
+import json
+import re
+import time
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type
 
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import delete, orm, update
+from sqlalchemy.dialects.sqlite import insert
 
-db = SQLAlchemy()
 
+class NodeSession(SignallingSession):
+    """
+    Session which also accepts the engine given by bind_arguments={"bind": engine}
+    of execute, which SignallingSession.get_bind ignores.
+    """
 
-class Group1(db.Model):
-    __tablename__ = "group1"
-    id = db.Column(db.Integer, primary_key=True)
-    groupId = db.Column(db.String, unique=True)
-    timestamp = db.Column(db.Float)
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+        return super().get_bind(mapper, clause)
 
 
-class Group2(db.Model):
-    __tablename__ = "group2"
+class NodeSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=NodeSession, db=self, **options)
 
-    id = db.Column(db.Integer, primary_key=True)
-    groupId = db.Column(db.String, unique=True)
-    timestamp = db.Column(db.Float)
+
+db = NodeSQLAlchemy()
+
+# digest is kept below 2**62, so adding a 48 bit hash never overflows SQLite 64 bit integer
+DIGEST_MODULUS = 2**62
+# bucket digest is kept below 2**40, so SUM over all buckets never overflows either
+BUCKET_DIGEST_MODULUS = 2**40
+TREE_FANOUT_BITS = 4  # each tree level splits bucket into 16 children
+TREE_LEAF_BITS = 16  # 65536 leaf buckets
+TREE_DEPTH = TREE_LEAF_BITS // TREE_FANOUT_BITS
 
 
-class Group3(db.Model):
-    __tablename__ = "group3"
+def group_hash(group_id: str) -> int:
+    """
+    Stable 48 bit hash of groupId, building block of NodeStats.digest
+    """
+    return int.from_bytes(
+        hashlib.blake2b(group_id.encode(), digest_size=6).digest(), "big"
+    )
+
+
+def hash_bucket(group_id_hash: int) -> int:
+    """
+    Leaf bucket of groupId by its group_hash, top TREE_LEAF_BITS bits of the hash
+    """
+    return group_id_hash >> (48 - TREE_LEAF_BITS)
+
+
+def group_bucket(group_id: str) -> int:
+    """
+    Leaf bucket of groupId
+    """
+    return hash_bucket(group_hash(group_id))
+
+
+def groups_digest(group_ids: Iterable[str]) -> int:
+    """
+    Order independent digest of the set of groupIds: sum of hashes modulo DIGEST_MODULUS
+    """
+    return sum(group_hash(group_id) for group_id in group_ids) % DIGEST_MODULUS
+
+
+def default_bucket(context) -> int:
+    """
+    Column default of Group.bucket, computed from inserted groupId
+    """
+    return group_bucket(context.get_current_parameters()["groupId"])
+
+
+class GroupMixin:
+    """
+    Definition of the node table, shared by the models of all nodes (see node_models)
+    """
 
     id = db.Column(db.Integer, primary_key=True)
     groupId = db.Column(db.String, unique=True)
-    timestamp = db.Column(db.Float, default=datetime.utcnow().timestamp)
+    timestamp = db.Column(db.Float, default=time.time)
+    bucket = db.Column(db.Integer, index=True, default=default_bucket)
+
+
+def node_table_name(node: str) -> str:
+    """
+    Table of the node: group<N> for node<NN> names, which keeps the tables created when
+    the models of node01..node03 were written by hand, group_<node> for any other name
+    """
+    match = re.fullmatch(r"node0*(\d+)", node)
+    return f"group{match.group(1)}" if match else f"group_{node}"
+
+
+_node_models: Dict[str, Type[GroupMixin]] = {}
+
+
+def node_models(nodes: Iterable[str]) -> Dict[str, Type[GroupMixin]]:
+    """
+    Builds model of every node, bound to the database of the node by bind key equal
+    to the node name. Models are built once per node, repeated calls return the same classes.
+    Returns:
+        node -> Model map, in the order of nodes
+    """
+    models = {}
+    for node in nodes:
+        if node not in _node_models:
+            table = node_table_name(node)
+            _node_models[node] = type(
+                f"Group_{node}",
+                (GroupMixin, db.Model),
+                {
+                    "__tablename__": table,
+                    "__bind_key__": node,
+                    "__table_args__": (
+                        db.Index(
+                            f"ix_{table}_groupId_timestamp", "groupId", "timestamp"
+                        ),
+                    ),
+                },
+            )
+        models[node] = _node_models[node]
+    return models
+
+
+class NodeStats(db.Model):
+    """
+    Statistics of one node table, updated in the same transaction as every insert and delete.
+        count  -> number of group records in the node
+        digest -> groups_digest of groupIds in the node, equal digests mean equal sets of groupIds
+    """
+
+    __tablename__ = "node_stats"
+
+    node = db.Column(db.String, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    digest = db.Column(db.Integer, nullable=False, default=0)
+
+
+class NodeBucket(db.Model):
+    """
+    Statistics of one leaf bucket of the node, maintained together with NodeStats.
+        count  -> number of group records in the bucket
+        digest -> sum of hashes of groupIds in the bucket modulo BUCKET_DIGEST_MODULUS
+    """
+
+    __tablename__ = "node_bucket"
+
+    node = db.Column(db.String, primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    digest = db.Column(db.Integer, nullable=False, default=0)
+
+
+class IdempotencyKey(db.Model):
+    """
+    Write of the node sent with Idempotency-Key header, recorded in the same transaction as the write.
+        key     -> value of Idempotency-Key header
+        request -> digest of the write, key reused by a different write is rejected
+        result  -> JSON of the result of the write, replayed to the retries
+        created -> time of the write, keys older than IDEMPOTENCY_KEY_TTL are removed
+    """
+
+    __tablename__ = "idempotency_key"
+
+    node = db.Column(db.String, primary_key=True)
+    key = db.Column(db.String, primary_key=True)
+    request = db.Column(db.String, nullable=False)
+    result = db.Column(db.Text)
+    created = db.Column(db.Float, nullable=False, index=True, default=time.time)
+
+
+# statement and its parameters, None for statements without them
+Statement = Tuple[Any, Optional[List[Dict[str, Any]]]]
+
+
+def write_digest(action: str, group_ids: List[str], timestamp: Optional[float]) -> str:
+    """
+    Digest of the write, which tells retries of the write from a different write with the same key
+    """
+    return hashlib.blake2b(
+        json.dumps([action, group_ids, timestamp]).encode(), digest_size=16
+    ).hexdigest()
+
+
+def stats_statements(node: str, group_ids: List[str], sign: int) -> List[Statement]:
+    """
+    Statements updating counter and digest of the node and of its buckets by inserted (sign=1)
+    or deleted (sign=-1) groupIds. They must be executed in the same transaction as the write
+    itself, updates are done by UPDATE and UPSERT statements, so concurrent writers can't lose
+    each other's changes.
+    """
+    hashes = [group_hash(group_id) for group_id in group_ids]
+    digest = sum(hashes) % DIGEST_MODULUS  # groups_digest of group_ids
+    delta = digest if sign > 0 else -digest
+    buckets = defaultdict(lambda: [0, 0])
+    for group_id_hash in hashes:
+        bucket = buckets[hash_bucket(group_id_hash)]
+        bucket[0] += sign
+        bucket[1] += sign * group_id_hash
+    upsert = insert(NodeBucket)
+    return [
+        (
+            update(NodeStats)
+            .where(NodeStats.node == node)
+            .values(
+                count=NodeStats.count + sign * len(group_ids),
+                digest=(NodeStats.digest + delta % DIGEST_MODULUS) % DIGEST_MODULUS,
+            )
+            .execution_options(synchronize_session=False),
+            None,
+        ),
+        (
+            upsert.on_conflict_do_update(
+                index_elements=["node", "bucket"],
+                set_={
+                    "count": NodeBucket.count + upsert.excluded.count,
+                    "digest": (NodeBucket.digest + upsert.excluded.digest)
+                    % BUCKET_DIGEST_MODULUS,
+                },
+            ),
+            [
+                {
+                    "node": node,
+                    "bucket": bucket,
+                    "count": count,
+                    "digest": digest % BUCKET_DIGEST_MODULUS,
+                }
+                for bucket, (count, digest) in buckets.items()
+            ],
+        ),
+    ]
+
+
+def recount_statements(
+    node: str, group_ids: Iterable[str]
+) -> Tuple[NodeStats, List[Statement]]:
+    """
+    Statistics of the node and of its buckets counted from all groupIds of its table,
+    and statements replacing the stored ones. groupIds are consumed one by one,
+    so memory usage doesn't depend on the table size.
+    """
+    count = 0
+    digest = 0
+    buckets = defaultdict(lambda: [0, 0])
+    for group_id in group_ids:
+        group_id_hash = group_hash(group_id)
+        count += 1
+        digest += group_id_hash
+        bucket = buckets[hash_bucket(group_id_hash)]
+        bucket[0] += 1
+        bucket[1] += group_id_hash
+    stats = NodeStats(node=node, count=count, digest=digest % DIGEST_MODULUS)
+    upsert = insert(NodeStats).values(
+        node=stats.node, count=stats.count, digest=stats.digest
+    )
+    statements = [
+        (
+            upsert.on_conflict_do_update(
+                index_elements=["node"],
+                set_={"count": upsert.excluded.count, "digest": upsert.excluded.digest},
+            ),
+            None,
+        ),
+        (
+            delete(NodeBucket)
+            .where(NodeBucket.node == node)
+            .execution_options(synchronize_session=False),
+            None,
+        ),
+    ]
+    if buckets:
+        statements.append(
+            (
+                NodeBucket.__table__.insert(),
+                [
+                    {
+                        "node": node,
+                        "bucket": bucket,
+                        "count": count,
+                        "digest": digest % BUCKET_DIGEST_MODULUS,
+                    }
+                    for bucket, (count, digest) in buckets.items()
+                ],
+            )
+        )
+    return stats, statements
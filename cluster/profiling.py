@@ -0,0 +1,309 @@
+"""
+Profiling of the API process under real load, switchable at runtime (/admin/profile).
+
+Timing breakdown: time of a request is split by phases
+    routing:   from the start of the request until its view is called (request context,
+               URL matching, before_request hooks)
+    fault:     latency injected by the fault profile (faults.py)
+    db:        execution of SQL statements
+    commit:    commit of sessions, statements flushed by the commit are counted in db
+    serialize: encoding of JSON responses
+    app:       the rest, code of the view, ORM objects built from rows, logging
+sample_rate of responses get the breakdown in Server-Timing header (milliseconds), and requests
+which took slow_seconds or longer are logged with it, so every request is timed while
+slow_seconds is set. Time is measured until the response is returned, streamed bodies are sent
+afterwards. Writes coalesced into one transaction (coalescer.py) are timed in the request
+of the batch leader, which applies them.
+
+Capture: cProfile of the next N requests of the process, dumped to a file in pstats format
+when they are done (python -m pstats file). Requests are captured one at a time, a request
+starting while another one is captured is not counted. With the gevent worker other requests
+run while the captured one waits for IO, and their code is recorded too, so the profile shows
+what the process spends time on under load, not only the captured requests.
+/admin and /metrics requests are never captured. Every gunicorn worker process has its own
+profiler, there is one (gunicorn_conf.py).
+"""
+
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from flask import has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+
+logger = logging.getLogger(__name__)
+
+TIMINGS_KEY = "cluster.timings"  # WSGI environ key of Timings of the request
+PHASES = ("routing", "fault", "db", "commit", "serialize")  # "app" is the rest
+EXCLUDED_PATHS = ("/admin/", "/metrics")  # paths which are never captured
+
+
+class ProfilingError(ValueError):
+    """Profiling settings are malformed"""
+
+
+def is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class Timings:
+    """Time of one request by phases, see the module docstring"""
+
+    __slots__ = ("started", "phases", "sampled")
+
+    def __init__(self, sampled: bool = False):
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.sampled = sampled  # the response gets Server-Timing header
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, phase: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - started)
+
+    def mark(self, phase: str):
+        """Time since the start of the request not counted in other phases goes to phase"""
+        self.add(phase, time.perf_counter() - self.started - sum(self.phases.values()))
+
+    def breakdown(self) -> Dict[str, float]:
+        """Seconds of every phase and "app" and "total" until now"""
+        total = time.perf_counter() - self.started
+        phases = {phase: self.phases.get(phase, 0.0) for phase in PHASES}
+        phases["app"] = max(total - sum(phases.values()), 0.0)
+        phases["total"] = total
+        return phases
+
+    @staticmethod
+    def server_timing(breakdown: Dict[str, float]) -> str:
+        return ", ".join(
+            f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in breakdown.items()
+        )
+
+
+def current_timings() -> Optional[Timings]:
+    """Timings of the current request, None outside of requests and for untimed ones"""
+    if not has_request_context():
+        return None
+    return request.environ.get(TIMINGS_KEY)
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """JSON provider of the application, encoding of responses is timed as serialize"""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        timings = current_timings()
+        if timings is None:
+            return super().dumps(obj, **kwargs)
+        with timings.phase("serialize"):
+            return super().dumps(obj, **kwargs)
+
+
+class Capture:
+    """cProfile capture of requests, armed by requests setting of RequestProfiler"""
+
+    def __init__(self, requests: int):
+        self.profile = cProfile.Profile()
+        self.requested = requests
+        self.remaining = requests
+        self.captured = 0
+        self.active = False
+        self.started = time.time()
+
+
+class RequestProfiler:
+    """
+    Timing breakdown and cProfile capture of requests, see the module docstring.
+    Args:
+        sample_rate: share of responses with Server-Timing header
+        slow_seconds: requests taking this or longer are logged with their breakdown,
+                      None disables the log
+        directory: directory of the capture files
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = 0.0,
+        slow_seconds: Optional[float] = None,
+        directory: str = "profiles",
+    ):
+        self._lock = threading.Lock()
+        self.directory = directory
+        self.sample_rate = 0.0
+        self.slow_seconds: Optional[float] = None
+        self._capture: Optional[Capture] = None
+        self.last_file: Optional[str] = None
+        self.configure(
+            {"sample_rate": sample_rate, "slow_request_seconds": slow_seconds}
+        )
+
+    def configure(self, settings: Dict[str, Any]):
+        """
+        Changes the settings given, keys are optional:
+            sample_rate:          share of responses with Server-Timing header
+            slow_request_seconds: slow_seconds, null disables the log of slow requests
+            requests:             cProfile of this number of next requests is captured,
+                                  a capture in progress is dumped
+        Exceptions:
+            ProfilingError:
+                Raises exception if the settings are malformed, nothing is changed then
+        """
+        if not isinstance(settings, dict):
+            raise ProfilingError("Settings should be an object")
+        unknown = set(settings) - {"sample_rate", "slow_request_seconds", "requests"}
+        if unknown:
+            raise ProfilingError(f"Unknown keys of settings: {sorted(unknown)}")
+        sample_rate = settings.get("sample_rate", self.sample_rate)
+        if not is_number(sample_rate) or not 0 <= sample_rate <= 1:
+            raise ProfilingError(
+                f"sample_rate should be a number from 0 to 1, got {sample_rate!r}"
+            )
+        slow_seconds = settings.get("slow_request_seconds", self.slow_seconds)
+        if slow_seconds is not None and (
+            not is_number(slow_seconds) or slow_seconds < 0
+        ):
+            raise ProfilingError(
+                "slow_request_seconds should be a non negative number or null, "
+                f"got {slow_seconds!r}"
+            )
+        requests = settings.get("requests")
+        if requests is not None and (
+            isinstance(requests, bool) or not isinstance(requests, int) or requests < 1
+        ):
+            raise ProfilingError(
+                f"requests should be a positive integer, got {requests!r}"
+            )
+        self.sample_rate = float(sample_rate)
+        self.slow_seconds = slow_seconds
+        if requests is not None:
+            self.stop()
+            with self._lock:
+                self._capture = Capture(requests)
+            logger.info("Capturing profile of the next %d requests", requests)
+
+    def start_timings(self) -> Optional[Timings]:
+        """Timings of a new request, None if it is not timed"""
+        sampled = bool(self.sample_rate) and random.random() < self.sample_rate
+        if sampled or self.slow_seconds is not None:
+            return Timings(sampled)
+        return None
+
+    def report(
+        self, timings: Timings, method: str, path: str, status: int
+    ) -> Optional[str]:
+        """
+        Logs the breakdown of a slow request.
+        Returns:
+            value of Server-Timing header if the response is sampled, None otherwise
+        """
+        breakdown = timings.breakdown()
+        if self.slow_seconds is not None and breakdown["total"] >= self.slow_seconds:
+            logger.warning(
+                "Slow request %s %s %d: %s",
+                method,
+                path,
+                status,
+                " ".join(
+                    f"{phase}={seconds * 1000:.1f}ms"
+                    for phase, seconds in breakdown.items()
+                ),
+            )
+        return Timings.server_timing(breakdown) if timings.sampled else None
+
+    def stop(self) -> Optional[str]:
+        """
+        Ends the capture in progress, requests captured so far are dumped.
+        Returns:
+            path of the file, None if no request was captured or one is being captured,
+            it is dumped when the request ends
+        """
+        with self._lock:
+            capture = self._capture
+            self._capture = None
+            if capture is None:
+                return None
+            capture.remaining = 0
+            if capture.active:
+                return None
+        return self._dump(capture)
+
+    def status(self) -> Dict[str, Any]:
+        capture = self._capture
+        return {
+            "sample_rate": self.sample_rate,
+            "slow_request_seconds": self.slow_seconds,
+            "capture": (
+                {
+                    "requests": capture.requested,
+                    "captured": capture.captured,
+                    "seconds": round(time.time() - capture.started, 3),
+                }
+                if capture is not None
+                else None
+            ),
+            "last_file": self.last_file,
+        }
+
+    def _begin(self, path: str) -> Optional[Capture]:
+        if self._capture is None or path.startswith(EXCLUDED_PATHS):
+            return None
+        with self._lock:
+            capture = self._capture
+            if capture is None or capture.active or capture.remaining <= 0:
+                return None
+            capture.remaining -= 1
+            capture.active = True
+        capture.profile.enable()
+        return capture
+
+    def _end(self, capture: Capture):
+        capture.profile.disable()
+        with self._lock:
+            capture.active = False
+            capture.captured += 1
+            if capture.remaining > 0:
+                return
+            if self._capture is capture:
+                self._capture = None
+        self._dump(capture)
+
+    def _dump(self, capture: Capture) -> Optional[str]:
+        if not capture.captured:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(
+            self.directory,
+            f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+            f"-{capture.captured}.prof",
+        )
+        capture.profile.dump_stats(path)
+        self.last_file = path
+        logger.info("Profile of %d requests is written to %s", capture.captured, path)
+        return path
+
+    def wrap(self, wsgi_app: Callable) -> Callable:
+        """WSGI middleware starting Timings and captures of requests"""
+
+        def profiled_app(environ, start_response):
+            timings = self.start_timings()
+            if timings is not None:
+                environ[TIMINGS_KEY] = timings
+            capture = self._begin(environ.get("PATH_INFO", ""))
+            if capture is None:
+                return wsgi_app(environ, start_response)
+            try:
+                return wsgi_app(environ, start_response)
+            finally:
+                self._end(capture)
+
+        return profiled_app
@@ -0,0 +1,235 @@
+"""
+Binary snapshot of a node table.
+
+Records (groupId, timestamp) are sorted by groupId and packed into blocks, so a snapshot
+is written and read as a stream of blocks, one block in memory at a time, and a snapshot file
+can be memory-mapped and searched through the block index at its end (SnapshotFile).
+All integers are little-endian.
+
+    header   MAGIC
+    block    BLOCK_HEADER (records, payload size, crc32 of payload) + payload,
+             payload is a sequence of RECORD_HEADER (timestamp, size of groupId) + groupId in UTF-8,
+             NaN timestamp stands for NULL
+    ...
+    end      BLOCK_HEADER of 0 records
+    index    INDEX_ENTRY (offset of the block header, records) of every block
+    trailer  TRAILER (records, blocks, offset of the index, MAGIC)
+"""
+
+import math
+import mmap
+import struct
+import zlib
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+MAGIC = b"GRPSNAP1"
+BLOCK_HEADER = struct.Struct("<III")
+RECORD_HEADER = struct.Struct("<dH")
+INDEX_ENTRY = struct.Struct("<QI")
+TRAILER = struct.Struct("<QQQ8s")
+BLOCK_RECORDS = 4096  # records in one block
+MAX_GROUP_ID_SIZE = 0xFFFF  # bytes of groupId which fit into RECORD_HEADER
+
+Record = Tuple[str, Optional[float]]
+
+
+class SnapshotError(ValueError):
+    """
+    Raised when the snapshot is malformed, truncated or corrupted
+    """
+
+    pass
+
+
+def encode_block(records: List[Record]) -> bytes:
+    """
+    Returns block of the records, with its header
+    """
+    parts = []
+    for group_id, timestamp in records:
+        data = group_id.encode()
+        if len(data) > MAX_GROUP_ID_SIZE:
+            raise SnapshotError(f"groupId {group_id[:32]}... is too long")
+        parts.append(
+            RECORD_HEADER.pack(math.nan if timestamp is None else timestamp, len(data))
+        )
+        parts.append(data)
+    payload = b"".join(parts)
+    return BLOCK_HEADER.pack(len(records), len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_block(payload: bytes, count: int) -> List[Record]:
+    """
+    Returns records of the block payload
+    """
+    records = []
+    position = 0
+    for _ in range(count):
+        timestamp, size = RECORD_HEADER.unpack_from(payload, position)
+        position += RECORD_HEADER.size
+        group_id = payload[position : position + size].decode()
+        position += size
+        records.append((group_id, None if math.isnan(timestamp) else timestamp))
+    if position != len(payload):
+        raise SnapshotError("Block size doesn't match its records")
+    return records
+
+
+def encode_snapshot(
+    records: Iterable[Record], block_records: int = BLOCK_RECORDS
+) -> Iterator[bytes]:
+    """
+    Encodes records, sorted by groupId, into the snapshot format.
+    Yields the header, every block, and the end of the snapshot (end, index and trailer),
+    so it can be streamed while records are read.
+    """
+    yield MAGIC
+    offset = len(MAGIC)
+    index = []
+    total = 0
+    previous = None
+    block = []
+    for record in records:
+        if previous is not None and record[0] <= previous:
+            raise SnapshotError("Records should be sorted by unique groupId")
+        previous = record[0]
+        block.append(record)
+        if len(block) == block_records:
+            data = encode_block(block)
+            index.append(INDEX_ENTRY.pack(offset, len(block)))
+            offset += len(data)
+            total += len(block)
+            block = []
+            yield data
+    if block:
+        data = encode_block(block)
+        index.append(INDEX_ENTRY.pack(offset, len(block)))
+        offset += len(data)
+        total += len(block)
+        yield data
+    yield b"".join(
+        [
+            BLOCK_HEADER.pack(0, 0, 0),
+            *index,
+            TRAILER.pack(total, len(index), offset + BLOCK_HEADER.size, MAGIC),
+        ]
+    )
+
+
+def read_exact(stream: BinaryIO, size: int) -> bytes:
+    """
+    Reads size bytes from the stream, which may return less on one read
+    """
+    chunks = []
+    while size:
+        chunk = stream.read(size)
+        if not chunk:
+            raise SnapshotError("Snapshot is truncated")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_snapshot(stream: BinaryIO) -> Iterator[List[Record]]:
+    """
+    Reads snapshot from the stream sequentially and yields records of every block,
+    after its checksum is verified. Trailer is verified after the last block,
+    SnapshotError is raised if the snapshot is truncated or corrupted.
+    """
+    if read_exact(stream, len(MAGIC)) != MAGIC:
+        raise SnapshotError("Not a snapshot")
+    total = 0
+    blocks = 0
+    while True:
+        count, size, crc = BLOCK_HEADER.unpack(read_exact(stream, BLOCK_HEADER.size))
+        if not count:
+            break
+        payload = read_exact(stream, size)
+        if zlib.crc32(payload) != crc:
+            raise SnapshotError(f"Block {blocks} is corrupted")
+        total += count
+        blocks += 1
+        yield decode_block(payload, count)
+    read_exact(stream, blocks * INDEX_ENTRY.size)
+    records, trailer_blocks, _, magic = TRAILER.unpack(read_exact(stream, TRAILER.size))
+    if magic != MAGIC or (records, trailer_blocks) != (total, blocks):
+        raise SnapshotError("Trailer doesn't match the blocks of the snapshot")
+
+
+class SnapshotFile:
+    """
+    Snapshot file read through memory map. Blocks are located by the index at the end
+    of the file, so a groupId is found by binary search over the first records of the blocks,
+    and only pages of the touched blocks are read from the disk.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < len(MAGIC) + BLOCK_HEADER.size + TRAILER.size or (
+            self._map[: len(MAGIC)] != MAGIC
+        ):
+            self.close()
+            raise SnapshotError(f"{path} is not a snapshot")
+        self.records, blocks, index, magic = TRAILER.unpack_from(
+            self._map, len(self._map) - TRAILER.size
+        )
+        if magic != MAGIC:
+            self.close()
+            raise SnapshotError(f"{path} is truncated")
+        self._index = [
+            INDEX_ENTRY.unpack_from(self._map, index + i * INDEX_ENTRY.size)
+            for i in range(blocks)
+        ]
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.records
+
+    def block(self, i: int) -> List[Record]:
+        """Records of the i-th block, its checksum is verified"""
+        offset, count = self._index[i]
+        _, size, crc = BLOCK_HEADER.unpack_from(self._map, offset)
+        start = offset + BLOCK_HEADER.size
+        payload = self._map[start : start + size]
+        if zlib.crc32(payload) != crc:
+            raise SnapshotError(f"Block {i} of {self.path} is corrupted")
+        return decode_block(payload, count)
+
+    def __iter__(self) -> Iterator[Record]:
+        for i in range(len(self._index)):
+            yield from self.block(i)
+
+    def first_group_id(self, i: int) -> str:
+        """groupId of the first record of the i-th block, read without decoding the block"""
+        start = self._index[i][0] + BLOCK_HEADER.size
+        _, size = RECORD_HEADER.unpack_from(self._map, start)
+        start += RECORD_HEADER.size
+        return self._map[start : start + size].decode()
+
+    def find(self, group_id: str) -> Optional[Record]:
+        """Returns record of the groupId, None if it isn't in the snapshot"""
+        low, high = 0, len(self._index)
+        # last block which first groupId is not greater than group_id
+        while low < high:
+            middle = (low + high) // 2
+            if self.first_group_id(middle) <= group_id:
+                low = middle + 1
+            else:
+                high = middle
+        if not low:
+            return None
+        for record in self.block(low - 1):
+            if record[0] == group_id:
+                return record
+        return None
@@ -0,0 +1,165 @@
+"""
+Write logic shared by the Flask application (main.py) and its async entry point (asgi.py),
+so both serve /group and /groups writes by the same rules: validation of request bodies,
+nodes and Idempotency-Key headers, statements of idempotency keys and replay of stored
+results, expiration of old keys and statuses of batch writes.
+
+Statements are built here and executed by the caller in the transaction of the write,
+by Session.execute of the Flask application or by awaited AsyncConnection.execute.
+"""
+
+import json
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+from models.models import IdempotencyKey
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.sql import Executable
+from werkzeug.exceptions import NotAcceptable, UnprocessableEntity
+
+# action -> (status of a written groupId, status of a groupId left as it was) of /groups
+BATCH_STATUSES = {"create": (201, 400), "delete": (200, 404)}
+
+# node -> time of the last removal of expired idempotency keys by this process
+keys_expired_at: Dict[str, float] = {}
+
+
+def group_body(body: Any) -> Dict[str, Any]:
+    """
+    Checks parsed body of POST and DELETE of /group endpoint,
+    groupId is converted to str, the same as in batch_group_ids
+    Exceptions:
+        NotAcceptable:
+            Raises exception if body is missing, or "groupId" parameter is missing in body
+    """
+    if body is None:
+        raise NotAcceptable("Invalid Request, Please provide body")
+    if "groupId" in body:
+        return dict(body, groupId=str(body["groupId"]))
+    else:
+        raise NotAcceptable("Invalid Request, missing groupId in body")
+
+
+def batch_group_ids(body: Any, limit: int) -> List[str]:
+    """
+    Returns groupIds of parsed body of the batch request ({"groupIds": [...]}).
+    Duplicated groupIds are dropped, order of the first occurrence is kept.
+    Exceptions:
+        NotAcceptable:
+            Raises exception if body is missing, "groupIds" parameter is missing or is not a list,
+            or the number of groupIds exceeds limit
+    """
+    if body is None:
+        raise NotAcceptable("Invalid Request, Please provide body")
+    group_ids = body.get("groupIds") if isinstance(body, dict) else None
+    if not isinstance(group_ids, list) or not group_ids:
+        raise NotAcceptable("Invalid Request, groupIds should be a non empty list")
+    if len(group_ids) > limit:
+        raise NotAcceptable(f"Invalid Request, at most {limit} groupIds are allowed")
+    return list(dict.fromkeys(str(group_id) for group_id in group_ids))
+
+
+def chunks(items: List[str], size: int = 500) -> Iterator[List[str]]:
+    """
+    Splits items into chunks, to keep the number of bound parameters of "IN (...)"
+    queries below the SQLite limit.
+    """
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def node_model(hosts: Dict[str, Any], node: Optional[str]):
+    """
+    Returns Group Model of the node
+    Exceptions:
+        NotAcceptable:
+            Raises exception if node is missing or not configured
+    """
+    if node is None:
+        raise NotAcceptable("provide node parameter in request headers")
+    Group = hosts.get(node)
+    if Group is None:
+        raise NotAcceptable(
+            f"node {node} is not configured. Available nodes {list(hosts.keys())}"
+        )
+    return Group
+
+
+def checked_idempotency_key(key: Optional[str]) -> Optional[str]:
+    """
+    Returns Idempotency-Key header of the write request, None if it is missing
+    Exceptions:
+        NotAcceptable:
+            Raises exception if the key is longer than 255 characters
+    """
+    if key is not None and len(key) > 255:
+        raise NotAcceptable("Invalid Request, Idempotency-Key is too long")
+    return key
+
+
+def claim_key(node: str, key: str, digest: str) -> Executable:
+    """
+    INSERT of the key, done before the write. It takes the write lock of the node database,
+    so of concurrent requests with the same key only the first one inserts it (rowcount 1),
+    the others wait for its commit and find its result by stored_key
+    """
+    return (
+        insert(IdempotencyKey)
+        .values(node=node, key=key, request=digest, created=time.time())
+        .on_conflict_do_nothing(index_elements=["node", "key"])
+    )
+
+
+def stored_key(node: str, key: str) -> Executable:
+    """SELECT of the digest and the result of the write which claimed the key"""
+    return select(IdempotencyKey.request, IdempotencyKey.result).where(
+        IdempotencyKey.node == node, IdempotencyKey.key == key
+    )
+
+
+def replayed_result(stored, key: str, digest: str) -> Any:
+    """
+    Result of the write which claimed the key, row of stored_key
+    Exceptions:
+        UnprocessableEntity:
+            Raises exception if the key was used by a different write
+    """
+    if stored.request != digest:
+        raise UnprocessableEntity(
+            f"Idempotency-Key '{key}' was used by a different request"
+        )
+    return json.loads(stored.result)
+
+
+def store_result(node: str, key: str, result: Any) -> Executable:
+    """
+    UPDATE storing the result of the write with the key, executed in the same transaction
+    as the write, so it is recorded if and only if the write is committed
+    """
+    return (
+        update(IdempotencyKey)
+        .where(IdempotencyKey.node == node, IdempotencyKey.key == key)
+        .values(result=json.dumps(result))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def expired_keys(node: str, config: Dict[str, Any]) -> Optional[Executable]:
+    """
+    DELETE of idempotency keys of the node older than IDEMPOTENCY_KEY_TTL seconds,
+    None if this process removed them less than IDEMPOTENCY_KEY_EXPIRE_INTERVAL seconds ago.
+    Served by the index on created, so it costs one indexed DELETE.
+    """
+    now = time.time()
+    if now - keys_expired_at.get(node, 0) < config.get(
+        "IDEMPOTENCY_KEY_EXPIRE_INTERVAL", 60
+    ):
+        return None
+    keys_expired_at[node] = now
+    ttl = config.get("IDEMPOTENCY_KEY_TTL", 24 * 3600)
+    return (
+        delete(IdempotencyKey)
+        .where(IdempotencyKey.node == node, IdempotencyKey.created < now - ttl)
+        .execution_options(synchronize_session=False)
+    )
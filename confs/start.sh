@@ -1,2 +1,9 @@
 service nginx start &
-gunicorn --conf /app/config/gunicorn_conf.py --bind 0.0.0.0:8080 main:app
\ No newline at end of file
+# SERVING_MODE of the config (CONFIG_PATH), SERVING_MODE environment variable overrides it
+mode=$(cd /app && python3 -c "import importlib, os; print(importlib.import_module(os.environ['CONFIG_PATH']).SERVING_MODE)")
+if [ "$mode" = "async" ]; then
+    # one process, the same as one gunicorn worker; keep-alive above the one of nginx upstream
+    uvicorn --app-dir /app --host 0.0.0.0 --port 8080 --timeout-keep-alive 5 asgi:app
+else
+    gunicorn --conf /app/config/gunicorn_conf.py --bind 0.0.0.0:8080 main:app
+fi
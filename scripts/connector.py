@@ -1,53 +1,361 @@
+import bisect
+import heapq
 import json
 import logging
+import os
+import random
+import threading
 import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
-from typing import Optional
+from functools import wraps
+from itertools import groupby
+from operator import itemgetter
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import requests
 from requests import Response
+from requests.adapters import HTTPAdapter
+
+from handoff import Hint, HintedHandoff
+from journal import (
+    Journal,
+    compact,
+    incomplete_operations,
+    journal_files,
+    journal_path,
+    last_begins,
+    lock_abandoned,
+    new_op_id,
+    read_records,
+    unlock,
+    unsuperseded,
+)
 
 logger = logging.getLogger(__name__)
 
+SNAPSHOT_CHUNK = 1 << 20  # bytes of snapshot read from the stream at once
+# bounds of request latency buckets in seconds, Connector.metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
 
-def retry(max_retries: int = 2, sleep: float = 2):
+class NodeUnavailableError(Exception):
     """
-    Simple retry decorator
-    Args:
-        max_retries: Number of maximum retries
-        sleep: timeout between retries
+    Raised when request to the node failed without response, or its circuit is open
     """
 
-    def inner_decorator(func):
-        def wrapper(*args, **kwargs):
-            for i in range(1, max_retries + 2):
-                try:
-                    return func(*args, **kwargs)
-                except RollbackError as e:
-                    if i <= max_retries:
-                        time.sleep(sleep)
-                        logger.info(
-                            "Retrying %s. Retry %s after %s seconds...",
-                            func.__qualname__,
-                            i,
-                            sleep,
-                        )
-                        continue
-                    else:
-                        logger.info(
-                            "Giving up retrying %s after %s retries...",
-                            func.__name__,
-                            max_retries,
-                        )
-                        raise e
 
-        return wrapper
+class CircuitOpenError(NodeUnavailableError):
+    """
+    Raised without calling the node, when its circuit breaker is open
+    """
+
+
+class RetryBudget:
+    """
+    Token bucket which limits retries to a share of the requests sent to the node.
+    Every request deposits <ratio> tokens (up to <max_tokens>), every retry withdraws one,
+    so when the node fails persistently, retries stop instead of multiplying its load.
+    """
+
+    def __init__(self, ratio: float, max_tokens: float):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class CircuitBreaker:
+    """
+    Tracks outcomes of the last <window> requests to the node.
+    When at least <min_calls> outcomes are known and share of failures reaches <threshold>,
+    circuit opens and requests fail fast for <reset_timeout> seconds.
+    After that one trial request is let through (half open state),
+    its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(
+        self, threshold: float, window: int, min_calls: int, reset_timeout: float
+    ):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = None
+        self.trial = False
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.trial or time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        self.trial = True
+        return True
+
+    def record(self, success: bool) -> bool:
+        """Records outcome of the request, returns True if it opened the circuit"""
+        if self.opened_at is not None:
+            if not self.trial:
+                return False  # request started before the circuit opened
+            self.trial = False
+            if success:
+                self.opened_at = None
+                return False
+            self.opened_at = time.monotonic()
+            return True
+        self.outcomes.append(success)
+        failures = self.outcomes.count(False)
+        if len(self.outcomes) >= self.min_calls and failures >= self.threshold * len(
+            self.outcomes
+        ):
+            self.opened_at = time.monotonic()
+            self.outcomes.clear()
+            return True
+        return False
+
+
+class LatencyHistogram:
+    """
+    Number of requests per latency bucket, bounds are LATENCY_BUCKETS seconds,
+    the last bucket counts requests slower than all bounds
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"buckets": list(self.counts), "sum": self.sum}
+
+
+class RetryPolicy:
+    """
+    Retry policy of the requests, with state kept per node:
+        - exponential backoff with full jitter: sleep is random in [0, min(cap, base * 2**retry)]
+        - retry budget (RetryBudget)
+        - circuit breaker (CircuitBreaker)
+    Response is retryable if it is missing (connection error, timeout)
+    or its status code is one of retryable_status_codes.
+    Subclasses can override backoff and is_retryable.
+    counters() returns number of requests, retries and breaker trips per node,
+    latencies() histograms of request latencies per node, failed attempts included.
+    """
+
+    retryable_status_codes = (408, 500, 502, 503, 504)
 
-    return inner_decorator
+    def __init__(
+        self,
+        max_retries: int = 10,
+        base: float = 0.05,
+        cap: float = 2.0,
+        budget_ratio: float = 0.5,
+        budget_max_tokens: float = 20,
+        breaker_threshold: float = 0.6,
+        breaker_window: int = 30,
+        breaker_min_calls: int = 10,
+        breaker_reset_timeout: float = 1.0,
+    ):
+        self.max_retries = max_retries
+        self.base = base
+        self.cap = cap
+        self.budget_ratio = budget_ratio
+        self.budget_max_tokens = budget_max_tokens
+        self.breaker_threshold = breaker_threshold
+        self.breaker_window = breaker_window
+        self.breaker_min_calls = breaker_min_calls
+        self.breaker_reset_timeout = breaker_reset_timeout
+        self._lock = threading.Lock()
+        self._nodes = (
+            {}
+        )  # node -> (RetryBudget, CircuitBreaker, counters, LatencyHistogram)
+
+    def __getstate__(self):
+        # state of the nodes belongs to the process, lock can't be pickled
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_nodes"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _node(self, node: str):
+        if node not in self._nodes:
+            self._nodes[node] = (
+                RetryBudget(self.budget_ratio, self.budget_max_tokens),
+                CircuitBreaker(
+                    self.breaker_threshold,
+                    self.breaker_window,
+                    self.breaker_min_calls,
+                    self.breaker_reset_timeout,
+                ),
+                dict.fromkeys(
+                    (
+                        "requests",
+                        "retries",
+                        "breaker_trips",
+                        "fast_failures",
+                        "budget_exhausted",
+                    ),
+                    0,
+                ),
+                LatencyHistogram(),
+            )
+        return self._nodes[node]
+
+    def counters(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {node: dict(state[2]) for node, state in self._nodes.items()}
+
+    def latencies(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {node: state[3].snapshot() for node, state in self._nodes.items()}
+
+    def backoff(self, retry: int) -> float:
+        return random.uniform(0, min(self.cap, self.base * 2**retry))
+
+    def is_retryable(self, resp: Optional[Response]) -> bool:
+        return resp is None or resp.status_code in self.retryable_status_codes
+
+    def call(
+        self,
+        node: str,
+        request: Callable[[], Response],
+        accept: Collection[int],
+        max_retries: Optional[int] = None,
+    ) -> Response:
+        """
+        Calls request() until response status code is in accept, or is not retryable,
+        or retries are exhausted.
+        Args:
+            node: node name, state of which is used
+            request: function sending the request
+            accept: expected status codes
+            max_retries: overrides max_retries of the policy, 0 disables retries
+        Returns:
+            last Response
+        Exceptions:
+            CircuitOpenError: circuit was open for all attempts, the request is not sent
+            NodeUnavailableError: the request was sent and no attempt got a response,
+                                  it may have been applied
+        """
+        if max_retries is None:
+            max_retries = self.max_retries
+        with self._lock:
+            budget, breaker, counters, latency = self._node(node)
+            budget.deposit()
+        resp = None
+        sent_error = None  # error of the last attempt which was sent without response
+        for retry in range(max_retries + 1):
+            if retry:
+                with self._lock:
+                    if not budget.withdraw():
+                        counters["budget_exhausted"] += 1
+                        logger.info("Retry budget of %s is exhausted", node)
+                        break
+                    counters["retries"] += 1
+                sleep = self.backoff(retry)
+                logger.info("Retry %s to %s after %.3f seconds", retry, node, sleep)
+                time.sleep(sleep)
+            with self._lock:
+                allowed = breaker.allow()
+                if not allowed:
+                    counters["fast_failures"] += 1
+            if not allowed:
+                continue
+            error = None
+            start = time.monotonic()
+            try:
+                resp = request()
+            except requests.RequestException as e:
+                error, resp = e, None
+                sent_error = e
+            success = not self.is_retryable(resp)
+            with self._lock:
+                latency.observe(time.monotonic() - start)
+                counters["requests"] += 1
+                if breaker.record(success):
+                    counters["breaker_trips"] += 1
+                    logger.warning("Circuit of %s is open", node)
+            if success and (resp.status_code in accept or not self.is_retryable(resp)):
+                return resp
+            if error is not None and retry == max_retries:
+                raise NodeUnavailableError(f"Request to {node} failed: {error}")
+        if resp is None and sent_error is not None:
+            raise NodeUnavailableError(f"Request to {node} failed: {sent_error}")
+        if resp is None:
+            raise CircuitOpenError(f"Circuit of {node} is open")
+        return resp
+
+
+class LatencyWindow:
+    """
+    Latencies of the last <size> reads of one node, which decide when a read is hedged.
+    Percentile is unknown until <min_samples> latencies are recorded.
+    counters: reads, hedged (second request was sent), hedge_wins (second request answered first)
+    """
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+        self.counters = dict.fromkeys(("reads", "hedged", "hedge_wins"), 0)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float, hedged: bool = False, hedge_won: bool = False):
+        with self._lock:
+            self.samples.append(seconds)
+            self.counters["reads"] += 1
+            self.counters["hedged"] += hedged
+            self.counters["hedge_wins"] += hedge_won
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self._lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+DEFAULT_POLICY = RetryPolicy()
+# groupIds in one /groups/exists request, GROUP_BATCH_LIMIT of the cluster
+EXISTS_BATCH_SIZE = 1000
 
 
 def create_node_group(
-    group_id: str, host: str, node: str, timestamp: Optional[float]
+    group_id: str,
+    host: str,
+    node: str,
+    timestamp: Optional[float],
+    session: Optional[requests.Session] = None,
+    idempotency_key: Optional[str] = None,
 ) -> Response:
     """
     Atomic function for creating one group record in one node. Function is doing API call POST method
@@ -56,6 +364,9 @@ def create_node_group(
         host: url of the host
         node: node name
         timestamp: timestamp in seconds
+        session: session used for the call, module level requests functions if not given
+        idempotency_key: Idempotency-Key header, retry with the same key gets the response of
+                         the first call instead of creating the record again
 
     If timestamp was provided it would be added into headers
 
@@ -66,18 +377,25 @@ def create_node_group(
         "node": node,
         "timestamp": str(timestamp),
     }
+    if idempotency_key:
+        header["Idempotency-Key"] = idempotency_key
     body = {
         "groupId": str(group_id),
     }
     group_url = f"{host}/group"
     logger.info(f"Trying to create %s, data: %s, headers: %s", group_url, body, header)
-    resp = requests.post(group_url, data=json.dumps(body), headers=header)
+    resp = (session or requests).post(group_url, data=json.dumps(body), headers=header)
     logger.info("Response %s, %s", resp, resp.text)
     return resp
 
 
 def delete_node_group(
-    group_id: str, host: str, node: str, timestamp: Optional[float] = None
+    group_id: str,
+    host: str,
+    node: str,
+    timestamp: Optional[float] = None,
+    session: Optional[requests.Session] = None,
+    idempotency_key: Optional[str] = None,
 ):
     """
     Atomic function for deleting one group record in one node. Function is doing API call DELETE method
@@ -86,6 +404,10 @@ def delete_node_group(
         host: url of the host
         node: node name
         timestamp: timestamp in seconds
+        session: session used for the call, module level requests functions if not given
+        idempotency_key: Idempotency-Key header, retry with the same key gets the response of
+                         the first call, so 200 tells that the record was deleted by this call
+                         and 404 that it didn't exist
 
     If timestamp was provided it would be added into headers
 
@@ -101,24 +423,116 @@ def delete_node_group(
         header = {
             "node": node,
         }
+    if idempotency_key:
+        header["Idempotency-Key"] = idempotency_key
 
     body = {
         "groupId": str(group_id),
     }
     group_url = f"{host}/group"
     logger.info(f"Trying to delete %s, data: %s, headers: %s", group_url, body, header)
-    resp = requests.delete(group_url, data=json.dumps(body), headers=header)
+    resp = (session or requests).delete(
+        group_url, data=json.dumps(body), headers=header
+    )
     logger.info("Response %s, %s", resp, resp.text)
     return resp
 
 
-def get_node_group(group_id: str, host: str, node: str) -> Response:
+def create_node_groups(
+    group_ids: List[str],
+    host: str,
+    node: str,
+    timestamp: Optional[float],
+    session: Optional[requests.Session] = None,
+    idempotency_key: Optional[str] = None,
+) -> Response:
+    """
+    Batch version of create_node_group. Creates all group records in one node
+    by one API call POST method on /groups endpoint
+    Args:
+        group_ids: ids of group records
+        host: url of the host
+        node: node name
+        timestamp: timestamp in seconds
+        session: session used for the call, module level requests functions if not given
+        idempotency_key: Idempotency-Key header, the same as in create_node_group
+
+    Returns:
+        Response, which json is a map of groupId -> status code (201/400)
+    """
+    header = {
+        "node": node,
+        "timestamp": str(timestamp),
+    }
+    if idempotency_key:
+        header["Idempotency-Key"] = idempotency_key
+    body = {
+        "groupIds": [str(group_id) for group_id in group_ids],
+    }
+    group_url = f"{host}/groups"
+    logger.info(
+        "Trying to create %s, %s groups, headers: %s", group_url, len(group_ids), header
+    )
+    resp = (session or requests).post(group_url, data=json.dumps(body), headers=header)
+    logger.info("Response %s", resp)
+    return resp
+
+
+def delete_node_groups(
+    group_ids: List[str],
+    host: str,
+    node: str,
+    timestamp: Optional[float] = None,
+    session: Optional[requests.Session] = None,
+    idempotency_key: Optional[str] = None,
+) -> Response:
+    """
+    Batch version of delete_node_group. Deletes all group records from one node
+    by one API call DELETE method on /groups endpoint
+    Args:
+        group_ids: ids of group records
+        host: url of the host
+        node: node name
+        timestamp: timestamp in seconds
+        session: session used for the call, module level requests functions if not given
+        idempotency_key: Idempotency-Key header, the same as in delete_node_group
+
+    If timestamp was provided it would be added into headers
+
+    Returns:
+        Response, which json is a map of groupId -> status code (200/404)
+    """
+    header = {
+        "node": node,
+    }
+    if timestamp:
+        header["timestamp"] = str(timestamp)
+    if idempotency_key:
+        header["Idempotency-Key"] = idempotency_key
+    body = {
+        "groupIds": [str(group_id) for group_id in group_ids],
+    }
+    group_url = f"{host}/groups"
+    logger.info(
+        "Trying to delete %s, %s groups, headers: %s", group_url, len(group_ids), header
+    )
+    resp = (session or requests).delete(
+        group_url, data=json.dumps(body), headers=header
+    )
+    logger.info("Response %s", resp)
+    return resp
+
+
+def get_node_group(
+    group_id: str, host: str, node: str, session: Optional[requests.Session] = None
+) -> Response:
     """
     Function implements GET method, for returning group record by specified group_id
     Args:
         group_id: id of group record
         host: url of the host
         node: node name
+        session: session used for the call, module level requests functions if not given
 
     Returns:
         Response
@@ -127,11 +541,203 @@ def get_node_group(group_id: str, host: str, node: str) -> Response:
         "node": node,
     }
     group_url = f"{host}/group/{group_id}"
-    resp = requests.get(group_url, headers=header)
+    resp = (session or requests).get(group_url, headers=header)
     return resp
 
 
-def check_group_exists(group_id: str, host: str, node: str) -> bool:
+def get_node_groups_exist(
+    group_ids: List[str],
+    host: str,
+    node: str,
+    session: Optional[requests.Session] = None,
+) -> Response:
+    """
+    Batch version of get_node_group. Checks existence of group records in one node
+    by one API call POST method on /groups/exists endpoint
+    Args:
+        group_ids: ids of group records
+        host: url of the host
+        node: node name
+        session: session used for the call, module level requests functions if not given
+
+    Returns:
+        Response, which json is a map of groupId -> status code (200/404)
+    """
+    header = {
+        "node": node,
+    }
+    body = {
+        "groupIds": [str(group_id) for group_id in group_ids],
+    }
+    resp = (session or requests).post(
+        f"{host}/groups/exists", data=json.dumps(body), headers=header
+    )
+    return resp
+
+
+def get_node_tree(
+    host: str,
+    node: str,
+    level: int,
+    prefixes: Optional[List[int]] = None,
+    session: Optional[requests.Session] = None,
+) -> Dict:
+    """
+    Function returns one level of the node's hash tree (/tree endpoint).
+    If prefixes are given, only children of these buckets are returned.
+    Prefixes are sent in chunks, to keep urls short.
+    Args:
+        host: url of the host
+        node: node name
+        level: tree level
+        prefixes: buckets of the previous level
+        session: session used for the call, module level requests functions if not given
+
+    Returns:
+        {"depth": int, "level": int, "buckets": {"<bucket>": [count, digest]}}
+    """
+    header = {
+        "node": node,
+    }
+    tree = {"buckets": {}}
+    chunks = (
+        [prefixes[i : i + 200] for i in range(0, len(prefixes), 200)]
+        if prefixes
+        else [[]]
+    )
+    for chunk in chunks:
+        resp = (session or requests).get(
+            f"{host}/tree", params={"level": level, "prefix": chunk}, headers=header
+        )
+        resp.raise_for_status()
+        body = resp.json()
+        tree["depth"], tree["level"] = body["depth"], body["level"]
+        tree["buckets"].update(body["buckets"])
+    return tree
+
+
+def get_node_tree_groups(
+    host: str, node: str, buckets: List[int], session: Optional[requests.Session] = None
+) -> Dict[str, List[str]]:
+    """
+    Function returns groupIds of the leaf buckets of the node's hash tree (/tree/groups endpoint)
+    Args:
+        host: url of the host
+        node: node name
+        buckets: leaf buckets
+        session: session used for the call, module level requests functions if not given
+
+    Returns:
+        {"<bucket>": [groupId, ...]}
+    """
+    header = {
+        "node": node,
+    }
+    groups = {}
+    for i in range(0, len(buckets), 200):
+        resp = (session or requests).get(
+            f"{host}/tree/groups",
+            params={"bucket": buckets[i : i + 200]},
+            headers=header,
+        )
+        resp.raise_for_status()
+        groups.update(resp.json())
+    return groups
+
+
+def list_node_groups(
+    host: str,
+    node: str,
+    order: str = "id",
+    after: Optional[Any] = None,
+    session: Optional[requests.Session] = None,
+) -> Response:
+    """
+    Function starts streaming listing of the node's groups (GET method of /groups endpoint)
+    Args:
+        host: url of the host
+        node: node name
+        order: "id" or "groupId", order of the records and key of the cursor
+        after: cursor, id or groupId of the last received record
+        session: session used for the call, module level requests functions if not given
+
+    Returns:
+        streamed Response, which lines are {"id": ..., "groupId": ..., "timestamp": ...},
+        it must be closed to release the connection
+    """
+    header = {
+        "node": node,
+    }
+    params = {"order": order}
+    if after is not None:
+        params["after"] = after
+    return (session or requests).get(
+        f"{host}/groups", params=params, headers=header, stream=True
+    )
+
+
+def get_node_snapshot(
+    host: str, node: str, session: Optional[requests.Session] = None
+) -> Response:
+    """
+    Function starts streaming binary snapshot of the node's table (GET method of /snapshot endpoint)
+    Args:
+        host: url of the host
+        node: node name
+        session: session used for the call, module level requests functions if not given
+
+    Returns:
+        streamed Response, it must be closed to release the connection
+    """
+    header = {
+        "node": node,
+    }
+    return (session or requests).get(f"{host}/snapshot", headers=header, stream=True)
+
+
+def put_node_snapshot(
+    data: Union[bytes, BinaryIO, Iterable[bytes]],
+    host: str,
+    node: str,
+    mode: str = "replace",
+    timeout: Optional[Tuple[float, Optional[float]]] = None,
+    session: Optional[requests.Session] = None,
+) -> Response:
+    """
+    Function loads binary snapshot into the node's table (PUT method of /snapshot endpoint)
+    Args:
+        data: snapshot, file or iterator of chunks is uploaded as it is read
+        host: url of the host
+        node: node name
+        mode: "replace" replaces records of the node, "merge" adds the missing ones
+        timeout: (connect, read) timeouts, the node responds after the whole snapshot is loaded
+        session: session used for the call, module level requests functions if not given
+
+    Returns:
+        Response, which body is {"records": ..., "inserted": ..., "deleted": ...}
+    """
+    header = {
+        "node": node,
+        "Content-Type": "application/octet-stream",
+    }
+    kwargs = {} if timeout is None else {"timeout": timeout}
+    return (session or requests).put(
+        f"{host}/snapshot",
+        params={"mode": mode},
+        data=data,
+        headers=header,
+        **kwargs,
+    )
+
+
+def check_group_exists(
+    group_id: str,
+    host: str,
+    node: str,
+    session: Optional[requests.Session] = None,
+    policy: Optional[RetryPolicy] = None,
+    hedge: Optional[Callable[[str, Callable[[], Response]], Response]] = None,
+) -> bool:
     """
     Function is used in Connection.delete_group method and it's mandatory to cover the case,
     when you are requesting to delete non existing item and it's failing due to random behavior.
@@ -144,41 +750,213 @@ def check_group_exists(group_id: str, host: str, node: str) -> bool:
         procedure it will recreate it again if we won't check either it exists or no.
         But doing a pre-check before deletion, we could prevent that situation.
 
-    Here Infinite loop is not best solution, with retry decorator it will be more proper,
-    but I leave everything simple. I am sure that modification of this function is pretty simple
-    and straightforward.
+    The check is retried by the policy, when it gives up existence is unknown
+    and NodeUnavailableError is raised.
 
     Args:
         group_id: id of group record
         host: url of the host
         node: node name
+        session: session used for the call, module level requests functions if not given
+        policy: retry policy, DEFAULT_POLICY if not given
+        hedge: function sending the request, hedge(node, request), e.g. Connector.hedged
 
     Returns:
         True/False
     """
-    while 1:
-        resp = get_node_group(group_id, host, node)
-        logger.info(
-            "Checking existence of group with groupId: %s, node: %s, status_code: %s, response: %s",
-            group_id,
+
+    def request() -> Response:
+        return get_node_group(group_id, host, node, session)
+
+    resp = (policy or DEFAULT_POLICY).call(
+        node, (lambda: hedge(node, request)) if hedge else request, accept=(200, 404)
+    )
+    logger.info(
+        "Checking existence of group with groupId: %s, node: %s, status_code: %s, response: %s",
+        group_id,
+        node,
+        resp.status_code,
+        resp.text,
+    )
+    if resp.status_code == 200:
+        return True
+    elif resp.status_code == 404:
+        return False
+    raise NodeUnavailableError(
+        f"Existence of group {group_id} in {node} is unknown, status code {resp.status_code}"
+    )
+
+
+def check_groups_exist(
+    group_ids: List[str],
+    host: str,
+    node: str,
+    session: Optional[requests.Session] = None,
+    policy: Optional[RetryPolicy] = None,
+    hedge: Optional[Callable[[str, Callable[[], Response]], Response]] = None,
+) -> List[str]:
+    """
+    Batch version of check_group_exists. groupIds are checked in chunks of EXISTS_BATCH_SIZE,
+    one request per chunk instead of one request per groupId.
+    Every chunk is retried by the policy, when it gives up NodeUnavailableError is raised.
+    Args:
+        group_ids: ids of group records
+        host: url of the host
+        node: node name
+        session: session used for the call, module level requests functions if not given
+        policy: retry policy, DEFAULT_POLICY if not given
+        hedge: function sending the request, hedge(node, request), e.g. Connector.hedged
+
+    Returns:
+        groupIds existing in the node, in the order of group_ids
+    """
+    existing = []
+    for i in range(0, len(group_ids), EXISTS_BATCH_SIZE):
+        chunk = group_ids[i : i + EXISTS_BATCH_SIZE]
+
+        def request() -> Response:
+            return get_node_groups_exist(chunk, host, node, session)
+
+        resp = (policy or DEFAULT_POLICY).call(
             node,
-            resp.status_code,
-            resp.text,
+            (lambda: hedge(node, request)) if hedge else request,
+            accept=(200,),
         )
-        if resp.status_code == 200:
-            return True
-        elif resp.status_code == 404:
-            return False
+        if resp.status_code != 200:
+            raise NodeUnavailableError(
+                f"Existence of {len(chunk)} groups in {node} is unknown, "
+                f"status code {resp.status_code}"
+            )
+        statuses = resp.json()
+        existing.extend(
+            group_id for group_id in chunk if statuses.get(str(group_id)) == 200
+        )
+    logger.info(
+        "Checking existence of %s groups, node: %s, %s exist",
+        len(group_ids),
+        node,
+        len(existing),
+    )
+    return existing
+
+
+def merge_metrics(total: Dict[str, Any], metrics: Dict[str, Any]) -> Dict[str, Any]:
+    """Adds Connector.metrics of one process to total, returns total"""
+    total["rollbacks"] = total.get("rollbacks", 0) + metrics["rollbacks"]
+    nodes = total.setdefault("nodes", {})
+    for node, values in metrics["nodes"].items():
+        merged = nodes.setdefault(node, {})
+        for name, value in values.items():
+            if name == "latency":
+                latency = merged.setdefault(
+                    name, {"buckets": [0] * len(value["buckets"]), "sum": 0.0}
+                )
+                latency["buckets"] = [
+                    a + b for a, b in zip(latency["buckets"], value["buckets"])
+                ]
+                latency["sum"] += value["sum"]
+            else:
+                merged[name] = merged.get(name, 0) + value
+    return total
+
+
+def render_metrics(metrics: Dict[str, Any]) -> str:
+    """
+    Connector.metrics in Prometheus text exposition format, e.g. for the textfile collector
+    of node_exporter, named connector_* like cluster_* metrics of the API
+    """
+    lines = [
+        "# TYPE connector_rollbacks_total counter",
+        f"connector_rollbacks_total {metrics.get('rollbacks', 0)}",
+    ]
+    nodes = sorted(metrics.get("nodes", {}).items())
+    names = sorted({name for _, values in nodes for name in values} - {"latency"})
+    for name in names:
+        metric = f"connector_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.extend(
+            f'{metric}{{node="{node}"}} {values[name]}'
+            for node, values in nodes
+            if name in values
+        )
+    lines.append("# TYPE connector_request_duration_seconds histogram")
+    for node, values in nodes:
+        if "latency" not in values:
+            continue
+        cumulative = 0
+        bounds = [str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"]
+        for bound, count in zip(bounds, values["latency"]["buckets"]):
+            cumulative += count
+            lines.append(
+                f'connector_request_duration_seconds_bucket{{node="{node}",le="{bound}"}} '
+                f"{cumulative}"
+            )
+        lines.append(
+            f'connector_request_duration_seconds_sum{{node="{node}"}} '
+            f'{values["latency"]["sum"]}'
+        )
+        lines.append(
+            f'connector_request_duration_seconds_count{{node="{node}"}} {cumulative}'
+        )
+    return "\n".join(lines) + "\n"
+
+
+class PooledSession(requests.Session):
+    """
+    Session keeping alive up to pool_size connections to one host,
+    and applying default timeout to every request made through it.
+    """
+
+    def __init__(self, pool_size: int, timeout: Tuple[float, float]):
+        super().__init__()
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
 
 
 class RollbackError(Exception):
     """
-    Handled in retry decorator
+    Raised when rollback or repair write didn't succeed within the retry policy
     """
 
     pass
 
 
+def journaled(action: str):
+    """
+    Decorator of Connector operations, which writes begin and end records of the operation
+    to the journal. end is written only if the operation returned, operation which raised
+    (e.g. rollback gave up) is left incomplete, to be finished or undone by recover.
+    Args:
+        action: "create"/"delete"
+    """
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, group_ids, *args, **kwargs):
+            self.begin(
+                action, group_ids if isinstance(group_ids, list) else [group_ids]
+            )
+            self._hinted = False
+            try:
+                result = method(self, group_ids, *args, **kwargs)
+                if not self._hinted:
+                    # with hints the operation ends when they are delivered
+                    self.record("end")
+                return result
+            finally:
+                self._op = None
+
+        return wrapper
+
+    return decorator
+
+
 class Connector:
     """
     Connector class which makes creation and deletion of the group records in a cluster more reliable
@@ -190,57 +968,1144 @@ class Connector:
         2. delete_group
              |-> rollback_delete               # If random errors occurred called rollback_delete
                      |-> create_node_group     # rollback of deleting is creation
+
+    and their batch versions create_groups/delete_groups, which send the whole list of
+    groupIds to a node in one request and roll back the whole batch the same way.
+
+    repair method brings diverged nodes (e.g. after failed rollback) back in sync,
+    touching only groups which differ.
+
+    By default nodes are called one after another. With fan_out=True create and delete methods
+    call all nodes concurrently from a thread pool, so one operation costs about one round trip
+    to the slowest node instead of the sum of all round trips. Rollback covers every node
+    which was called, because responses of all of them are known only at the end.
+
+    Every host is called through its own PooledSession, which keeps up to pool_size connections
+    alive between calls, so connection setup isn't paid on every request.
+    Sessions are created lazily in the process which uses them, they are never shared
+    between processes of multiprocessing.Pool. pool_size=0 disables sessions.
+
+    Failures are handled by the RetryPolicy (policy argument, RetryPolicy() by default).
+    Writes with idempotency key are retried by the policy, without keys they are sent once.
+    A write which failed all its attempts is rolled back together with the nodes written before,
+    and NodeUnavailableError is raised. Rollback is retried with backoff together with existence
+    checks and repair writes. Node with open circuit is not called, operation is rolled back
+    on the nodes written before, as if the node failed.
+
+    With journal_dir every operation is recorded in the write-ahead journal (journal.py)
+    before and after each node write, so operation interrupted by the crash of the process
+    is finished or undone later by recover method.
+
+    With write_quorum=W an operation succeeds once W nodes acknowledged the write, it is rolled
+    back only when that is no longer possible. Nodes which missed the write get it later
+    from the hinted handoff queue (handoff.py), delivered by a background thread,
+    so one slow or flaky node doesn't set the failure rate of every write.
+    close() delivers pending hints before the process exits.
+
+    With hedge_percentile=p existence checks are hedged: when a read takes longer than
+    the p-th percentile of the recent reads of the node, the same read is sent again
+    and the first response is used.
+
+    With idempotency_keys (default) every write of an operation carries Idempotency-Key header,
+    the node applies it once and replays its response to retries. So writes are retried
+    by the policy like reads, and only writes which failed all retries are rolled back.
+    delete_group sends delete without checking existence first, replayed 404 tells
+    the group didn't exist in the node.
+    The key is new for every operation and is reused only by the attempts of its writes.
+    Rollback writes carry no key, they are idempotent by the timestamp of the record,
+    and a rolled back operation is never retried with its key, so a stored result
+    of an undone write is never replayed.
     """
 
-    def __init__(self, hosts):
+    def __init__(
+        self,
+        hosts,
+        fan_out: bool = False,
+        pool_size: int = 10,
+        timeout: Tuple[float, float] = (3.05, 30),
+        policy: Optional[RetryPolicy] = None,
+        journal_dir: Optional[str] = None,
+        journal_sync_interval: float = 0.05,
+        write_quorum: Optional[int] = None,
+        hedge_percentile: Optional[float] = None,
+        handoff_retry_interval: float = 0.5,
+        idempotency_keys: bool = True,
+    ):
+        if write_quorum is not None and not 1 <= write_quorum <= len(hosts):
+            raise ValueError(f"write_quorum should be in range 1..{len(hosts)}")
         self.hosts = hosts
+        self.fan_out = fan_out
+        self.pool_size = pool_size
+        self.timeout = timeout  # (connect, read) timeouts in seconds
+        self.policy = policy or RetryPolicy()
+        self.journal_dir = journal_dir
+        self.journal_sync_interval = journal_sync_interval  # seconds between fsyncs
+        self.write_quorum = write_quorum  # None requires all nodes
+        self.hedge_percentile = hedge_percentile  # None disables hedged reads
+        self.handoff_retry_interval = handoff_retry_interval
+        self.idempotency_keys = idempotency_keys  # writes are retried with the same key
         # All status_codes that provides API without influence of random effects
         self.acceptable_status_codes = [400, 404, 201, 200]
         # containers for collecting temporary data needed for rollback
         self.rollback_create_hosts = []
         self.rollback_delete_hosts = []
+        self.rollback_create_batches = []
+        self.rollback_delete_batches = []
+        self._executor = None  # thread pool for fan_out, created on first use
+        self._sessions = {}  # host -> PooledSession, created on first use
+        self._journal = None  # journal file of the process, created on first use
+        self._op = None  # id of the journaled operation in progress
+        self._hinted = False  # operation in progress queued hints
+        self._handoff = None  # hinted handoff queue, created on first use
+        self._hedge_executor = None  # thread pool of hedged reads, created on first use
+        self._latencies = {}  # node -> LatencyWindow of reads
+        self._rollbacks = 0  # operations rolled back by this process
+        self._undone = defaultdict(int)  # node -> rollback writes sent to it
+        self._lock = threading.Lock()  # guards lazy state used by fan_out threads
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        # Connector is pickled into multiprocessing workers, thread pool can't be pickled,
+        # and connections of the sessions and journal file must not be shared with another process
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        state["_sessions"] = {}
+        state["_journal"] = None
+        state["_handoff"] = None
+        state["_hedge_executor"] = None
+        state["_latencies"] = {}
+        state["_rollbacks"] = 0
+        state["_undone"] = defaultdict(int)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def session(self, host: str) -> Optional[requests.Session]:
+        """
+        Returns session of the host, created on first use
+        """
+        if not self.pool_size:
+            return None
+        self.check_pid()
+        if host not in self._sessions:
+            self._sessions[host] = PooledSession(self.pool_size, self.timeout)
+        return self._sessions[host]
+
+    def check_pid(self):
+        """
+        If connector was inherited by forked process, sessions and journal of the parent
+        are dropped without closing their connections and file.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._sessions = {}
+            self._executor = None
+            self._journal = None
+            self._handoff = None
+            self._hedge_executor = None
+            self._latencies = {}
+
+    def close(self, timeout: Optional[float] = 30.0) -> int:
+        """
+        Delivers pending hints for at most timeout seconds and closes the journal.
+        Returns number of hints left undelivered, their operations stay unfinished
+        in the journal and are finished by recover
+        """
+        self.check_pid()
+        pending = 0
+        if self._handoff is not None:
+            pending = self._handoff.close(timeout)
+            self._handoff = None
+            if pending:
+                logger.warning("%s hints are not delivered", pending)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        return pending
+
+    def journal(self) -> Optional[Journal]:
+        """Returns journal of the process, None if journal_dir is not set"""
+        if not self.journal_dir:
+            return None
+        self.check_pid()
+        if self._journal is None:
+            os.makedirs(self.journal_dir, exist_ok=True)
+            self._journal = Journal(
+                journal_path(self.journal_dir), self.journal_sync_interval
+            )
+        return self._journal
+
+    def begin(self, action: str, group_ids: List[str]):
+        """Starts journaled operation"""
+        if self.journal() is not None:
+            self._op = new_op_id()
+            self.record("begin", action=action, groupIds=group_ids, time=time.time())
+
+    def record(self, type_: str, **fields):
+        """
+        Appends record of the operation in progress to the journal.
+        Rollbacks and their writes are counted for metrics, with or without journal
+        """
+        if type_ == "rollback":
+            self._rollbacks += 1
+        elif type_ == "undone":
+            self._undone[fields["node"]] += 1
+        if self._op is not None:
+            self.journal().append({"op": self._op, "type": type_, **fields})
 
+    def map_nodes(self, func: Callable[[str, str], Any]) -> Dict[str, Any]:
+        """
+        Calls func(node, host) for all nodes concurrently.
+        Returns map of node -> result of func, after all calls are finished
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=len(self.hosts), thread_name_prefix="connector"
+            )
+        futures = {
+            node: self._executor.submit(func, node, host)
+            for node, host in self.hosts.items()
+        }
+        return {node: future.result() for node, future in futures.items()}
+
+    def map_writes(
+        self, func: Callable[[str, str], Any], failed: Any = None
+    ) -> Tuple[Dict[str, Any], Dict[str, NodeUnavailableError]]:
+        """
+        map_nodes of writes sent by send, NodeUnavailableError of a node doesn't lose
+        results of the others.
+        Returns map of node -> result of func, failed for nodes which raised,
+        and map of node -> NodeUnavailableError raised by func
+        """
+        errors = {}
+
+        def call(node: str, host: str) -> Any:
+            try:
+                return func(node, host)
+            except NodeUnavailableError as e:
+                errors[node] = e
+                return failed
+
+        return self.map_nodes(call), errors
+
+    def acceptable(self, resp: Optional[Response]) -> bool:
+        return resp is not None and resp.status_code in self.acceptable_status_codes
+
+    def idempotency_key(self) -> Optional[str]:
+        """New Idempotency-Key of a write, None if idempotency_keys are disabled"""
+        return uuid.uuid4().hex if self.idempotency_keys else None
+
+    def send(
+        self,
+        node: str,
+        request: Callable[[], Response],
+        timestamp: Optional[float] = None,
+        group_ids: Optional[List[str]] = None,
+    ) -> Optional[Response]:
+        """
+        Sends write request to the node through circuit breaker of the policy, once,
+        or retried by the policy if the request carries idempotency key (idempotency_keys).
+        Intent of the write (timestamp and groupIds) is journaled before it is sent,
+        status code of the response after.
+        Returns None without sending, if circuit of the node is open.
+        NodeUnavailableError (not in quorum mode) means the request was sent and may have
+        been applied, the caller rolls it back with the other nodes.
+        """
+        self.record("intent", node=node, timestamp=timestamp, groupIds=group_ids)
+        try:
+            resp = self.policy.call(
+                node,
+                request,
+                self.acceptable_status_codes,
+                max_retries=None if self.idempotency_keys else 0,
+            )
+        except CircuitOpenError:
+            logger.info("Circuit of %s is open, request is not sent", node)
+            resp = None
+        except NodeUnavailableError:
+            if self.write_quorum is None:
+                raise
+            # in quorum mode the node only misses the write, as if it responded with error
+            logger.exception("Request to %s failed", node)
+            resp = None
+        self.record(
+            "done", node=node, status=None if resp is None else resp.status_code
+        )
+        return resp
+
+    def quorum_possible(self, missed: int) -> bool:
+        """Whether the write can still succeed, when <missed> nodes didn't acknowledge it"""
+        if self.write_quorum is None:
+            return missed == 0
+        return len(self.hosts) - missed >= self.write_quorum
+
+    def handoff(self) -> HintedHandoff:
+        """Returns hinted handoff queue of the process, created on first use"""
+        self.check_pid()
+        with self._lock:
+            if self._handoff is None:
+                self._handoff = HintedHandoff(
+                    self.deliver_hint, self.hint_delivered, self.handoff_retry_interval
+                )
+        return self._handoff
+
+    def hint(
+        self, action: str, group_ids: List[str], missed: Dict[str, Optional[float]]
+    ):
+        """
+        Queues write of the operation in progress for the nodes which missed it.
+        Args:
+            missed: node -> timestamp of the write
+        """
+        if not missed:
+            return
+        logger.info("Handing off %s to %s", action, list(missed))
+        self._hinted = True
+        self.handoff().put(Hint(self._op, action, group_ids, missed))
+
+    def deliver_hint(self, node: str, hint: Hint):
+        """Sends hinted write to the node, raises RollbackError if it didn't succeed"""
+        host = self.hosts[node]
+        if hint.action == "create":
+            self.retry_write(
+                node,
+                lambda: create_node_groups(
+                    hint.group_ids, host, node, hint.nodes[node], self.session(host)
+                ),
+            )
+        else:
+            self.retry_write(
+                node,
+                lambda: delete_node_groups(
+                    hint.group_ids, host, node, session=self.session(host)
+                ),
+            )
+
+    def hint_delivered(self, hint: Hint):
+        """Ends journaled operation, all hints of which are delivered"""
+        if hint.op is not None and self.journal() is not None:
+            self.journal().append({"op": hint.op, "type": "end"})
+
+    def hedged(self, node: str, request: Callable[[], Response]) -> Response:
+        """
+        Sends read request. If it takes longer than hedge_percentile of the recent reads
+        of the node, the same request is sent again, and the response which comes first
+        is returned. Exception is raised only if both requests failed.
+        """
+        with self._lock:
+            if node not in self._latencies:
+                self._latencies[node] = LatencyWindow()
+            window = self._latencies[node]
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(
+                    max_workers=4 * len(self.hosts), thread_name_prefix="hedge"
+                )
+        delay = window.percentile(self.hedge_percentile)
+        start = time.monotonic()
+        if delay is None:
+            resp = request()
+            window.add(time.monotonic() - start)
+            return resp
+        first = self._hedge_executor.submit(request)
+        if wait([first], timeout=delay).done:
+            window.add(time.monotonic() - start)
+            return first.result()
+        second = self._hedge_executor.submit(request)
+        error = None
+        for future in as_completed([first, second]):
+            if future.exception() is None:
+                window.add(
+                    time.monotonic() - start, hedged=True, hedge_won=future is second
+                )
+                return future.result()
+            error = future.exception()
+        raise error
+
+    def hedge_counters(self) -> Dict[str, Dict[str, int]]:
+        """Number of reads, hedged reads and reads won by the hedge per node"""
+        return {node: dict(w.counters) for node, w in self._latencies.items()}
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Client metrics of this process, merged across processes by merge_metrics
+        and rendered by render_metrics:
+            {"rollbacks": operations rolled back,
+             "nodes": {node: {"requests", "retries", "breaker_trips", "fast_failures",
+                              "budget_exhausted", "reads", "hedged", "hedge_wins",
+                              "undone": rollback writes,
+                              "latency": {"buckets": counts per LATENCY_BUCKETS, "sum": seconds}}}}
+        """
+        nodes = defaultdict(dict)
+        for node, counters in self.policy.counters().items():
+            nodes[node].update(counters)
+        for node, counters in self.hedge_counters().items():
+            nodes[node].update(counters)
+        for node, count in self._undone.items():
+            nodes[node]["undone"] = count
+        for node, latency in self.policy.latencies().items():
+            nodes[node]["latency"] = latency
+        return {"rollbacks": self._rollbacks, "nodes": dict(nodes)}
+
+    def read_hedge(self) -> Optional[Callable[[str, Callable[[], Response]], Response]]:
+        """hedge argument of check_group_exists/check_groups_exist"""
+        return self.hedged if self.hedge_percentile else None
+
+    def exists(self, group_id: str, host: str, node: str) -> Optional[bool]:
+        """check_group_exists with policy of the connector, None if existence is unknown"""
+        try:
+            return check_group_exists(
+                group_id, host, node, self.session(host), self.policy, self.read_hedge()
+            )
+        except NodeUnavailableError:
+            logger.exception("Failed to check group %s in %s", group_id, node)
+            return None
+
+    def existing(
+        self, group_ids: List[str], host: str, node: str
+    ) -> Optional[List[str]]:
+        """check_groups_exist with policy of the connector, None if existence is unknown"""
+        try:
+            return check_groups_exist(
+                group_ids,
+                host,
+                node,
+                self.session(host),
+                self.policy,
+                self.read_hedge(),
+            )
+        except NodeUnavailableError:
+            logger.exception("Failed to check %s groups in %s", len(group_ids), node)
+            return None
+
+    def retry_write(self, node: str, request: Callable[[], Response]):
+        """
+        Sends idempotent write (rollback, repair) to the node, retrying it by the policy.
+        Raises RollbackError if it didn't get acceptable response
+        """
+        try:
+            resp = self.policy.call(node, request, self.acceptable_status_codes)
+        except NodeUnavailableError as e:
+            raise RollbackError(str(e)) from e
+        if resp.status_code not in self.acceptable_status_codes:
+            raise RollbackError(f"{node} responded with {resp.status_code}")
+
+    @journaled("create")
     def create_group(self, group_id: str):
+        # rollback data belongs to one operation, leftovers of the previous one
+        # (e.g. after rollback gave up retrying) must not be applied to this groupId
+        self.rollback_create_hosts.clear()
+        key = self.idempotency_key()
+        if self.fan_out:
+            timestamp = datetime.utcnow().timestamp()
+            responses, errors = self.map_writes(
+                lambda node, host: self.send(
+                    node,
+                    lambda: create_node_group(
+                        group_id, host, node, timestamp, self.session(host), key
+                    ),
+                    timestamp,
+                    [group_id],
+                )
+            )
+            missed = {
+                node: timestamp
+                for node, resp in responses.items()
+                if not self.acceptable(resp)
+            }
+            if errors or not self.quorum_possible(len(missed)):
+                self.rollback_create_hosts.extend(
+                    (node, self.hosts[node], timestamp)
+                    for node, resp in sorted(
+                        responses.items(), key=lambda item: item[0] in errors
+                    )
+                    if resp is not None or node in errors
+                )
+                self.rollback_create(group_id)
+                if errors:
+                    raise next(iter(errors.values()))
+                return
+            self.hint("create", [group_id], missed)
+            return
+
+        missed = {}
         for node, host in self.hosts.items():
             timestamp = datetime.utcnow().timestamp()
-            resp = create_node_group(group_id, host, node, timestamp)
-            self.rollback_create_hosts.append((node, host, timestamp))
-            if resp.status_code not in self.acceptable_status_codes:
+            try:
+                resp = self.send(
+                    node,
+                    lambda: create_node_group(
+                        group_id, host, node, timestamp, self.session(host), key
+                    ),
+                    timestamp,
+                    [group_id],
+                )
+            except NodeUnavailableError:
+                # the node may have applied the write, it is rolled back as well
+                self.rollback_create_hosts.append((node, host, timestamp))
                 self.rollback_create(group_id)
-                break
+                raise
+            if resp is not None:
+                self.rollback_create_hosts.append((node, host, timestamp))
+            if not self.acceptable(resp):
+                missed[node] = timestamp
+                if not self.quorum_possible(len(missed)):
+                    self.rollback_create(group_id)
+                    return
+        self.hint("create", [group_id], missed)
 
-    @retry(max_retries=10, sleep=0.1)
     def rollback_create(self, group_id: str):
+        self.record("rollback")
         while self.rollback_create_hosts:
             node, host, timestamp = self.rollback_create_hosts[0]
             logger.info("Trying to rollback")
-            resp = delete_node_group(group_id, host, node, timestamp)
-            if resp.status_code not in self.acceptable_status_codes:
-                raise RollbackError
+            self.retry_write(
+                node,
+                lambda: delete_node_group(
+                    group_id, host, node, timestamp, self.session(host)
+                ),
+            )
+            self.record("undone", node=node)
+            self.rollback_create_hosts.pop(0)
+
+    def prefetch_existence(self, group_ids: List[str]) -> Dict[str, Optional[Set[str]]]:
+        """
+        Checks existence of all group_ids in every node by /groups/exists requests.
+        Returns map of node -> set of existing groupIds, None for nodes which failed.
+        Result is passed to delete_group, so deleting a list of groupIds one by one
+        doesn't cost an existence request per groupId and node.
+        """
+
+        def prefetch(node: str, host: str) -> Optional[Set[str]]:
+            found = self.existing(group_ids, host, node)
+            return None if found is None else set(found)
+
+        if self.fan_out:
+            return self.map_nodes(prefetch)
+        return {node: prefetch(node, host) for node, host in self.hosts.items()}
+
+    @journaled("delete")
+    def delete_group(
+        self,
+        group_id: str,
+        existing: Optional[Dict[str, Optional[Set[str]]]] = None,
+    ):
+        """
+        Deletes group record from all nodes.
+        existing is the result of prefetch_existence, nodes missing in it
+        are checked by check_group_exists, unless delete is sent with idempotency key,
+        then the response of the delete tells whether the group existed.
+        """
+        # the same as in create_group
+        self.rollback_delete_hosts.clear()
+        key = self.idempotency_key()
+
+        def delete(
+            node: str, host: str, timestamp: float
+        ) -> Tuple[Optional[Response], Optional[bool]]:
+            # (response if delete was sent to the existing group,
+            #  whether the group exists, None if it is unknown)
+            if existing and existing.get(node) is not None:
+                exists = group_id in existing[node]
+            elif key:
+                exists = True
             else:
-                if self.rollback_create_hosts:
-                    self.rollback_create_hosts.pop(0)
+                exists = self.exists(group_id, host, node)
+            if not exists:
+                return None, exists
+            resp = self.send(
+                node,
+                lambda: delete_node_group(
+                    group_id,
+                    host,
+                    node,
+                    session=self.session(host),
+                    idempotency_key=key,
+                ),
+                timestamp,
+                [group_id],
+            )
+            if resp is not None and resp.status_code == 404:
+                return None, False  # nothing was deleted, nothing to roll back
+            return resp, True
 
-    def delete_group(self, group_id: str):
+        if self.fan_out:
+            timestamp = datetime.utcnow().timestamp()
+            results, errors = self.map_writes(
+                lambda node, host: delete(node, host, timestamp), (None, None)
+            )
+            missed = {
+                node: None
+                for node, (resp, exists) in results.items()
+                if exists is None or (exists and not self.acceptable(resp))
+            }
+            if errors or not self.quorum_possible(len(missed)):
+                self.rollback_delete_hosts.extend(
+                    (node, self.hosts[node], timestamp)
+                    for node, (resp, _) in sorted(
+                        results.items(), key=lambda item: item[0] in errors
+                    )
+                    if resp is not None or node in errors
+                )
+                self.rollback_delete(group_id)
+                if errors:
+                    raise next(iter(errors.values()))
+                return
+            self.hint("delete", [group_id], missed)
+            return
+
+        missed = {}
         for node, host in self.hosts.items():
             timestamp = datetime.utcnow().timestamp()
-            if check_group_exists(group_id, host, node):
-                resp = delete_node_group(group_id, host, node)
-            else:
-                break
-            self.rollback_delete_hosts.append((node, host, timestamp))
-            if resp.status_code not in self.acceptable_status_codes:
+            try:
+                resp, exists = delete(node, host, timestamp)
+            except NodeUnavailableError:
+                # the same as in create_group
+                self.rollback_delete_hosts.append((node, host, timestamp))
                 self.rollback_delete(group_id)
+                raise
+            if exists is False:
                 break
+            if resp is not None:
+                self.rollback_delete_hosts.append((node, host, timestamp))
+            if not self.acceptable(resp):
+                # existence is unknown or delete failed
+                missed[node] = None
+                if not self.quorum_possible(len(missed)):
+                    self.rollback_delete(group_id)
+                    return
+        self.hint("delete", [group_id], missed)
 
-    @retry(max_retries=10, sleep=0.1)
     def rollback_delete(self, group_id: str):
+        self.record("rollback")
         while self.rollback_delete_hosts:
             node, host, timestamp = self.rollback_delete_hosts[0]
             logger.info("Trying to rollback")
-            resp = create_node_group(group_id, host, node, timestamp)
-            if resp.status_code not in self.acceptable_status_codes:
-                raise RollbackError
+            self.retry_write(
+                node,
+                lambda: create_node_group(
+                    group_id, host, node, timestamp, self.session(host)
+                ),
+            )
+            self.record("undone", node=node)
+            self.rollback_delete_hosts.pop(0)
+
+    @journaled("create")
+    def create_groups(self, group_ids: List[str]) -> Dict[str, Dict[str, int]]:
+        """
+        Creates list of group records in all nodes, one request per node.
+        Returns map of node -> per groupId statuses, or empty map if the batch was rolled back.
+        """
+        self.rollback_create_batches.clear()
+        key = self.idempotency_key()
+        if self.fan_out:
+            timestamp = datetime.utcnow().timestamp()
+            responses, errors = self.map_writes(
+                lambda node, host: self.send(
+                    node,
+                    lambda: create_node_groups(
+                        group_ids, host, node, timestamp, self.session(host), key
+                    ),
+                    timestamp,
+                    group_ids,
+                )
+            )
+            missed = {
+                node: timestamp
+                for node, resp in responses.items()
+                if not self.acceptable(resp)
+            }
+            if errors or not self.quorum_possible(len(missed)):
+                self.rollback_create_batches.extend(
+                    (node, self.hosts[node], timestamp, group_ids)
+                    for node, resp in sorted(
+                        responses.items(), key=lambda item: item[0] in errors
+                    )
+                    if resp is not None or node in errors
+                )
+                self.rollback_create_groups()
+                if errors:
+                    raise next(iter(errors.values()))
+                return {}
+            self.hint("create", group_ids, missed)
+            return {
+                node: resp.json()
+                for node, resp in responses.items()
+                if node not in missed
+            }
+
+        statuses = {}
+        missed = {}
+        for node, host in self.hosts.items():
+            timestamp = datetime.utcnow().timestamp()
+            try:
+                resp = self.send(
+                    node,
+                    lambda: create_node_groups(
+                        group_ids, host, node, timestamp, self.session(host), key
+                    ),
+                    timestamp,
+                    group_ids,
+                )
+            except NodeUnavailableError:
+                # the same as in create_group
+                self.rollback_create_batches.append((node, host, timestamp, group_ids))
+                self.rollback_create_groups()
+                raise
+            if resp is not None:
+                self.rollback_create_batches.append((node, host, timestamp, group_ids))
+            if not self.acceptable(resp):
+                missed[node] = timestamp
+                if not self.quorum_possible(len(missed)):
+                    self.rollback_create_groups()
+                    return {}
+                continue
+            statuses[node] = resp.json()
+        self.hint("create", group_ids, missed)
+        return statuses
+
+    def rollback_create_groups(self):
+        self.record("rollback")
+        while self.rollback_create_batches:
+            node, host, timestamp, group_ids = self.rollback_create_batches[0]
+            logger.info("Trying to rollback")
+            self.retry_write(
+                node,
+                lambda: delete_node_groups(
+                    group_ids, host, node, timestamp, self.session(host)
+                ),
+            )
+            self.record("undone", node=node)
+            self.rollback_create_batches.pop(0)
+
+    @journaled("delete")
+    def delete_groups(self, group_ids: List[str]) -> Dict[str, Dict[str, int]]:
+        """
+        Deletes list of group records from all nodes, one request per node.
+        The same as in delete_group, existence of the groups is checked before deletion,
+        by one /groups/exists request per node, and groups missing in a node
+        are not deleted from the next nodes.
+        With fan_out, nodes are checked and deleted independently of each other.
+        Returns map of node -> per groupId statuses, or empty map if the batch was rolled back.
+        """
+        self.rollback_delete_batches.clear()
+        key = self.idempotency_key()
+        if self.fan_out:
+            timestamp = datetime.utcnow().timestamp()
+            existing = {}
+
+            def delete(node: str, host: str) -> Tuple[Optional[Response], bool]:
+                # (response if delete was sent, whether the node succeeded)
+                found = self.existing(group_ids, host, node)
+                if found is None:
+                    return None, False
+                existing[node] = found
+                if not found:
+                    return None, True
+                resp = self.send(
+                    node,
+                    lambda: delete_node_groups(
+                        existing[node],
+                        host,
+                        node,
+                        session=self.session(host),
+                        idempotency_key=key,
+                    ),
+                    timestamp,
+                    existing[node],
+                )
+                return resp, self.acceptable(resp)
+
+            results, errors = self.map_writes(delete, (None, False))
+            missed = {node: None for node, (_, ok) in results.items() if not ok}
+            if errors or not self.quorum_possible(len(missed)):
+                self.rollback_delete_batches.extend(
+                    (node, self.hosts[node], timestamp, existing[node])
+                    for node, (resp, _) in sorted(
+                        results.items(), key=lambda item: item[0] in errors
+                    )
+                    if resp is not None or node in errors
+                )
+                self.rollback_delete_groups()
+                if errors:
+                    raise next(iter(errors.values()))
+                return {}
+            self.hint("delete", group_ids, missed)
+            return {
+                node: resp.json()
+                for node, (resp, ok) in results.items()
+                if resp is not None and ok
+            }
+
+        statuses = {}
+        missed = {}
+        requested = group_ids
+        for node, host in self.hosts.items():
+            timestamp = datetime.utcnow().timestamp()
+            found = self.existing(group_ids, host, node)
+            if found is not None and not found:
+                break
+            resp = None
+            if found:
+                group_ids = found
+                try:
+                    resp = self.send(
+                        node,
+                        lambda: delete_node_groups(
+                            group_ids,
+                            host,
+                            node,
+                            session=self.session(host),
+                            idempotency_key=key,
+                        ),
+                        timestamp,
+                        group_ids,
+                    )
+                except NodeUnavailableError:
+                    # the same as in create_group
+                    self.rollback_delete_batches.append(
+                        (node, host, timestamp, group_ids)
+                    )
+                    self.rollback_delete_groups()
+                    raise
+                if resp is not None:
+                    self.rollback_delete_batches.append(
+                        (node, host, timestamp, group_ids)
+                    )
+            if not self.acceptable(resp):
+                # existence is unknown or delete failed
+                missed[node] = None
+                if not self.quorum_possible(len(missed)):
+                    self.rollback_delete_groups()
+                    return {}
+                continue
+            statuses[node] = resp.json()
+        self.hint("delete", requested, missed)
+        return statuses
+
+    def rollback_delete_groups(self):
+        self.record("rollback")
+        while self.rollback_delete_batches:
+            node, host, timestamp, group_ids = self.rollback_delete_batches[0]
+            logger.info("Trying to rollback")
+            self.retry_write(
+                node,
+                lambda: create_node_groups(
+                    group_ids, host, node, timestamp, self.session(host)
+                ),
+            )
+            self.record("undone", node=node)
+            self.rollback_delete_batches.pop(0)
+
+    def repair(self, batch_size: int = 1000) -> Dict[str, Dict[str, List[str]]]:
+        """
+        Finds groups which differ between nodes and repairs them.
+        Nodes' hash trees are compared level by level, descending only into buckets which differ,
+        and only contents of the divergent leaf buckets are downloaded.
+        Group which exists in the majority of nodes (at least half of them) is created in
+        the nodes missing it, otherwise it is deleted from the nodes having it.
+        Returns map of node -> {"created": [...], "deleted": [...]}
+        """
+        level = 0
+        prefixes = None
+        while True:
+            trees = {
+                node: get_node_tree(host, node, level, prefixes, self.session(host))
+                for node, host in self.hosts.items()
+            }
+            buckets = set().union(*(tree["buckets"] for tree in trees.values()))
+            prefixes = sorted(
+                int(bucket)
+                for bucket in buckets
+                if len({str(tree["buckets"].get(bucket)) for tree in trees.values()})
+                > 1
+            )
+            depth = next(iter(trees.values()))["depth"]
+            logger.info("Tree level %s, %s divergent buckets", level, len(prefixes))
+            if not prefixes or level == depth:
+                break
+            level += 1
+
+        contents = {
+            node: get_node_tree_groups(host, node, prefixes, self.session(host))
+            for node, host in self.hosts.items()
+        }
+        repairs = {node: {"created": [], "deleted": []} for node in self.hosts}
+        for bucket in prefixes:
+            presence = {}
+            for node in self.hosts:
+                for group_id in contents[node].get(str(bucket), []):
+                    presence.setdefault(group_id, set()).add(node)
+            for group_id, nodes in presence.items():
+                if len(nodes) == len(self.hosts):
+                    continue
+                if 2 * len(nodes) >= len(self.hosts):
+                    for node in self.hosts.keys() - nodes:
+                        repairs[node]["created"].append(group_id)
+                else:
+                    for node in nodes:
+                        repairs[node]["deleted"].append(group_id)
+
+        for node, host in self.hosts.items():
+            for action, write in (
+                ("created", create_node_groups),
+                ("deleted", delete_node_groups),
+            ):
+                group_ids = repairs[node][action]
+                for i in range(0, len(group_ids), batch_size):
+                    self.repair_node_groups(
+                        write, group_ids[i : i + batch_size], host, node
+                    )
+            logger.info(
+                "Repaired %s: %s created, %s deleted",
+                node,
+                len(repairs[node]["created"]),
+                len(repairs[node]["deleted"]),
+            )
+        return repairs
+
+    def repair_node_groups(self, write, group_ids: List[str], host: str, node: str):
+        """
+        Calls batch write function (create_node_groups/delete_node_groups) for one node.
+        Both are idempotent, so the call is retried by the policy until it gets acceptable response
+        """
+        if write is delete_node_groups:
+            self.retry_write(
+                node, lambda: write(group_ids, host, node, session=self.session(host))
+            )
+        else:
+            self.retry_write(
+                node,
+                lambda: write(
+                    group_ids,
+                    host,
+                    node,
+                    datetime.utcnow().timestamp(),
+                    self.session(host),
+                ),
+            )
+
+    def recover(self) -> Dict[str, int]:
+        """
+        Finishes or undoes operations which are not ended in the journal files of journal_dir
+        whose processes exited, e.g. because the process crashed in the middle of create_group.
+        Files of running processes (job.py running meanwhile) are left to them.
+        Operations are replayed in the order they began, each only for groupIds no operation
+        of the journals began on later, the later one decides the state of the groupId:
+            - operation without rollback record is finished: its write is repeated on all nodes,
+              both batch create and batch delete are idempotent
+            - operation with rollback record is undone: nodes with intent and without
+              undone record get the inverse write, with the timestamp of the intent
+        Operations which couldn't be recovered are kept in a new journal file,
+        scanned files are removed.
+        Returns:
+            {"finished": int, "undone": int, "superseded": int, "failed": int}
+        """
+        paths = journal_files(self.journal_dir)
+        last = last_begins(read_records(paths))
+        locked = lock_abandoned(paths)
+        try:
+            operations = incomplete_operations(read_records(locked))
+            logger.info(
+                "%s incomplete operations in %s journal files, %s of running processes",
+                len(operations),
+                len(locked),
+                len(paths) - len(locked),
+            )
+            result = {"finished": 0, "undone": 0, "superseded": 0, "failed": 0}
+            failed = []
+            for op, operation in sorted(
+                operations.items(), key=lambda item: item[1]["time"]
+            ):
+                if not operation["intents"]:
+                    continue  # nothing was sent to the nodes
+                replayed = unsuperseded(operation, last)
+                if replayed is None:
+                    result["superseded"] += 1
+                    continue
+                try:
+                    if operation["rollback"]:
+                        self.undo_operation(replayed)
+                        result["undone"] += 1
+                    else:
+                        self.finish_operation(replayed)
+                        result["finished"] += 1
+                except (RollbackError, KeyError):
+                    logger.exception("Failed to recover operation %s", op)
+                    failed.append(operation)
+                    result["failed"] += 1
+            compact(self.journal_dir, list(locked), failed)
+        finally:
+            unlock(locked)
+        return result
+
+    def finish_operation(self, operation: Dict):
+        """Repeats write of the journaled operation on all nodes"""
+        group_ids = operation["groupIds"]
+        timestamp = datetime.utcnow().timestamp()
+        for node, host in self.hosts.items():
+            if operation["action"] == "create":
+                self.retry_write(
+                    node,
+                    lambda: create_node_groups(
+                        group_ids, host, node, timestamp, self.session(host)
+                    ),
+                )
+            else:
+                self.retry_write(
+                    node,
+                    lambda: delete_node_groups(
+                        group_ids, host, node, session=self.session(host)
+                    ),
+                )
+
+    def node_groups(
+        self, node: str, order: str = "id", max_restarts: int = 10
+    ) -> Iterator[Dict]:
+        """
+        Yields records of the node ({"id", "groupId", "timestamp"}) in the given order,
+        as they are streamed by the node, so the node isn't loaded into memory.
+        Listing which broke off is continued after the last received record,
+        at most max_restarts times.
+        """
+        host = self.hosts[node]
+        cursor = None
+        restarts = 0
+        while True:
+            resp = self.policy.call(
+                node,
+                lambda: list_node_groups(host, node, order, cursor, self.session(host)),
+                (200,),
+            )
+            try:
+                resp.raise_for_status()
+                for line in resp.iter_lines(chunk_size=65536):
+                    if line:
+                        record = json.loads(line)
+                        cursor = record[order]
+                        yield record
+                return
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                restarts += 1
+                if restarts > max_restarts:
+                    raise
+                logger.warning("Listing of %s broke off after %s", node, cursor)
+            finally:
+                resp.close()
+
+    def save_snapshot(self, node: str, file: BinaryIO) -> int:
+        """
+        Writes binary snapshot of the node into the file, as it is streamed by the node.
+        Returns number of written bytes.
+        Snapshot is read in one transaction of the node, so a snapshot which broke off
+        isn't continued, the exception is raised and the file should be written again.
+        """
+        host = self.hosts[node]
+        resp = self.policy.call(
+            node, lambda: get_node_snapshot(host, node, self.session(host)), (200,)
+        )
+        size = 0
+        try:
+            resp.raise_for_status()
+            for chunk in resp.iter_content(chunk_size=SNAPSHOT_CHUNK):
+                file.write(chunk)
+                size += len(chunk)
+        finally:
+            resp.close()
+        return size
+
+    def restore_snapshot(
+        self,
+        node: str,
+        data: Union[bytes, BinaryIO, Iterable[bytes]],
+        merge: bool = False,
+    ) -> Dict[str, int]:
+        """
+        Loads binary snapshot into the node, replacing its records, or adding the missing ones
+        with merge. data is uploaded as it is read, so it isn't retried, a file or iterator
+        can't be read again. There is no read timeout, the node responds when the load is done.
+        Returns {"records", "inserted", "deleted"} of the node.
+        """
+        host = self.hosts[node]
+        resp = self.policy.call(
+            node,
+            lambda: put_node_snapshot(
+                data,
+                host,
+                node,
+                "merge" if merge else "replace",
+                (self.timeout[0], None),
+                self.session(host),
+            ),
+            (200,),
+            max_retries=0,
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    def copy_node(
+        self, source: str, target: str, merge: bool = False
+    ) -> Dict[str, int]:
+        """
+        Restores target node from the snapshot of source node. Snapshot is piped from one
+        node to the other, without writing it to the disk or reading it into memory.
+        Returns {"records", "inserted", "deleted"} of the target node.
+        """
+        host = self.hosts[source]
+        resp = self.policy.call(
+            source, lambda: get_node_snapshot(host, source, self.session(host)), (200,)
+        )
+        try:
+            resp.raise_for_status()
+            return self.restore_snapshot(
+                target, resp.iter_content(chunk_size=SNAPSHOT_CHUNK), merge
+            )
+        finally:
+            resp.close()
+
+    def diff_groups(self, nodes: Optional[List[str]] = None) -> Iterator[Dict]:
+        """
+        Yields groups which are missing in some of the nodes (all nodes by default),
+        {"groupId": ..., "nodes": [nodes having it]}, in the order of groupIds.
+        Listings of the nodes ordered by groupId are merged as they are streamed,
+        so memory use doesn't depend on the number of groups.
+        """
+        nodes = list(nodes or self.hosts)
+
+        def tagged(node: str) -> Iterator[Tuple[str, str]]:
+            for record in self.node_groups(node, "groupId"):
+                yield record["groupId"], node
+
+        merged = heapq.merge(*(tagged(node) for node in nodes))
+        for group_id, having in groupby(merged, key=itemgetter(0)):
+            having = [node for _, node in having]
+            if len(having) < len(nodes):
+                yield {"groupId": group_id, "nodes": having}
+
+    def undo_operation(self, operation: Dict):
+        """
+        Sends inverse writes of the journaled operation to the nodes not undone yet.
+        Delete which got 404 didn't delete anything, it has nothing to undo
+        """
+        for node, (timestamp, group_ids) in operation["intents"].items():
+            if node in operation["undone"]:
+                continue
+            if operation["action"] == "delete" and operation["done"].get(node) == 404:
+                continue
+            host = self.hosts[node]
+            if operation["action"] == "create":
+                self.retry_write(
+                    node,
+                    lambda: delete_node_groups(
+                        group_ids, host, node, timestamp, self.session(host)
+                    ),
+                )
             else:
-                if self.rollback_delete_hosts:
-                    self.rollback_delete_hosts.pop(0)
+                self.retry_write(
+                    node,
+                    lambda: create_node_groups(
+                        group_ids, host, node, timestamp, self.session(host)
+                    ),
+                )
@@ -0,0 +1,162 @@
+"""
+Hinted handoff of quorum writes.
+
+In quorum mode a Connector operation succeeds once write_quorum nodes acknowledged it.
+Nodes which missed the write get a hint: the write is queued here and delivered
+to them by a background thread, retried with exponential backoff until it succeeds.
+Both batch create and batch delete are idempotent, so a hint can be delivered to a node
+which applied the write despite the failed response.
+
+Hints live in the memory of the process. Operation with undelivered hints is not ended
+in the write-ahead journal, so hints lost with a crashed process are delivered by
+Connector.recover, which repeats unfinished operations on all nodes.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Hint:
+    """
+    Write which missed some nodes.
+        op       -> id of the journaled operation, None without journal
+        action   -> "create"/"delete"
+        groupIds -> groupIds of the write
+        nodes    -> node -> timestamp of the write, nodes which didn't get it yet
+    """
+
+    def __init__(
+        self,
+        op: Optional[str],
+        action: str,
+        group_ids: List[str],
+        nodes: Dict[str, Optional[float]],
+    ):
+        self.op = op
+        self.action = action
+        self.group_ids = group_ids
+        self.nodes = dict(nodes)
+        self.attempts = 0
+
+
+class HintedHandoff:
+    """
+    Args:
+        deliver: function sending the hint to one node, raises if it didn't succeed
+        delivered: function called when the hint reached all its nodes
+        retry_interval: seconds before the first redelivery, doubled by every failure
+        max_retry_interval: upper limit of the interval between redeliveries
+    """
+
+    def __init__(
+        self,
+        deliver: Callable[[str, Hint], None],
+        delivered: Callable[[Hint], None],
+        retry_interval: float = 0.5,
+        max_retry_interval: float = 30.0,
+    ):
+        self.deliver = deliver
+        self.delivered = delivered
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self._condition = threading.Condition()
+        self._queue = []  # heap of (due time, sequence number, Hint)
+        self._seq = itertools.count()
+        self._busy = False  # worker is delivering a hint taken from the queue
+        self._closed = False
+        self._thread = None
+        self.counters = dict.fromkeys(("queued", "delivered", "redeliveries"), 0)
+
+    def put(self, hint: Hint):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="handoff", daemon=True
+                )
+                self._thread.start()
+            self.counters["queued"] += 1
+            heapq.heappush(self._queue, (time.monotonic(), next(self._seq), hint))
+            self._condition.notify_all()
+
+    def pending(self) -> int:
+        """Number of hints not delivered to all their nodes yet"""
+        with self._condition:
+            return len(self._queue) + self._busy
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until all hints are delivered, hints waiting for redelivery are tried immediately.
+        Returns False if some hints are still pending after timeout seconds
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._queue = [(0, seq, hint) for _, seq, hint in self._queue]
+            heapq.heapify(self._queue)
+            self._condition.notify_all()
+            while self._queue or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self, timeout: Optional[float] = None) -> int:
+        """
+        Flushes hints for at most timeout seconds and stops the worker.
+        Returns number of hints left undelivered
+        """
+        self.flush(timeout)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            return len(self._queue) + self._busy
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and (
+                    not self._queue or self._queue[0][0] > time.monotonic()
+                ):
+                    self._condition.wait(
+                        self._queue[0][0] - time.monotonic() if self._queue else None
+                    )
+                if self._closed:
+                    return
+                _, _, hint = heapq.heappop(self._queue)
+                self._busy = True
+            self._deliver(hint)
+            if not hint.nodes:
+                try:
+                    self.delivered(hint)
+                except Exception:
+                    logger.exception("Failed to complete delivered %s", hint.action)
+            with self._condition:
+                self._busy = False
+                if hint.nodes:
+                    hint.attempts += 1
+                    self.counters["redeliveries"] += 1
+                    delay = min(
+                        self.max_retry_interval,
+                        self.retry_interval * 2 ** (hint.attempts - 1),
+                    )
+                    heapq.heappush(
+                        self._queue, (time.monotonic() + delay, next(self._seq), hint)
+                    )
+                else:
+                    self.counters["delivered"] += 1
+                self._condition.notify_all()
+
+    def _deliver(self, hint: Hint):
+        for node in list(hint.nodes):
+            try:
+                self.deliver(node, hint)
+            except Exception:
+                logger.exception("Failed to hand off %s to %s", hint.action, node)
+                continue
+            del hint.nodes[node]
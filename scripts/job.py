@@ -1,64 +1,431 @@
-from multiprocessing import Pool
+import json
+from typing import Dict
 
 import click
 import requests
-from connector import Connector
+from connector import Connector, merge_metrics, render_metrics
+from runner import AdaptiveLimit, read_group_ids, run_job
 import logging
 
 logger = logging.getLogger("JOB")
 logging.basicConfig(level="INFO")
 
-# For running job script in local machine, use these hosts and uncomment `ports` block in `docker-compose.yaml`
-# HOSTS = {
-#     "node01": "http://127.0.0.1:8080",
-#     "node02": "http://127.0.0.1:8080",
-#     "node03": "http://127.0.0.1:8080",
-# }
-
+# Nodes are node01..nodeNN, the same registry as NODES of the cluster config.
+# Url of every node is HOST_TEMPLATE with {node} replaced by the node name.
+# For running job script in local machine, use --host-template http://127.0.0.1:8080
+# and uncomment `ports` block in `docker-compose.yaml`
+N_NODES = 3  # Default number of nodes
 # For running job script in docker container
-HOSTS = {
-    "node01": "http://node01.app.internal.com/v1",
-    "node02": "http://node02.app.internal.com/v1",
-    "node03": "http://node03.app.internal.com/v1",
-}
-N_PROC = 16  # Number of parallel processes
+HOST_TEMPLATE = "http://{node}.app.internal.com/v1"
+N_PROC = 16  # Default number of parallel processes
+ADAPTIVE_MAX_PROC = 64  # Default maximum number of processes with --adaptive
 
 test_groupId_list = [str(i) for i in range(0, 100)]  # groupIds list for tests
 
 
 @click.group()
-def cli():
-    pass
+@click.option(
+    "--nodes",
+    default=N_NODES,
+    show_default=True,
+    envvar="NODE_COUNT",
+    help="Number of nodes node01..nodeNN, NODE_COUNT of the cluster",
+)
+@click.option(
+    "--host-template",
+    default=HOST_TEMPLATE,
+    show_default=True,
+    help="Url of the node, {node} is replaced by the node name",
+)
+@click.option(
+    "--fan-out",
+    is_flag=True,
+    help="Send requests of one operation to all nodes concurrently",
+)
+@click.option(
+    "--pool-size",
+    default=10,
+    show_default=True,
+    help="Number of keep-alive connections per host in every process, 0 disables pooling",
+)
+@click.option(
+    "--timeout",
+    default=30.0,
+    show_default=True,
+    help="Read timeout of the requests in seconds",
+)
+@click.option(
+    "--journal-dir",
+    default="journal",
+    show_default=True,
+    help="Directory of the write-ahead journal used by recover command, empty string disables it",
+)
+@click.option(
+    "--write-quorum",
+    type=int,
+    default=None,
+    help="Number of nodes which must acknowledge a write, the rest get it by hinted handoff. "
+    "All nodes if not given",
+)
+@click.option(
+    "--hedge-percentile",
+    type=float,
+    default=None,
+    help="Existence check slower than this percentile of the recent ones (e.g. 0.95) "
+    "is sent again, and the first response is used",
+)
+@click.option(
+    "--idempotency-keys/--no-idempotency-keys",
+    default=True,
+    show_default=True,
+    help="Send writes with Idempotency-Key header and retry them, "
+    "instead of sending them once and rolling back failures",
+)
+@click.option(
+    "--metrics-file",
+    default=None,
+    help="File to write client metrics (retries, rollbacks, latency per node) into "
+    "when the command ends, in Prometheus text format",
+)
+@click.pass_context
+def cli(
+    ctx,
+    nodes,
+    host_template,
+    fan_out,
+    pool_size,
+    timeout,
+    journal_dir,
+    write_quorum,
+    hedge_percentile,
+    idempotency_keys,
+    metrics_file,
+):
+    ctx.obj = {
+        "hosts": node_hosts(nodes, host_template),
+        "write_quorum": write_quorum,
+        "hedge_percentile": hedge_percentile,
+        "idempotency_keys": idempotency_keys,
+        "fan_out": fan_out,
+        "pool_size": pool_size,
+        "timeout": timeout,
+        "journal_dir": journal_dir,
+        "metrics": {},  # merged metrics of the connectors of bulk command workers
+        "connectors": [],  # connectors created in this process
+    }
+    if metrics_file:
+        ctx.call_on_close(lambda: write_metrics(ctx.obj, metrics_file))
+
+
+def write_metrics(obj: dict, path: str):
+    """Writes metrics of all connectors of the command into the file"""
+    metrics = obj["metrics"]
+    for connector in obj["connectors"]:
+        merge_metrics(metrics, connector.metrics())
+    with open(path, "w") as f:
+        f.write(render_metrics(metrics))
+
+
+def node_hosts(n_nodes: int, host_template: str) -> Dict[str, str]:
+    """node -> url map of nodes node01..nodeNN"""
+    nodes = [f"node{i:02d}" for i in range(1, n_nodes + 1)]
+    return {node: host_template.format(node=node) for node in nodes}
+
+
+def hosts() -> Dict[str, str]:
+    """node -> url map configured by global options of the cli"""
+    return click.get_current_context().obj["hosts"]
+
+
+def connector_options() -> dict:
+    """Keyword arguments of Connector configured by global options of the cli"""
+    options = click.get_current_context().obj
+    return {
+        "fan_out": options["fan_out"],
+        "pool_size": options["pool_size"],
+        "timeout": (3.05, options["timeout"]),
+        "journal_dir": options["journal_dir"] or None,
+        "write_quorum": options["write_quorum"],
+        "hedge_percentile": options["hedge_percentile"],
+        "idempotency_keys": options["idempotency_keys"],
+    }
+
+
+def make_connector() -> Connector:
+    """Creates Connector configured by global options of the cli"""
+    connector = Connector(hosts(), **connector_options())
+    click.get_current_context().obj["connectors"].append(connector)
+    return connector
 
 
 @cli.command(name="stats", help="Shows the statistics of the groups")
-def stats():
+@click.option(
+    "--full",
+    is_flag=True,
+    help="Recount statistics from the node tables and repair the counters",
+)
+def stats(full):
     logger.info("Running stats command for showing statistics of group records")
-    url = HOSTS[
-        "node01"
-    ]  # Could be used, one of the nodes arbitrary /"node02", "node03"/
-    resp = requests.get(f"{url}/stats")
+    url = next(iter(hosts().values()))  # Could be used, any of the nodes arbitrary
+    resp = requests.get(f"{url}/stats", params={"full": 1} if full else None)
     click.echo(resp.json())
 
 
+def bulk_options(func):
+    """Options shared by bulk create and delete commands"""
+    options = [
+        click.option(
+            "--input",
+            "input_file",
+            type=click.File("r"),
+            default=None,
+            help="File with one groupId per line, '-' for stdin. "
+            "If not given, global parameter <test_group_list> is used",
+        ),
+        click.option(
+            "--chunk-size",
+            default=1,
+            show_default=True,
+            help="Number of groupIds sent in one request, values above 1 use batch /groups endpoint",
+        ),
+        click.option(
+            "--concurrency",
+            type=int,
+            default=None,
+            help=f"Number of worker processes, {N_PROC} by default. "
+            f"With --adaptive maximum of the limit, {ADAPTIVE_MAX_PROC} by default",
+        ),
+        click.option(
+            "--adaptive",
+            is_flag=True,
+            help="Adjust number of requests in flight by AIMD, from latency and error rate",
+        ),
+        click.option(
+            "--min-concurrency",
+            default=1,
+            show_default=True,
+            help="With --adaptive, the limit starts at it and is never lowered below it",
+        ),
+        click.option(
+            "--target-latency",
+            type=float,
+            default=None,
+            help="With --adaptive, milliseconds of one task (task-size groupIds or a chunk). "
+            "Twice the lowest latency seen by default",
+        ),
+        click.option(
+            "--target-error-rate",
+            type=float,
+            default=None,
+            help="With --adaptive, retried requests and rollbacks per request. "
+            "Moving average of error rate plus 0.05 by default",
+        ),
+        click.option(
+            "--limit-log",
+            type=click.File("w"),
+            default=None,
+            help="With --adaptive, JSON lines of the limit chosen after every window of tasks",
+        ),
+        click.option(
+            "--checkpoint",
+            default=None,
+            help="Progress file, interrupted job is resumed from it when run with the same input",
+        ),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def run_bulk(
+    command,
+    input_file,
+    chunk_size,
+    concurrency,
+    checkpoint,
+    adaptive,
+    min_concurrency,
+    target_latency,
+    target_error_rate,
+    limit_log,
+):
+    if input_file is None:
+        group_ids = test_groupId_list
+    else:
+        group_ids = read_group_ids(input_file)
+    limiter = None
+    if adaptive:
+        maximum = concurrency or ADAPTIVE_MAX_PROC
+        limiter = AdaptiveLimit(
+            minimum=min_concurrency,
+            maximum=maximum,
+            target_latency=target_latency / 1000 if target_latency else None,
+            target_error_rate=target_error_rate,
+        )
+        logger.info(
+            "Running parallel %s command, adaptive concurrency <%s..%s>",
+            command,
+            limiter.minimum,
+            limiter.maximum,
+        )
+    else:
+        concurrency = concurrency or N_PROC
+        logger.info(
+            "Running parallel %s command, concurrency <%s>", command, concurrency
+        )
+    result = run_job(
+        command,
+        group_ids,
+        hosts(),
+        connector_options(),
+        concurrency=concurrency or N_PROC,
+        chunk_size=chunk_size,
+        checkpoint_path=checkpoint,
+        metrics=click.get_current_context().obj["metrics"],
+        limiter=limiter,
+    )
+    limits = result.pop("limits", None)
+    if limits is not None:
+        if limit_log is not None:
+            for entry in limits:
+                limit_log.write(json.dumps(entry) + "\n")
+        result["limit"] = limiter.limit
+        result["max_limit"] = max(
+            [entry["limit"] for entry in limits], default=limiter.limit
+        )
+    click.echo(result)
+
+
 @cli.command(
     name="create",
-    help="Creates bunch of groups specified in global parameter <test_group_list>",
+    help="Creates bunch of groups from --input or global parameter <test_group_list>",
 )
-def parallel_creates():
-    logger.info("Running parallel creates command on <%s> items", len(test_groupId_list))
-    with Pool(N_PROC) as p:
-        p.map(Connector(HOSTS).create_group, test_groupId_list)
+@bulk_options
+def parallel_creates(**options):
+    run_bulk("create", **options)
 
 
 @cli.command(
     name="delete",
-    help="Deletes bunch of groups specified in global parameter <test_group_list>",
+    help="Deletes bunch of groups from --input or global parameter <test_group_list>",
+)
+@bulk_options
+def parallel_deletes(**options):
+    run_bulk("delete", **options)
+
+
+@cli.command(
+    name="repair",
+    help="Finds groups which differ between nodes and repairs them by majority of nodes",
+)
+def repair():
+    logger.info("Running repair command")
+    repairs = make_connector().repair()
+    click.echo(
+        {
+            node: {action: len(group_ids) for action, group_ids in actions.items()}
+            for node, actions in repairs.items()
+        }
+    )
+
+
+@cli.command(
+    name="export",
+    help="Streams groups of the nodes as NDJSON, or with --diff groups missing in some nodes",
+)
+@click.option(
+    "--node",
+    "nodes",
+    multiple=True,
+    help="Node to export, repeatable. All nodes if not given",
+)
+@click.option(
+    "--output",
+    type=click.File("w"),
+    default="-",
+    show_default=True,
+    help="File of the NDJSON output",
+)
+@click.option(
+    "--diff",
+    is_flag=True,
+    help="Write groupIds which are missing in some of the nodes, with the nodes having them",
+)
+def export(nodes, output, diff):
+    """
+    Records are written as they are streamed from the nodes, memory use doesn't depend
+    on the number of groups, the same for --diff, which merges listings ordered by groupId.
+    """
+    logger.info("Running export command")
+    connector = make_connector()
+    nodes = list(nodes or hosts())
+    count = 0
+    if diff:
+        records = connector.diff_groups(nodes)
+    else:
+        records = (
+            {"node": node, **record}
+            for node in nodes
+            for record in connector.node_groups(node)
+        )
+    for record in records:
+        output.write(json.dumps(record) + "\n")
+        count += 1
+    logger.info("Exported %s records", count)
+
+
+@cli.command(
+    name="snapshot",
+    help="Writes binary snapshot of the node's groups into a file",
+)
+@click.option("--node", required=True, help="Node to snapshot")
+@click.option(
+    "--output", type=click.File("wb"), required=True, help="File of the snapshot"
+)
+def snapshot(node, output):
+    logger.info("Running snapshot command for %s", node)
+    size = make_connector().save_snapshot(node, output)
+    logger.info("Wrote snapshot of %s, %s bytes", node, size)
+
+
+@cli.command(
+    name="restore",
+    help="Loads binary snapshot into the node, from a file or from another node",
+)
+@click.option("--node", required=True, help="Node to restore")
+@click.option(
+    "--input", "input_file", type=click.File("rb"), help="File of the snapshot"
+)
+@click.option(
+    "--from-node",
+    help="Node which snapshot is piped into the restored node, instead of --input",
+)
+@click.option(
+    "--merge",
+    is_flag=True,
+    help="Add groups missing in the node instead of replacing its groups",
+)
+def restore(node, input_file, from_node, merge):
+    if (input_file is None) == (from_node is None):
+        raise click.UsageError("Exactly one of --input and --from-node is required")
+    logger.info("Running restore command for %s", node)
+    connector = make_connector()
+    if from_node is not None:
+        result = connector.copy_node(from_node, node, merge)
+    else:
+        result = connector.restore_snapshot(node, input_file, merge)
+    click.echo(result)
+
+
+@cli.command(
+    name="recover",
+    help="Finishes or undoes operations interrupted by a crash, using the journal",
 )
-def parallel_deletes():
-    logger.info("Running parallel deletes command on <%s> items", len(test_groupId_list))
-    with Pool(N_PROC) as p:
-        p.map(Connector(HOSTS).delete_group, test_groupId_list)
+def recover():
+    if not click.get_current_context().obj["journal_dir"]:
+        raise click.UsageError("recover command requires --journal-dir")
+    logger.info("Running recover command")
+    click.echo(make_connector().recover())
 
 
 @cli.command(
@@ -68,7 +435,9 @@ def parallel_deletes():
 @click.argument('group_id', required=1)
 def delete_one(group_id):
     logger.info("Running delete-one command with groupId <%s>", group_id)
-    Connector(HOSTS).delete_group(group_id)
+    connector = make_connector()
+    connector.delete_group(group_id)
+    connector.close()  # delivers hints of quorum write
 
 
 @cli.command(
@@ -78,7 +447,9 @@ def delete_one(group_id):
 @click.argument('group_id', required=1)
 def create_one(group_id):
     logger.info("Running create-one command with groupId <%s>", group_id)
-    Connector(HOSTS).create_group(group_id)
+    connector = make_connector()
+    connector.create_group(group_id)
+    connector.close()  # delivers hints of quorum write
 
 
 if __name__ == "__main__":
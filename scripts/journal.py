@@ -0,0 +1,294 @@
+"""
+Write-ahead intent journal of Connector operations.
+
+Every create/delete operation of the Connector appends records to the journal:
+    begin    -> operation started, action and groupIds
+    intent   -> before a write is sent to the node, node, timestamp and groupIds of the write
+    done     -> after the write, status code of the response
+    rollback -> rollback of the operation started
+    undone   -> rollback write of the node succeeded
+    end      -> operation finished, either applied to all nodes or rolled back
+
+Every record is written to the file by one os.write call, so it reaches the OS as soon as
+it is appended and survives the crash of the process. fsync, which protects it from the crash
+of the machine, is done at most every sync_interval seconds, so writes aren't serialised on it.
+
+Each process appends to its own file in the journal directory, and holds flock of it while
+it is open. Connector.recover finishes operations of the files whose writers exited (the lock
+is free), which were interrupted before rollback (writes are repeated on all nodes, both create
+and delete are idempotent), and undoes operations interrupted during rollback. Files of running
+processes are only read: an operation is replayed only for groupIds no operation began on
+later (begin records carry the time), so a replayed write doesn't revert a later one.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    """
+    Append-only journal file of one process.
+    Records of the operations which are not ended are kept in memory, when file grows
+    above max_bytes it is rewritten with these records only.
+    The file is created under a temporary name and locked before it is given its name,
+    so recover never sees it unlocked while the journal is open.
+    """
+
+    def __init__(
+        self, path: str, sync_interval: float = 0.05, max_bytes: int = 64 * 2**20
+    ):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.max_bytes = max_bytes
+        self.pending: Dict[str, List[bytes]] = {}  # op -> records of not ended op
+        self._lock = threading.Lock()
+        self._fd = locked_file(f"{path}.new")
+        os.rename(f"{path}.new", path)
+        self._size = 0
+        self._synced_at = time.monotonic()
+
+    def append(self, record: Dict):
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode()
+        with self._lock:
+            os.write(self._fd, line)
+            self._size += len(line)
+            if record["type"] == "end":
+                self.pending.pop(record["op"], None)
+            else:
+                self.pending.setdefault(record["op"], []).append(line)
+            if time.monotonic() - self._synced_at >= self.sync_interval:
+                self._sync()
+            if self._size > self.max_bytes:
+                self._rotate()
+
+    def _sync(self):
+        os.fsync(self._fd)
+        self._synced_at = time.monotonic()
+
+    def _rotate(self):
+        """
+        Replaces the file by the records of not ended operations. The new file is locked
+        before it replaces the old one, whose lock is held until then
+        """
+        tmp_path = f"{self.path}.tmp"
+        fd = locked_file(tmp_path)
+        try:
+            data = b"".join(line for lines in self.pending.values() for line in lines)
+            os.write(fd, data)
+            os.fsync(fd)
+        except BaseException:
+            os.close(fd)
+            raise
+        os.replace(tmp_path, self.path)
+        os.close(self._fd)
+        self._fd = fd
+        self._size = len(data)
+        self._synced_at = time.monotonic()
+
+    def close(self):
+        """
+        Closes the file, which is removed if all its operations are ended,
+        while it is still locked, so recover never takes it
+        """
+        with self._lock:
+            if self._fd is not None:
+                if self.pending:
+                    self._sync()
+                else:
+                    os.remove(self.path)
+                os.close(self._fd)
+                self._fd = None
+
+
+def locked_file(path: str) -> int:
+    """Creates empty file opened for appending, returns its descriptor holding flock of it"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def lock_abandoned(paths: Iterable[str]) -> Dict[str, int]:
+    """
+    Locks journal files of processes which exited. Files locked by their writer
+    or by another recover are skipped.
+    Returns map of path -> descriptor holding the lock, released by unlock
+    """
+    locked = {}
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue  # removed by another recover
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # rotated file was replaced by a new one of the running writer
+            if os.fstat(fd).st_ino != os.stat(path).st_ino:
+                raise FileNotFoundError(path)
+        except OSError:
+            os.close(fd)
+            continue
+        locked[path] = fd
+    return locked
+
+
+def unlock(locked: Dict[str, int]):
+    for fd in locked.values():
+        os.close(fd)
+
+
+def new_op_id() -> str:
+    return uuid.uuid4().hex
+
+
+def journal_path(directory: str) -> str:
+    """
+    New journal file of the current process. Start time is a part of the name,
+    so a process reusing pid of a crashed one doesn't rotate away its records.
+    """
+    return os.path.join(
+        directory, f"journal-{os.getpid()}-{int(time.time() * 1000)}.log"
+    )
+
+
+def journal_files(directory: Optional[str]) -> List[str]:
+    """Journal files of the directory, none if the journal is disabled (no directory)"""
+    if not directory or not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith("journal-") and name.endswith(".log")
+    )
+
+
+def read_records(paths: Iterable[str]) -> Iterator[Dict]:
+    """
+    Yields records of the journal files. Torn last line of a crashed process is skipped.
+    """
+    for path in paths:
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning("Skipping broken record of %s", path)
+
+
+def incomplete_operations(records: Iterable[Dict]) -> Dict[str, Dict]:
+    """
+    Replays records in one pass, only operations which are not ended are kept.
+    Returns map of op -> {
+        "action": "create"/"delete",
+        "groupIds": [...],
+        "time": time of begin, 0 for journals written before it was recorded,
+        "intents": {node: [timestamp, groupIds]},
+        "done": {node: status code, None if the write failed without response},
+        "rollback": bool,
+        "undone": [node, ...],
+        "records": [record, ...],
+    }
+    """
+    operations = {}
+    for record in records:
+        op, type_ = record["op"], record["type"]
+        if type_ == "end":
+            operations.pop(op, None)
+            continue
+        operation = operations.setdefault(
+            op,
+            {
+                "action": None,
+                "groupIds": [],
+                "time": 0.0,
+                "intents": {},
+                "done": {},
+                "rollback": False,
+                "undone": [],
+                "records": [],
+            },
+        )
+        operation["records"].append(record)
+        if type_ == "begin":
+            operation["action"] = record["action"]
+            operation["groupIds"] = record["groupIds"]
+            operation["time"] = record.get("time", 0.0)
+        elif type_ == "intent":
+            operation["intents"][record["node"]] = [
+                record["timestamp"],
+                record["groupIds"],
+            ]
+        elif type_ == "done":
+            operation["done"][record["node"]] = record["status"]
+        elif type_ == "rollback":
+            operation["rollback"] = True
+        elif type_ == "undone":
+            operation["undone"].append(record["node"])
+    return operations
+
+
+def last_begins(records: Iterable[Dict]) -> Dict[str, float]:
+    """Returns map of groupId -> time of the last operation which began on it"""
+    last = {}
+    for record in records:
+        if record["type"] == "begin":
+            began = record.get("time", 0.0)
+            for group_id in record["groupIds"]:
+                if began > last.get(group_id, 0.0):
+                    last[group_id] = began
+    return last
+
+
+def unsuperseded(operation: Dict, last: Dict[str, float]) -> Optional[Dict]:
+    """
+    Operation of incomplete_operations restricted to groupIds no later operation began on
+    (last_begins), None if every groupId was written later
+    """
+    kept = {
+        group_id
+        for group_id in operation["groupIds"]
+        if last.get(group_id, 0.0) <= operation["time"]
+    }
+    if len(kept) == len(set(operation["groupIds"])):
+        return operation
+    if not kept:
+        return None
+    intents = {}
+    for node, (timestamp, group_ids) in operation["intents"].items():
+        group_ids = [group_id for group_id in group_ids if group_id in kept]
+        if group_ids:
+            intents[node] = [timestamp, group_ids]
+    return dict(
+        operation,
+        groupIds=[group_id for group_id in operation["groupIds"] if group_id in kept],
+        intents=intents,
+    )
+
+
+def compact(directory: str, paths: List[str], operations: Iterable[Dict]):
+    """
+    Replaces scanned journal files, locked by lock_abandoned, by one file with records
+    of the given operations
+    """
+    journal = None
+    for operation in operations:
+        if journal is None:
+            journal = Journal(journal_path(directory))
+        for record in operation["records"]:
+            journal.append(record)
+    if journal is not None:
+        journal.close()
+    for path in paths:
+        if journal is None or path != journal.path:
+            os.remove(path)
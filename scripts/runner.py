@@ -0,0 +1,525 @@
+"""
+Streaming job runner used by bulk commands of job.py.
+
+groupIds are read lazily from any iterable (file, stdin), split into tasks and sent to
+a pool of worker processes through a bounded queue, so memory usage doesn't depend on
+the number of groupIds. Every worker process creates its own Connector, its metrics
+are sent back to the job when the worker exits.
+
+With AdaptiveLimit the number of tasks in flight is adjusted by AIMD (additive increase,
+multiplicative decrease) from the latency and error rate of finished tasks, the pool
+has as many workers as the limit may reach.
+
+Progress is checkpointed as the number of groupIds, all tasks before which are finished
+(tasks finish out of order), and the groupIds which failed in those tasks. Resumed run
+re-queues the failed groupIds first, then skips that many groupIds of the input,
+tasks which were finished after that point are repeated, creation and deletion of
+the same group twice is harmless.
+"""
+
+import json
+import logging
+import os
+import statistics
+import threading
+import time
+from itertools import islice
+from multiprocessing import Pool, SimpleQueue
+from multiprocessing.util import Finalize
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from connector import Connector, merge_metrics
+
+logger = logging.getLogger(__name__)
+
+# command -> (method for one groupId, method for list of groupIds)
+COMMANDS = {
+    "create": ("create_group", "create_groups"),
+    "delete": ("delete_group", "delete_groups"),
+}
+
+_connector: Optional[Connector] = None  # connector of the worker process
+
+
+def chunked(items: Iterable[str], size: int) -> Iterator[List[str]]:
+    """Lazily splits items into lists of size <size>"""
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_group_ids(lines: Iterable[str]) -> Iterator[str]:
+    """Yields groupIds from lines of the input, one groupId per line, empty lines are skipped"""
+    for line in lines:
+        group_id = line.strip()
+        if group_id:
+            yield group_id
+
+
+def init_worker(
+    hosts: Dict[str, str],
+    connector_options: Dict,
+    metrics: Optional[SimpleQueue] = None,
+):
+    """
+    Pool initializer, creates connector of the worker process.
+    Connector is closed when the worker exits, hints of quorum writes are delivered by then,
+    afterwards its metrics are put into metrics queue
+    """
+    global _connector
+    _connector = Connector(hosts, **connector_options)
+    Finalize(_connector, _connector.close, exitpriority=10)
+    if metrics is not None:
+        Finalize(_connector, lambda: metrics.put(_connector.metrics()), exitpriority=5)
+
+
+def request_counts(connector: Connector) -> Tuple[int, int]:
+    """
+    Requests sent by the connector so far, and errors among them: retried and failed fast
+    requests, and rolled back operations
+    """
+    metrics = connector.metrics()
+    requests = errors = 0
+    for counters in metrics["nodes"].values():
+        requests += counters.get("requests", 0)
+        errors += counters.get("retries", 0) + counters.get("fast_failures", 0)
+    return requests, errors + metrics["rollbacks"]
+
+
+def run_task(
+    task: Tuple[int, str, List[str], bool],
+) -> Tuple[int, int, List[str], float, int, int]:
+    """
+    Runs command on groupIds of one task in the worker process.
+    Errors are logged and the failed groupIds returned, they don't stop the job.
+    Returns:
+        (task sequence number, number of groupIds, failed groupIds,
+         seconds the task took, requests sent by it, errors among them, see request_counts)
+    """
+    start = time.perf_counter()
+    requests, errors = request_counts(_connector)
+    seq, size, failed = apply_task(task)
+    requests_after, errors_after = request_counts(_connector)
+    return (
+        seq,
+        size,
+        failed,
+        time.perf_counter() - start,
+        requests_after - requests,
+        errors_after - errors + len(failed),
+    )
+
+
+def applied(method: str, *args, **kwargs) -> bool:
+    """Calls connector method, False if its operation was rolled back"""
+    rollbacks = _connector.metrics()["rollbacks"]
+    getattr(_connector, method)(*args, **kwargs)
+    return _connector.metrics()["rollbacks"] == rollbacks
+
+
+def apply_task(task: Tuple[int, str, List[str], bool]) -> Tuple[int, int, List[str]]:
+    """
+    Returns (task sequence number, number of groupIds, failed groupIds),
+    groupIds of raised or rolled back operations are failed
+    """
+    seq, command, group_ids, batch = task
+    single, multiple = COMMANDS[command]
+    if batch:
+        try:
+            if applied(multiple, group_ids):
+                return seq, len(group_ids), []
+            logger.warning("Rolled back %s of groups %s..", command, group_ids[:3])
+        except Exception:
+            logger.exception("Failed to %s groups %s..", command, group_ids[:3])
+        return seq, len(group_ids), group_ids
+    # existence of the whole task is checked by one request per node, not per groupId
+    kwargs = (
+        {"existing": _connector.prefetch_existence(group_ids)}
+        if command == "delete"
+        else {}
+    )
+    failed = []
+    for group_id in group_ids:
+        try:
+            if applied(single, group_id, **kwargs):
+                continue
+            logger.warning("Rolled back %s of group %s", command, group_id)
+        except Exception:
+            logger.exception("Failed to %s group %s", command, group_id)
+        failed.append(group_id)
+    return seq, len(group_ids), failed
+
+
+class AdaptiveLimit:
+    """
+    Limit of tasks in flight, adjusted by AIMD.
+    The limit starts at minimum and is doubled by every good window until the first bad one
+    (slow start), so the lowest latency is learned at low concurrency.
+    Every window of finished tasks (as many as the limit, at least min_window) is judged:
+    if median task latency is at most target_latency and error rate (errors per request,
+    see request_counts) at most target_error_rate, the limit grows by increase,
+    otherwise it is multiplied by decrease. Tasks started before a decrease are not judged,
+    they were sent at the old limit.
+    Without target_latency it is latency_factor times the lowest window median seen so far,
+    i.e. latency of the unloaded cluster with some queueing allowed. Without target_error_rate
+    it is the moving average of window error rates plus error_margin, so errors which don't
+    depend on the load (unstable nodes) don't keep the limit down.
+    Used as the semaphore of run_job: acquire before a task is queued, release when it finished.
+    Args:
+        minimum: limit at start, the limit is never lowered below it
+        maximum: limit is never raised above it, number of worker processes
+        target_latency: seconds of one task
+        target_error_rate: errors per request
+        error_margin: target_error_rate above the average error rate, if it is not given
+        error_smoothing: weight of the last window in the average error rate
+        increase: added to the limit by a good window
+        decrease: factor of the limit after a bad window
+        latency_factor: target_latency relative to the best window median, if not given
+        min_window: minimum number of tasks of a window
+    """
+
+    def __init__(
+        self,
+        minimum: int = 1,
+        maximum: int = 64,
+        target_latency: Optional[float] = None,
+        target_error_rate: Optional[float] = None,
+        error_margin: float = 0.05,
+        error_smoothing: float = 0.2,
+        increase: int = 1,
+        decrease: float = 0.75,
+        latency_factor: float = 2.0,
+        min_window: int = 4,
+    ):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = self.minimum
+        self.slow_start = True
+        self.target_latency = target_latency
+        self.target_error_rate = target_error_rate
+        self.error_margin = error_margin
+        self.error_smoothing = error_smoothing
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.min_window = min_window
+        self.best_latency: Optional[float] = None
+        self.average_error_rate: Optional[float] = None
+        self.history: List[Dict[str, Any]] = []  # one entry per judged window
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._epoch = 0  # increased by every decrease
+        self._started = time.monotonic()
+        self._window_started = self._started
+        self._latencies: List[float] = []
+        self._requests = 0
+        self._errors = 0
+        self._group_ids = 0
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Waits until the number of tasks in flight is below the limit"""
+        with self._condition:
+            if not self._condition.wait_for(
+                lambda: self._in_flight < self.limit, timeout
+            ):
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    @property
+    def epoch(self) -> int:
+        """Tag of tasks started now, given back to observe"""
+        return self._epoch
+
+    def observe(
+        self, epoch: int, size: int, seconds: float, requests: int, errors: int
+    ):
+        """Adds a finished task to the window, judges the window once it is full"""
+        with self._condition:
+            if epoch != self._epoch:
+                return
+            self._latencies.append(seconds)
+            self._requests += requests
+            self._errors += errors
+            self._group_ids += size
+            if len(self._latencies) >= max(self.limit, self.min_window):
+                self._judge()
+                self._condition.notify_all()
+
+    def _judge(self):
+        now = time.monotonic()
+        latency = statistics.median(self._latencies)
+        error_rate = self._errors / max(self._requests, 1)
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+        target = self.target_latency or self.latency_factor * self.best_latency
+        if self.target_error_rate is not None:
+            target_error_rate = self.target_error_rate
+        else:
+            # judged by the average before this window, which it would pull up
+            average = (
+                error_rate
+                if self.average_error_rate is None
+                else self.average_error_rate
+            )
+            target_error_rate = average + self.error_margin
+        if self.average_error_rate is None:
+            self.average_error_rate = error_rate
+        else:
+            self.average_error_rate += self.error_smoothing * (
+                error_rate - self.average_error_rate
+            )
+        limit = self.limit
+        if latency <= target and error_rate <= target_error_rate:
+            grown = limit * 2 if self.slow_start else limit + self.increase
+            self.limit = min(self.maximum, grown)
+        else:
+            self.slow_start = False
+            self.limit = max(self.minimum, int(limit * self.decrease))
+            self._epoch += 1
+        self.history.append(
+            {
+                "seconds": round(now - self._started, 3),
+                "limit": self.limit,
+                "previous_limit": limit,
+                "latency": round(latency, 4),
+                "target_latency": round(target, 4),
+                "error_rate": round(error_rate, 4),
+                "target_error_rate": round(target_error_rate, 4),
+                "throughput": round(
+                    self._group_ids / max(now - self._window_started, 1e-9), 1
+                ),
+            }
+        )
+        if self.limit != limit:
+            logger.info(
+                "Concurrency limit %s -> %s, task latency %.3f s (target %.3f s), "
+                "error rate %.3f (target %.3f)",
+                limit,
+                self.limit,
+                latency,
+                target,
+                error_rate,
+                target_error_rate,
+            )
+        self._window_started = now
+        self._latencies = []
+        self._requests = self._errors = self._group_ids = 0
+
+
+class Checkpoint:
+    """
+    Progress of the job stored in json file.
+        done -> number of groupIds of the input, all of which are processed
+        failed -> groupIds which failed, in tasks before done or re-queued ones
+    Without path progress is only tracked in memory.
+    Failed groupIds of the checkpoint are re-queued by the resumed job (requeued),
+    they are kept in the checkpoint until their new task is finished.
+    """
+
+    def __init__(self, path: Optional[str], command: str):
+        self.path = path
+        self.command = command
+        self.done = 0
+        self.failed: List[str] = []
+        self.requeued: List[str] = []
+        self._pending = {}  # requeued groupIds not finished yet, ordered
+        self.next_seq = 0
+        self.finished = (
+            {}
+        )  # seq -> (size, retried, failed) of tasks finished out of order
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state["command"] != command:
+                raise ValueError(
+                    f"Checkpoint {path} belongs to {state['command']} command"
+                )
+            self.done = state["done"]
+            self.requeued = state.get("failed", [])
+            self._pending = dict.fromkeys(self.requeued)
+            logger.info(
+                "Resuming from checkpoint %s, %s done, %s failed re-queued",
+                path,
+                self.done,
+                len(self.requeued),
+            )
+
+    def complete(
+        self,
+        seq: int,
+        size: int,
+        failed: Iterable[str] = (),
+        retried: Iterable[str] = (),
+    ):
+        """
+        Marks task as finished and advances done over contiguous finished tasks,
+        their failed groupIds are kept
+        Args:
+            seq: task sequence number
+            size: number of groupIds of the input in the task, 0 for re-queued ones
+            failed: groupIds of the task which failed
+            retried: re-queued groupIds of the task
+        """
+        self.finished[seq] = (size, retried, failed)
+        while self.next_seq in self.finished:
+            size, retried, failed = self.finished.pop(self.next_seq)
+            self.done += size
+            for group_id in retried:
+                self._pending.pop(group_id, None)
+            self.failed.extend(failed)
+            self.next_seq += 1
+
+    def save(self):
+        """Atomically replaces checkpoint file"""
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "command": self.command,
+                    "done": self.done,
+                    "failed": list(self._pending) + self.failed,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        """Removes the checkpoint when no groupId failed, otherwise saves it to re-queue them"""
+        if self._pending or self.failed:
+            self.save()
+        else:
+            self.remove()
+
+
+def run_job(
+    command: str,
+    group_ids: Iterable[str],
+    hosts: Dict[str, str],
+    connector_options: Optional[Dict] = None,
+    concurrency: int = 16,
+    chunk_size: int = 1,
+    checkpoint_path: Optional[str] = None,
+    queue_size: Optional[int] = None,
+    task_size: int = 16,
+    checkpoint_interval: float = 1.0,
+    metrics: Optional[Dict] = None,
+    limiter: Optional[AdaptiveLimit] = None,
+) -> Dict[str, Any]:
+    """
+    Runs create/delete command over stream of groupIds.
+    Args:
+        command: "create" or "delete"
+        group_ids: iterable of groupIds, consumed lazily
+        hosts: node -> host map
+        connector_options: keyword arguments of Connector in worker processes
+        concurrency: number of worker processes
+        chunk_size: values above 1 send chunk_size groupIds in one batch request
+        checkpoint_path: json file for progress, job resumes from it if it exists,
+                         failed groupIds of it are sent again first. File is removed
+                         when job is finished without failed groupIds
+        queue_size: maximum number of tasks queued or in progress, 2 * concurrency by default
+        task_size: number of groupIds in one task, when groupIds are sent one by one
+        checkpoint_interval: seconds between checkpoint saves
+        metrics: Connector.metrics of the workers are merged into it, by merge_metrics,
+                 when the workers exit, workers of interrupted job don't report them
+        limiter: adaptive limit of tasks in flight, replaces queue_size,
+                 the pool has limiter.maximum worker processes instead of concurrency
+    Returns:
+        {"processed": int, "failed": int}, with limiter also
+        "limits": AdaptiveLimit.history, limit chosen after every window of tasks
+    """
+    checkpoint = Checkpoint(checkpoint_path, command)
+    group_ids = islice(group_ids, checkpoint.done, None)
+    task_size = chunk_size if chunk_size > 1 else task_size
+    if limiter is not None:
+        slots = limiter
+        concurrency = limiter.maximum
+    else:
+        slots = threading.BoundedSemaphore(queue_size or 2 * concurrency)
+    stop = threading.Event()
+    batch = chunk_size > 1
+
+    def tasks():
+        # runs in task handler thread of the pool, blocks while queue is full,
+        # and stops when the job is interrupted, so the pool can be terminated
+        seq = 0
+        for retried, source in (
+            (True, checkpoint.requeued),
+            (False, group_ids),
+        ):
+            for chunk in chunked(source, task_size):
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                epochs[seq] = limiter.epoch if limiter is not None else 0
+                if retried:
+                    requeued[seq] = chunk
+                yield seq, command, chunk, batch
+                seq += 1
+
+    epochs = {}  # seq -> epoch of the limiter when the task was queued
+    requeued = {}  # seq -> groupIds of tasks of re-queued groupIds
+    processed = failed = 0
+    saved_at = time.monotonic()
+    worker_metrics = SimpleQueue() if metrics is not None else None
+    with Pool(
+        concurrency,
+        initializer=init_worker,
+        initargs=(hosts, connector_options or {}, worker_metrics),
+    ) as pool:
+        try:
+            for (
+                seq,
+                size,
+                task_failed,
+                seconds,
+                requests,
+                errors,
+            ) in pool.imap_unordered(run_task, tasks()):
+                epoch = epochs.pop(seq)
+                if limiter is not None:
+                    limiter.observe(epoch, size, seconds, requests, errors)
+                slots.release()
+                retried = requeued.pop(seq, [])
+                checkpoint.complete(seq, 0 if retried else size, task_failed, retried)
+                processed += size
+                failed += len(task_failed)
+                if time.monotonic() - saved_at >= checkpoint_interval:
+                    checkpoint.save()
+                    saved_at = time.monotonic()
+                    logger.info(
+                        "Progress: %s processed, %s failed, %s done in total",
+                        processed,
+                        failed,
+                        checkpoint.done,
+                    )
+            # workers exit normally instead of being terminated,
+            # so their connectors deliver pending hints (see init_worker)
+            pool.close()
+            pool.join()
+        except BaseException:
+            stop.set()
+            checkpoint.save()
+            raise
+    while worker_metrics is not None and not worker_metrics.empty():
+        merge_metrics(metrics, worker_metrics.get())
+    checkpoint.close()
+    result = {"processed": processed, "failed": failed}
+    if limiter is not None:
+        result["limits"] = limiter.history
+    return result
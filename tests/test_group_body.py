@@ -0,0 +1,36 @@
+"""
+Regression tests of /group request bodies, run from the repository root: python -m pytest tests
+"""
+
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks")
+)
+
+from harness import load_app  # noqa: E402
+
+main = load_app()
+
+
+def test_numeric_group_id_is_stored_as_string():
+    client = main.app.test_client()
+    headers = {"node": "node01"}
+
+    resp = client.post("/group", json={"groupId": 5}, headers=headers)
+    assert resp.status_code == 201
+
+    resp = client.get("/group/5", headers=headers)
+    assert resp.status_code == 200
+    assert resp.get_json() == {"groupId": "5"}
+
+    resp = client.delete("/group", json={"groupId": 5}, headers=headers)
+    assert resp.status_code == 200
+
+
+def test_group_body_converts_group_id():
+    from writes import group_body
+
+    assert group_body({"groupId": 5}) == {"groupId": "5"}
+    assert group_body({"groupId": "5"}) == {"groupId": "5"}